@@ -0,0 +1,7 @@
+"""
+Benchmarks of niviz-rater on synthetic studies, not installed with the
+package. Run from the repository root, e.g.:
+
+    python -m benchmarks.generate /tmp/study --subjects 1000
+    python -m benchmarks.suite --subjects 1000 -o results.json
+"""
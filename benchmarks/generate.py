@@ -0,0 +1,179 @@
+"""
+Generate a synthetic BIDS QC tree and a QC specification rating it
+
+Each subject and session gets a figures directory holding the images of
+every component, named sub-<s>[_ses-<n>]_desc-c<k>i<m>_qc.svg. Images
+are empty unless --image-bytes is given
+
+Usage:
+    python -m benchmarks.generate OUTPUT [--subjects N] [--sessions N]
+        [--components N] [--images-per-component N] [--image-bytes N]
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, Iterator, List
+from dataclasses import asdict, dataclass
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import yaml
+
+SPEC_FILE = "niviz_spec.yaml"
+EXTENSION = "svg"
+ANNOTATIONS = ["Good", "Bad"]
+
+
+@dataclass
+class StudyShape:
+    """
+    Size of a synthetic study
+
+    Attributes:
+        subjects: Number of subjects, the rows of the spreadsheet
+        sessions: Number of sessions per subject, 0 for a study without
+            sessions. Each session is a row when there are sessions
+        components: Number of QC components, the columns of the
+            spreadsheet
+        images_per_component: Number of images rated together in each
+            Entity
+        image_bytes: Size of each image file
+    """
+    subjects: int = 100
+    sessions: int = 0
+    components: int = 3
+    images_per_component: int = 2
+    image_bytes: int = 0
+
+    @property
+    def rows(self) -> int:
+        return self.subjects * max(self.sessions, 1)
+
+    @property
+    def entities(self) -> int:
+        return self.rows * self.components
+
+    @property
+    def images(self) -> int:
+        return self.entities * self.images_per_component
+
+
+def _prefixes(shape: StudyShape) -> Iterator[List[str]]:
+    for s in range(1, shape.subjects + 1):
+        subject = f"sub-{s:05d}"
+        if not shape.sessions:
+            yield [subject]
+            continue
+        for n in range(1, shape.sessions + 1):
+            yield [subject, f"ses-{n:02d}"]
+
+
+def spec(shape: StudyShape) -> Dict[str, Any]:
+    """
+    QC specification with one column per component, rating a row per
+    subject or per subject and session
+    """
+
+    entities = ["subject", "session"] if shape.sessions else ["subject"]
+    row = "_".join(f"${{{e}}}" for e in entities)
+    components = []
+    for k in range(1, shape.components + 1):
+        images = [{
+            "description": f"c{k}i{m}"
+        } for m in range(1, shape.images_per_component + 1)]
+        components.append({
+            "id": f"component{k}",
+            "entities": list(entities),
+            "label": f"{row} c{k}",
+            "column": f"c{k}",
+            "images": images,
+            "annotations": list(ANNOTATIONS)
+        })
+
+    return {
+        "ImageExtensions": [EXTENSION],
+        "RowDescription": row,
+        "Components": components
+    }
+
+
+def generate_study(root: Path, shape: StudyShape) -> Path:
+    """
+    Write the images of a synthetic study under `root` and its QC
+    specification to `root`/SPEC_FILE, which is not matched by
+    the specification
+
+    Returns:
+        spec_file: Path of the QC specification
+    """
+
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    (root / "dataset_description.json").write_text(
+        json.dumps({
+            "Name": "niviz-rater benchmark",
+            "BIDSVersion": "1.4.0",
+            "DatasetType": "derivative"
+        }))
+
+    content = b"\0" * shape.image_bytes
+    names = [
+        f"desc-c{k}i{m}_qc.{EXTENSION}"
+        for k in range(1, shape.components + 1)
+        for m in range(1, shape.images_per_component + 1)
+    ]
+    for parts in _prefixes(shape):
+        figures = root.joinpath(*parts, "figures")
+        os.makedirs(figures, exist_ok=True)
+        prefix = "_".join(parts)
+        for name in names:
+            with open(figures / f"{prefix}_{name}", "wb") as f:
+                f.write(content)
+
+    spec_file = root / SPEC_FILE
+    spec_file.write_text(yaml.safe_dump(spec(shape), sort_keys=False))
+    return spec_file
+
+
+def add_shape_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = StudyShape()
+    parser.add_argument("--subjects", type=int, default=defaults.subjects)
+    parser.add_argument("--sessions",
+                        type=int,
+                        default=defaults.sessions,
+                        help="Sessions per subject, 0 for no sessions")
+    parser.add_argument("--components",
+                        type=int,
+                        default=defaults.components)
+    parser.add_argument("--images-per-component",
+                        type=int,
+                        default=defaults.images_per_component)
+    parser.add_argument("--image-bytes",
+                        type=int,
+                        default=defaults.image_bytes,
+                        help="Size of each image, images are empty "
+                        "by default")
+
+
+def shape_from_args(args: argparse.Namespace) -> StudyShape:
+    return StudyShape(**{k: getattr(args, k) for k in asdict(StudyShape())})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", type=Path)
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    shape = shape_from_args(args)
+    start = time.perf_counter()
+    spec_file = generate_study(args.output, shape)
+    print(f"Wrote {shape.images} images of {shape.entities} entities in "
+          f"{time.perf_counter() - start:.2f}s")
+    print(f"QC specification: {spec_file}")
+
+
+if __name__ == '__main__':
+    main()
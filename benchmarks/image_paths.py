@@ -0,0 +1,139 @@
+"""
+Compare DB size and image URL serialisation time of absolute image
+paths against base directory relative paths split into directories
+
+Usage:
+    python benchmarks/image_paths.py [--entities N] [--images-per-entity K]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from peewee import SqliteDatabase
+
+from niviz_rater.db.models import database_proxy
+import niviz_rater.db.migrations as migrations
+
+BASE = "/archive/data/STUDY01/derivatives/niviz/qc"
+FILESERVER = "http://localhost:5001"
+
+LEGACY_SCHEMA = [
+    'CREATE TABLE "entity" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "image" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"path" TEXT NOT NULL, "entity_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("entity_id") REFERENCES "entity" ("id"))',
+    'CREATE UNIQUE INDEX "image_path" ON "image" ("path")',
+    'CREATE INDEX "image_entity_id" ON "image" ("entity_id")',
+    'CREATE UNIQUE INDEX "image_path_entity_id" ON "image" '
+    '("path", "entity_id")',
+]
+
+
+def build_legacy_db(db_file, n_entities, n_images):
+    db = SqliteDatabase(str(db_file))
+    with db.atomic():
+        for statement in LEGACY_SCHEMA:
+            db.execute_sql(statement)
+        for e in range(n_entities):
+            sub = f"sub-{e:06d}"
+            db.execute_sql("INSERT INTO entity VALUES (?, ?)", (e + 1, sub))
+            db.execute_sql(
+                "INSERT INTO image (path, entity_id) VALUES " +
+                ", ".join(["(?, ?)"] * n_images),
+                [
+                    v for i in range(n_images)
+                    for v in (f"{BASE}/{sub}/ses-01/figures/"
+                              f"{sub}_ses-01_desc-qc{i}_bold.svg", e + 1)
+                ])
+    db.close()
+
+
+def db_size(db_file):
+    db = SqliteDatabase(str(db_file))
+    db.execute_sql("VACUUM")
+    db.close()
+    return os.path.getsize(db_file)
+
+
+def legacy_urls(db_file):
+    """
+    Previous behaviour: relpath on every absolute image path
+    """
+    db = SqliteDatabase(str(db_file))
+    config = {
+        'niviz_rater.base_path': BASE,
+        'niviz_rater.fileserver': FILESERVER
+    }
+    rows = db.execute_sql("SELECT path FROM image").fetchall()
+
+    start = time.perf_counter()
+    for (path, ) in rows:
+        img = os.path.relpath(path, config['niviz_rater.base_path'])
+        f"{config['niviz_rater.fileserver']}/{img}"
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+def relative_urls(db_file):
+    """
+    Current behaviour: prefix join on relative directory + name
+    """
+    db = SqliteDatabase(str(db_file))
+    rows = db.execute_sql(
+        "SELECT d.path, i.name FROM image i "
+        "JOIN imagedirectory d ON i.directory_id = d.id").fetchall()
+
+    start = time.perf_counter()
+    prefix = f"{FILESERVER}/"
+    for directory, name in rows:
+        prefix + directory + name
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, default=100000)
+    parser.add_argument("--images-per-entity", type=int, default=4)
+    args = parser.parse_args()
+
+    tmpdir = Path(tempfile.mkdtemp())
+    try:
+        legacy = tmpdir / "legacy.db"
+        build_legacy_db(legacy, args.entities, args.images_per_entity)
+        legacy_size = db_size(legacy)
+        legacy_time = legacy_urls(legacy)
+
+        migrated = tmpdir / "migrated.db"
+        shutil.copy(legacy, migrated)
+        db = SqliteDatabase(str(migrated))
+        database_proxy.initialize(db)
+        start = time.perf_counter()
+        migrations.migrate(db, base_path=BASE)
+        migrate_time = time.perf_counter() - start
+        db.close()
+        migrated_size = db_size(migrated)
+        migrated_time = relative_urls(migrated)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    n = args.entities * args.images_per_entity
+    print(f"Images: {n}")
+    print(f"DB size (absolute paths): {legacy_size / 1024**2:.1f} MB")
+    print(f"DB size (relative paths): {migrated_size / 1024**2:.1f} MB "
+          f"({100 * (1 - migrated_size / legacy_size):.0f}% smaller)")
+    print(f"Migration time: {migrate_time:.2f}s")
+    print(f"URL building (relpath):     {legacy_time * 1000:.0f} ms")
+    print(f"URL building (prefix join): {migrated_time * 1000:.0f} ms "
+          f"({legacy_time / migrated_time:.0f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Measure /api/spreadsheet serialisation throughput of model instances
+with prefetched images against tuple queries with SQL aggregated images
+
+Usage:
+    python benchmarks/serialisation.py [--entities N] [--images-per-entity K]
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from bottle import default_app, request
+from peewee import SqliteDatabase
+
+import niviz_rater.api as api
+import niviz_rater.db.queries as queries
+import niviz_rater.db.utils as dbutils
+import niviz_rater.db.models as models
+from niviz_rater.config import db_defaults
+
+FILESERVER = "http://localhost:5001"
+N_COLUMNS = 10
+
+
+def build_db(db_file, n_entities, n_images):
+    db = SqliteDatabase(str(db_file), pragmas={'foreign_keys': 1})
+    models.database_proxy.initialize(db)
+    dbutils.initialize_tables(db, {})
+
+    n_rows = max(n_entities // N_COLUMNS, 1)
+    with db.atomic():
+        models.Component.insert_many([(f"component{c}", )
+                                      for c in range(N_COLUMNS)],
+                                     fields=["name"]).execute()
+        models.TableColumn.insert_many([(f"column{c}", )
+                                        for c in range(N_COLUMNS)],
+                                       fields=["name"]).execute()
+        models.TableRow.insert_many([(f"sub-{r:06d}", )
+                                     for r in range(n_rows)],
+                                    fields=["name"]).execute()
+        models.ImageDirectory.insert_many([(f"sub-{r:06d}/figures/", )
+                                           for r in range(n_rows)],
+                                          fields=["path"]).execute()
+
+        cursor = db.cursor()
+        cursor.executemany(
+            'INSERT INTO "entity" ("id", "name", "columnname_id", '
+            '"rowname_id", "component_id", "comment", "rating_id", '
+            '"version") VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+            ((e + 1, f"entity {e}", e % N_COLUMNS + 1, e // N_COLUMNS + 1,
+              e % N_COLUMNS + 1, "", (e % 3) or None)
+             for e in range(n_entities)))
+        cursor.executemany(
+            'INSERT INTO "image" ("directory_id", "name", "entity_id") '
+            'VALUES (?, ?, ?)',
+            ((e // N_COLUMNS + 1, f"entity{e}_desc-qc{i}.svg", e + 1)
+             for e in range(n_entities) for i in range(n_images)))
+    return db
+
+
+def legacy_spreadsheet():
+    """
+    Previous implementation: denormalized models with prefetched images
+    """
+
+    def _rating(rating):
+        if rating is None:
+            return {'id': None, 'name': db_defaults.DEFAULT_RATING}
+        return {'id': rating.id, 'name': rating.name}
+
+    def _annotation(annotation):
+        if annotation is None:
+            return {'id': None, 'name': db_defaults.DEFAULT_ANNOTATION}
+        return {'id': annotation.id, 'name': annotation.name}
+
+    prefix = f"{FILESERVER}/"
+    entities = queries.get_denormalized_entities()
+    payload = {
+        "entities": [{
+            "rowName": e.rowname.name,
+            "columnName": e.columnname.name,
+            "imagePaths": [prefix + i.path for i in e.images],
+            "thumbnailPaths": [prefix + i.path for i in e.images],
+            "comment": e.comment,
+            "rating": _rating(e.rating),
+            "id": e.id,
+            "name": e.name,
+            "annotation": _annotation(e.annotation)
+        } for e in entities]
+    }
+    return json.dumps(payload)
+
+
+def timed(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = func()
+        best = min(best, time.perf_counter() - start)
+    return best, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, default=100000)
+    parser.add_argument("--images-per-entity", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    app = default_app()
+    app.config['niviz_rater.fileserver'] = FILESERVER
+    request.bind({'bottle.app': app})
+
+    tmpdir = Path(tempfile.mkdtemp())
+    try:
+        db = build_db(tmpdir / "niviz.db", args.entities,
+                      args.images_per_entity)
+        legacy, legacy_size = timed(legacy_spreadsheet, args.repeat)
+        current, current_size = timed(api.spreadsheet, args.repeat)
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    encoder = "orjson" if api.orjson is not None else "json"
+    per_100k = 100000 / args.entities
+    print(f"Entities: {args.entities}, images per entity: "
+          f"{args.images_per_entity}")
+    print(f"Models + prefetch + json: {legacy * per_100k:.2f}s per 100k "
+          f"entities ({args.entities / legacy:,.0f} entities/s, "
+          f"{legacy_size / 1024**2:.1f} MB)")
+    print(f"Tuples + group_concat + {encoder}: "
+          f"{current * per_100k:.2f}s per 100k entities "
+          f"({args.entities / current:,.0f} entities/s, "
+          f"{current_size / 1024**2:.1f} MB)")
+    print(f"Speedup: {legacy / current:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+"""
+Time ingestion and API endpoints of niviz-rater on a synthetic study and
+write the results as JSON, to compare them across commits
+
+Benchmarks, each the best of --repeat runs:
+    layout: Scanning the study with pyBIDS
+    spec: Expanding the QC specification into Entities of each component
+    initialize_db: The `initialize_db` subcommand on an empty DB
+    update_db: The `update_db` subcommand updating every Entity
+    spreadsheet: GET /api/spreadsheet
+    export: GET /api/export
+    save: POST /api/entity saving --saves ratings
+    queue: POST /api/queue/next once the default rater has rated all but
+        the last Entity of the largest column
+    queue_rater: As queue for a named rater, whose unrated Entities are
+        found by scanning its rated Entities of the column
+
+Usage:
+    python -m benchmarks.suite [--study DIR] [--subjects N] [--sessions N]
+        [--components N] [--images-per-component N] [--repeat N]
+        [--saves N] [-o OUTPUT] [--compare BASELINE]
+"""
+
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Optional
+from argparse import Namespace
+from dataclasses import asdict
+import argparse
+import io
+import itertools
+import json
+import logging
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from wsgiref.util import setup_testing_defaults
+
+from peewee import fn
+
+import niviz_rater.app as app
+import niviz_rater.db.models as models
+import niviz_rater.db.queries as queries
+import niviz_rater.db.utils as dbutils
+from niviz_rater.db.models import database_proxy
+from niviz_rater.spec import SpecConfig, db_settings_from_config
+from niviz_rater.utils import get_bids_layout, update_bids_configuration
+from niviz_rater.validation import validate_config
+
+from benchmarks.generate import (add_shape_arguments, generate_study,
+                                 shape_from_args, SPEC_FILE)
+
+FILESERVER = "http://localhost:5001"
+
+Result = Dict[str, Any]
+
+
+def timed(func: Callable[[], Any],
+          repeat: int,
+          setup: Optional[Callable[[], Any]] = None,
+          **extra: Any) -> Result:
+    """
+    Time `repeat` calls of `func`, calling `setup` untimed before each
+
+    Arguments:
+        extra: Keys added to the result, given the value returned by
+            the last call of `func` if callable
+
+    Returns:
+        result: Best and all times in seconds, and `extra`
+    """
+
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        value = func()
+        runs.append(time.perf_counter() - start)
+
+    result = {"seconds": min(runs), "runs": runs}
+    result.update({
+        k: v(value) if callable(v) else v
+        for k, v in extra.items()
+    })
+    return result
+
+
+def call(method: str, path: str, payload: Any = None) -> int:
+    """
+    Request `path` from the bottle application without a server
+
+    Returns:
+        size: Size of the response body in bytes
+    """
+
+    path, _, query = path.partition("?")
+    body = json.dumps(payload).encode() if payload is not None else b""
+    environ: Dict[str, Any] = {}
+    setup_testing_defaults(environ)
+    environ.update({
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "CONTENT_TYPE": "application/json",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body)
+    })
+
+    status: List[str] = []
+    chunks = app.app(environ, lambda s, h, e=None: status.append(s))
+    try:
+        size = sum(len(chunk) for chunk in chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    if not status[0].startswith("200"):
+        raise RuntimeError(f"{method} {path} failed: {status[0]}")
+    return size
+
+
+def _open_db(db_file: Path) -> None:
+    db = dbutils.get_or_create_db(str(db_file))
+    database_proxy.initialize(db)
+    app.app.config['niviz_rater.db.file'] = str(db_file)
+    app.app.config['niviz_rater.db.instance'] = database_proxy
+
+
+def run_benchmarks(study: Path, workdir: Path, repeat: int,
+                   saves: int) -> Dict[str, Result]:
+    bids_configs = update_bids_configuration(app.DEFAULT_BIDS_CONFIGURATION)
+    qc_spec = validate_config(str(study / SPEC_FILE), bids_configs)
+    config = SpecConfig.from_validated(qc_spec)
+    db_settings = db_settings_from_config(qc_spec,
+                                          app.CONFIGURABLE_DB_SETTINGS)
+    db_file = workdir / "niviz.db"
+    # Arguments of the initialize_db and update_db subcommands
+    args = Namespace(db_file=str(db_file),
+                     db_settings=db_settings,
+                     config=config,
+                     base_directory=str(study),
+                     compression_cache=None,
+                     update_existing=True,
+                     no_reset_on_update=True)
+    app.app.config['niviz_rater.base_path'] = str(study)
+    app.app.config['niviz_rater.fileserver'] = FILESERVER
+
+    results = {}
+    results["layout"] = timed(lambda: get_bids_layout(str(study)), repeat)
+    args.bids_layout = get_bids_layout(str(study))
+
+    def _expand():
+        return sum(
+            len(c.entities)
+            for c in config.entities_by_component(args.bids_layout))
+
+    results["spec"] = timed(_expand, repeat, entities=lambda n: n)
+
+    def _empty_db():
+        if database_proxy.obj is not None:
+            database_proxy.close()
+        for path in workdir.glob("niviz.db*"):
+            path.unlink()
+        _open_db(db_file)
+
+    results["initialize_db"] = timed(lambda: app.initialize_db(args),
+                                     repeat,
+                                     setup=_empty_db)
+    results["update_db"] = timed(lambda: app.update_db(args), repeat)
+    results["spreadsheet"] = timed(lambda: call("GET", "/api/spreadsheet"),
+                                   repeat,
+                                   bytes=lambda size: size)
+    results["export"] = timed(lambda: call("GET", "/api/export"),
+                              repeat,
+                              bytes=lambda size: size)
+
+    ids = [e.id for e in models.Entity.select(models.Entity.id)]
+    sample = random.Random(0).sample(ids, min(saves, len(ids)))
+    ratings = [r.id for r in models.Rating.select(models.Rating.id)]
+    changes: List[Dict[str, Any]] = []
+    runs = itertools.count()
+
+    def _changes():
+        versions = dict(
+            models.Entity.select(models.Entity.id,
+                                 models.Entity.version).where(
+                                     models.Entity.id.in_(sample)).tuples())
+        # Rotate ratings between runs so every save is a change
+        offset = next(runs)
+        changes[:] = [{
+            "id": entity_id,
+            "version": versions[entity_id],
+            "rating": ratings[(i + offset) % len(ratings)]
+        } for i, entity_id in enumerate(sample)]
+
+    def _save():
+        for change in changes:
+            call("POST", "/api/entity", change)
+
+    results["save"] = timed(_save, repeat, setup=_changes, saves=len(sample))
+    results.update(_queue_benchmarks(repeat, ratings[0]))
+    database_proxy.close()
+    return results
+
+
+def _queue_benchmarks(repeat: int, rating: int) -> Dict[str, Result]:
+    """
+    Time leasing the last Entity of the largest column, which all the
+    other Entities of the column are rated before
+    """
+
+    column, = (models.TableColumn.select().join(models.Entity).group_by(
+        models.TableColumn.id).order_by(
+            fn.COUNT(models.Entity.id).desc()).limit(1))
+    ids = [
+        e.id for e in models.Entity.select(models.Entity.id).where(
+            models.Entity.columnname == column).order_by(models.Entity.id)
+    ]
+    rater = queries.get_rater("benchmark", create=True)
+    with database_proxy.atomic():
+        models.Entity.update(rating=rating).where(
+            models.Entity.id.in_(ids[:-1])).execute()
+        models.Entity.update(rating=None).where(
+            models.Entity.id == ids[-1]).execute()
+        models.RaterRating.insert_many(
+            [(rater.id, i, rating) for i in ids[:-1]],
+            fields=[
+                models.RaterRating.rater, models.RaterRating.entity,
+                models.RaterRating.rating
+            ]).on_conflict_replace().execute()
+
+    path = (f"/api/queue/next?holder=benchmark&prefetch=0"
+            f"&column={column.name}")
+    return {
+        "queue": timed(lambda: call("POST", path), repeat,
+                       entities=len(ids)),
+        "queue_rater": timed(lambda: call("POST", path + "&rater=benchmark"),
+                             repeat,
+                             entities=len(ids))
+    }
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              cwd=Path(__file__).parent,
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> str:
+    """
+    Table of the best times of `report` relative to `baseline`
+    """
+
+    lines = [f"{'benchmark':<14}{'baseline':>12}{'current':>12}{'ratio':>8}"]
+    if (report["shape"], report["study"]) != (baseline["shape"],
+                                              baseline["study"]):
+        lines.insert(0, "Warning: the baseline was run on a different study")
+    for name, result in report["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            continue
+        lines.append(f"{name:<14}{before['seconds']:>11.3f}s"
+                     f"{result['seconds']:>11.3f}s"
+                     f"{result['seconds'] / before['seconds']:>8.2f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--study",
+                        type=Path,
+                        help="Study written by benchmarks.generate, a "
+                        "temporary study of the given shape is generated "
+                        "by default")
+    add_shape_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--saves",
+                        type=int,
+                        default=200,
+                        help="Ratings saved in each run of the save "
+                        "benchmark")
+    parser.add_argument("-o",
+                        "--output",
+                        default="-",
+                        help="File to write JSON results to, written to "
+                        "stdout by default")
+    parser.add_argument("--compare",
+                        type=Path,
+                        help="JSON results of an earlier run to compare "
+                        "against")
+    args = parser.parse_args()
+
+    # Subcommands log every Entity they add, which would be timed too
+    logging.disable(logging.INFO)
+
+    workdir = Path(tempfile.mkdtemp())
+    try:
+        shape = None
+        study = args.study
+        if study is None:
+            shape = shape_from_args(args)
+            study = workdir / "study"
+            generate_study(study, shape)
+        results = run_benchmarks(study, workdir, args.repeat, args.saves)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        "commit": _commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "study": str(args.study) if args.study else None,
+        "shape": asdict(shape) if shape else None,
+        "repeat": args.repeat,
+        "benchmarks": results
+    }
+    content = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(content)
+    else:
+        Path(args.output).write_text(content)
+
+    if args.compare:
+        print(compare(report, json.loads(args.compare.read_text())),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
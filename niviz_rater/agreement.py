@@ -0,0 +1,353 @@
+"""
+Inter-rater agreement statistics computed over a dictionary-encoded
+matrix of Entity ratings (Entities x raters)
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from itertools import combinations
+
+import niviz_rater.db.queries as queries
+from niviz_rater.db.models import Component, Rating, TableColumn
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Name of the default rater, whose ratings are stored on Entities
+DEFAULT_RATER = "default"
+
+# Default number of disagreeing Entities listed per component/column
+DISAGREEMENTS = 100
+
+# Code of an unrated Entity in RatingMatrix.codes
+UNRATED = -1
+
+
+class RatingMatrix(NamedTuple):
+    """
+    Ratings of every Entity by each rater
+
+    Attributes:
+        entity_ids: (N,) Entity ids in ascending order
+        components: (N,) Component id of each Entity
+        columns: (N,) TableColumn id of each Entity
+        codes: (N, R) index into `ratings` of each Entity's rating by
+            each rater, UNRATED if not rated
+        raters: R rater names
+        ratings: Rating names indexed by code
+    """
+    entity_ids: Any
+    components: Any
+    columns: Any
+    codes: Any
+    raters: List[str]
+    ratings: List[str]
+
+
+def _resolve_raters(raters: Optional[List[str]]) -> list:
+    """
+    Look up Rater models, None stands for the default rater
+
+    Raises:
+        ValueError: If any of `raters` do not exist
+    """
+
+    if raters is None:
+        return [None] + list(queries.get_raters())
+
+    models = []
+    for name in raters:
+        if name == DEFAULT_RATER:
+            models.append(None)
+            continue
+        rater = queries.get_rater(name)
+        if rater.id is None:
+            raise ValueError(f"Unknown rater {name}")
+        models.append(rater)
+    return models
+
+
+def load_ratings(raters: Optional[List[str]] = None) -> RatingMatrix:
+    """
+    Load ratings into a RatingMatrix with a single query, Rating ids
+    are dictionary encoded to small integer codes
+
+    Arguments:
+        raters: Names of raters to load, DEFAULT_RATER is the default
+            rater. Defaults to the default rater and all Raters
+
+    Raises:
+        ValueError: If any of `raters` do not exist
+    """
+
+    rater_models = _resolve_raters(raters)
+    ratings = list(Rating.select().order_by(Rating.id))
+
+    lookup = np.full(max([r.id for r in ratings], default=0) + 1,
+                     UNRATED,
+                     dtype=np.int16)
+    lookup[[r.id for r in ratings]] = np.arange(len(ratings))
+
+    dtype = np.dtype([("entity", np.int64), ("component", np.int64),
+                      ("column", np.int64)] +
+                     [(f"rater{i}", np.int64)
+                      for i in range(len(rater_models))])
+    records = np.fromiter(queries.get_rating_matrix_records(rater_models),
+                          dtype=dtype)
+
+    # Column-major so each rater's ratings are contiguous
+    codes = np.empty((len(records), len(rater_models)),
+                     dtype=np.int16,
+                     order="F")
+    for i in range(len(rater_models)):
+        codes[:, i] = lookup[records[f"rater{i}"]]
+
+    return RatingMatrix(
+        records["entity"], records["component"], records["column"], codes,
+        [DEFAULT_RATER if r is None else r.name for r in rater_models],
+        [r.name for r in ratings])
+
+
+def confusion_matrices(a, b, groups, n_groups: int, n_ratings: int):
+    """
+    Confusion matrices of rating codes `a` against `b` for each group,
+    counting only Entities rated in both
+
+    Returns:
+        confusion: (n_groups, n_ratings, n_ratings) counts
+    """
+
+    both = (a != UNRATED) & (b != UNRATED)
+    index = (groups[both] * n_ratings + a[both]) * n_ratings + b[both]
+    return np.bincount(index, minlength=n_groups * n_ratings *
+                       n_ratings).reshape(n_groups, n_ratings, n_ratings)
+
+
+def cohen_kappa(confusion):
+    """
+    Cohen's kappa of each of a stack of (..., K, K) confusion matrices,
+    NaN where undefined (no ratings or a single category used)
+    """
+
+    n = confusion.sum(axis=(-2, -1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        observed = np.trace(confusion, axis1=-2, axis2=-1) / n
+        expected = (confusion.sum(axis=-1) *
+                    confusion.sum(axis=-2)).sum(axis=-1) / n**2
+        return (observed - expected) / (1 - expected)
+
+
+def fleiss_kappa(codes, groups, n_groups: int,
+                 n_ratings: int) -> Tuple[Any, Any]:
+    """
+    Fleiss' kappa of each group over Entities rated by every rater
+
+    Returns:
+        kappa: (n_groups,) Fleiss' kappa, NaN where undefined
+        n_entities: (n_groups,) Number of Entities rated by every rater
+    """
+
+    n_raters = codes.shape[1]
+    complete = (codes != UNRATED).all(axis=1)
+    if n_raters < 2:
+        complete[:] = False
+
+    codes, groups = codes[complete], groups[complete]
+    n_entities = np.bincount(groups, minlength=n_groups)
+
+    # Number of raters assigning each rating to each Entity
+    counts = np.zeros((len(codes), n_ratings), dtype=np.int64)
+    rows = np.arange(len(codes))
+    for i in range(n_raters):
+        counts[rows, codes[:, i]] += 1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entity_agreement = ((counts**2).sum(axis=1) -
+                            n_raters) / (n_raters * (n_raters - 1))
+        observed = np.bincount(groups,
+                               weights=entity_agreement,
+                               minlength=n_groups) / n_entities
+
+        proportions = np.stack([
+            np.bincount(groups, weights=counts[:, j], minlength=n_groups)
+            for j in range(n_ratings)
+        ],
+                               axis=1) / (n_entities * n_raters)[:, None]
+        expected = (proportions**2).sum(axis=1)
+        return (observed - expected) / (1 - expected), n_entities
+
+
+def disagreements(codes):
+    """
+    Mask of Entities given different ratings by at least two raters
+    """
+
+    rated = codes != UNRATED
+    highest = codes.max(axis=1)
+    lowest = np.where(rated, codes, np.iinfo(codes.dtype).max).min(axis=1)
+    return (rated.sum(axis=1) >= 2) & (highest != lowest)
+
+
+def _first_per_group(indices, groups, n_groups: int,
+                     limit: Optional[int]) -> List[Any]:
+    """
+    Split `indices` by group, keeping the first `limit` of each group
+    """
+
+    order = np.argsort(groups, kind="stable")
+    indices, groups = indices[order], groups[order]
+    bounds = np.searchsorted(groups, np.arange(n_groups + 1))
+    return [
+        indices[start:stop if limit is None else min(stop, start + limit)]
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def _number(value) -> Optional[float]:
+    """
+    JSON compatible float, NaN becomes None
+    """
+
+    return None if np.isnan(value) else float(value)
+
+
+def _group_reports(matrix: RatingMatrix, disagree, groups, n_groups: int,
+                   limit: Optional[int]) -> Tuple[List[dict], List[Any]]:
+    """
+    Agreement statistics of each group of Entities, computed for all
+    groups at once. `disagree` is the disagreements() mask of `matrix`
+
+    Returns:
+        reports: Agreement report of each group
+        listed: Indices into `matrix` of the disagreements listed
+            in each group's report
+    """
+
+    codes = matrix.codes
+    n_ratings = max(len(matrix.ratings), 1)
+    n_entities = np.bincount(groups, minlength=n_groups)
+    n_rated = np.stack([
+        np.bincount(groups[codes[:, i] != UNRATED], minlength=n_groups)
+        for i in range(codes.shape[1])
+    ],
+                       axis=1)
+
+    pairs = []
+    for i, j in combinations(range(codes.shape[1]), 2):
+        confusion = confusion_matrices(codes[:, i], codes[:, j], groups,
+                                       n_groups, n_ratings)
+        n = confusion.sum(axis=(1, 2))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            observed = np.trace(confusion, axis1=1, axis2=2) / n
+        pairs.append(((i, j), confusion, n, observed,
+                      cohen_kappa(confusion)))
+
+    fleiss, n_complete = fleiss_kappa(codes, groups, n_groups, n_ratings)
+
+    n_disagree = np.bincount(groups[disagree], minlength=n_groups)
+    listed = _first_per_group(np.flatnonzero(disagree), groups[disagree],
+                              n_groups, limit)
+
+    reports = [{
+        "entities": int(n_entities[g]),
+        "rated": n_rated[g].tolist(),
+        "fleissKappa": _number(fleiss[g]),
+        "fleissEntities": int(n_complete[g]),
+        "pairs": [{
+            "raters": [matrix.raters[i], matrix.raters[j]],
+            "entities": int(n[g]),
+            "agreement": _number(observed[g]),
+            "kappa": _number(kappa[g]),
+            "confusion": confusion[g].tolist()
+        } for (i, j), confusion, n, observed, kappa in pairs],
+        "disagreements": {
+            "count": int(n_disagree[g]),
+        }
+    } for g in range(n_groups)]
+    return reports, listed
+
+
+def _encode_groups(ids) -> Tuple[Any, Any]:
+    """
+    Dictionary encode group ids to 0..G-1
+
+    Returns:
+        unique_ids: (G,) Distinct group ids
+        groups: Group index of each element of `ids`
+    """
+    return np.unique(ids, return_inverse=True)
+
+
+def agreement_report(raters: Optional[List[str]] = None,
+                     limit: Optional[int] = DISAGREEMENTS) -> Dict[str, Any]:
+    """
+    Inter-rater agreement over all Entities and per component and
+    column: pairwise percent agreement, Cohen's kappa and confusion
+    matrices, Fleiss' kappa over Entities rated by all raters and
+    Entities rated differently by at least two raters
+
+    Arguments:
+        raters: Names of raters to compare, DEFAULT_RATER is the default
+            rater. Defaults to the default rater and all Raters
+        limit: Maximum number of disagreements listed per component
+            or column, None lists all
+
+    Raises:
+        ValueError: If any of `raters` do not exist or fewer than two
+            raters are compared
+    """
+
+    matrix = load_ratings(raters)
+    if len(matrix.raters) < 2:
+        raise ValueError("At least two raters are required to compute "
+                         "agreement")
+
+    disagree = disagreements(matrix.codes)
+    overall, overall_listed = _group_reports(
+        matrix, disagree, np.zeros(len(matrix.entity_ids), dtype=np.int64), 1,
+        limit)
+
+    component_ids, component_groups = _encode_groups(matrix.components)
+    components, component_listed = _group_reports(matrix, disagree,
+                                                  component_groups,
+                                                  len(component_ids), limit)
+
+    column_ids, column_groups = _encode_groups(matrix.columns)
+    columns, column_listed = _group_reports(matrix, disagree, column_groups,
+                                            len(column_ids), limit)
+
+    listed = overall_listed + component_listed + column_listed
+    names = queries.get_entity_names(
+        matrix.entity_ids[np.unique(np.concatenate(listed))].tolist())
+    for report, indices in zip(overall + components + columns, listed):
+        report["disagreements"]["entities"] = [{
+            "id": int(matrix.entity_ids[i]),
+            "name": names[int(matrix.entity_ids[i])],
+            "ratings": [
+                None if c == UNRATED else matrix.ratings[c]
+                for c in matrix.codes[i].tolist()
+            ]
+        } for i in indices.tolist()]
+
+    component_names = dict(
+        Component.select(Component.id, Component.name).where(
+            Component.id.in_(component_ids.tolist())).tuples())
+    column_names = dict(
+        TableColumn.select(TableColumn.id, TableColumn.name).where(
+            TableColumn.id.in_(column_ids.tolist())).tuples())
+
+    return {
+        "raters": matrix.raters,
+        "ratings": matrix.ratings,
+        "overall": overall[0],
+        "components": {
+            component_names[i]: r
+            for i, r in zip(component_ids.tolist(), components)
+        },
+        "columns": {
+            column_names[i]: r
+            for i, r in zip(column_ids.tolist(), columns)
+        }
+    }
@@ -2,29 +2,162 @@
 API for accessing and updating stored QC Index
 """
 
-import os
-from bottle import route, Bottle, request, response
+from bottle import route, Bottle, request, response, static_file, redirect
+from peewee import DoesNotExist, IntegrityError
 
-from niviz_rater.db.utils import fetch_db_from_config
 import niviz_rater.db.queries as queries
+import niviz_rater.db.exceptions as exceptions
+import niviz_rater.export as export
+import niviz_rater.agreement as agreement
+import niviz_rater.db.backup as backup
+import niviz_rater.telemetry as telemetry
+import niviz_rater.metrics as metrics
 from niviz_rater.config import db_defaults
+from niviz_rater.db.models import SAVE_EVENT, VIEW_EVENT
+from niviz_rater.thumbnails import is_thumbnailable
+from bisect import bisect_right
+from functools import wraps
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import json
 import logging
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 apiRoutes = Bottle()
 logger = logging.getLogger(__file__)
 
+# Default and maximum number of Entity views returned for prefetching
+NEXT_VIEWS = 5
+MAX_NEXT_VIEWS = 20
+
+# Default and maximum number of following Entity ids returned by the queue
+QUEUE_PREFETCH = 5
+QUEUE_MAX_PREFETCH = 50
+
+# Default and maximum number of incomplete rows returned by progress
+PROGRESS_ROWS = 10
+MAX_PROGRESS_ROWS = 100
+
+# Number of finished snapshots whose status is kept for
+# /api/admin/backup/<snapshot>
+SNAPSHOT_STATUSES = 20
+
+# Snapshots started by POST /api/admin/backup, by file name, oldest first
+_snapshots: Dict[str, backup.BackgroundSnapshot] = {}
+_snapshots_lock = threading.Lock()
+
+
+class ReadCache(NamedTuple):
+    """
+    Responses of the default rater precomputed when serving a read-only
+    DB, which cannot change while it is served
+
+    Attributes:
+        spreadsheet: Body of /api/spreadsheet
+        views: Mapping of Entity ids to the body of their
+            /api/entity/<id>/view and image URLs
+        order: Entity ids in spreadsheet order
+        positions: Mapping of Entity ids to their index in `order`
+        unrated: Sorted indices in `order` of unrated Entities
+    """
+    spreadsheet: bytes
+    views: Dict[int, Tuple[bytes, List[str]]]
+    order: List[int]
+    positions: Dict[int, int]
+    unrated: List[int]
+
+    def next_entity_ids(self,
+                        entity_id: int,
+                        count: int,
+                        unrated: bool = False) -> Optional[List[int]]:
+        """
+        Ids as returned by queries.get_next_entity_ids, None if the
+        Entity does not exist
+        """
+
+        position = self.positions.get(entity_id)
+        if position is None:
+            return None
+        if not unrated:
+            return self.order[position + 1:position + 1 + count]
+        start = bisect_right(self.unrated, position)
+        return [self.order[i] for i in self.unrated[start:start + count]]
+
+
+def _fileserver(app_config):
+    """
+    Return URL prefix of the fileserver, Image paths are stored relative
+    to the base directory so an image's URL is `prefix + image.path`
+    """
 
-def _fileserver(path, app_config):
+    return f"{app_config['niviz_rater.fileserver']}/"
+
+
+def _thumbnailer(app_config):
     """
-    Transform local directory path to fileserver path
+    Return URL prefix of image thumbnails or None if thumbnails
+    are not enabled
     """
 
-    base = app_config['niviz_rater.base_path']
-    address = app_config['niviz_rater.fileserver']
+    if 'niviz_rater.thumbnails' not in app_config:
+        return None
+    return "/api/thumbnail/"
+
+
+def _thumbnail(path, image_prefix, thumbnail_prefix):
+    """
+    Build thumbnail URL for image `path`, falls back to the full
+    image if thumbnails are not available for it (i.e SVG)
+    """
+
+    if thumbnail_prefix is None or not is_thumbnailable(path):
+        return image_prefix + path
+    return thumbnail_prefix + path
+
+
+def _encode(payload):
+    """
+    Encode `payload` as JSON bytes, using orjson when available
+    """
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode()
+
+
+def _json(payload):
+    """
+    Encode `payload` as a JSON response body
+    """
 
-    img = os.path.relpath(path, base)
-    addr = f"{address}/{img}"
-    return addr
+    response.content_type = 'application/json'
+    return _encode(payload)
+
+
+def _writes(func):
+    """
+    Reject requests to a route that writes to the DB with 403 Forbidden
+    when serving a read-only DB
+    """
+
+    @wraps(func)
+    def _wrapped(*args, **kwargs):
+        if request.app.config.get('niviz_rater.read_only'):
+            response.status = 403
+            return {"error": "The server is read-only"}
+        return func(*args, **kwargs)
+
+    return _wrapped
+
+
+def _image_paths(images):
+    if images is None:
+        return []
+    return images.split(queries.IMAGE_SEPARATOR)
 
 
 def _annotation(annotation):
@@ -34,6 +167,30 @@ def _annotation(annotation):
         return {'id': annotation.id, 'name': annotation.name}
 
 
+def _rater(name=None, create=False):
+    """
+    Return the Rater given by `name`, or by the `rater` query parameter,
+    None selects the default rater whose ratings are stored on Entities
+    """
+
+    if name is None:
+        name = request.query.decode().get('rater')
+    if not name:
+        return None
+    return queries.get_rater(name, create=create)
+
+
+def _record(kind, entity_id, rater=None):
+    """
+    Buffer a telemetry event of `kind` if telemetry is enabled
+    """
+
+    buffer = request.app.config.get('niviz_rater.telemetry')
+    if buffer is None:
+        return
+    buffer.record(kind, entity_id, rater.name if rater is not None else None)
+
+
 def _rating(rating):
     if rating is None:
         return {'id': None, 'name': db_defaults.DEFAULT_RATING}
@@ -51,17 +208,105 @@ def summary():
         - total number of annotations required
     """
 
-    total, n_rated, n_unrated = queries.get_summary()
-    logger.info(f"Number of unrated scans is: {n_unrated}")
+    total, n_rated, n_unrated = queries.get_summary(_rater())
+    logger.debug("Number of unrated scans is: %d", n_unrated)
 
     return {
         "numberOfUnrated": n_unrated,
         "numberOfRated": n_rated,
-        "numberOfRows": 0,
+        "numberOfRows": queries.get_row_count(),
         "numberOfEntities": total
     }
 
 
+def _histogram(counts, rating_names):
+    """
+    Summarize (rating_id, count) pairs as the number of Entities, rated
+    Entities and Entities given each rating (by name)
+    """
+
+    histogram = dict.fromkeys(rating_names.values(), 0)
+    for rating_id, count in counts:
+        histogram[rating_names[rating_id]] += count
+    total = sum(histogram.values())
+    return {
+        "entities": total,
+        "rated": total - histogram[db_defaults.DEFAULT_RATING],
+        "ratings": histogram
+    }
+
+
+def _group_progress(counts, names, rating_names):
+    """
+    Histogram of each group in (group_id, rating_id, count) `counts`,
+    ordered by group name
+    """
+
+    grouped = {}
+    for group_id, rating_id, count in counts:
+        grouped.setdefault(group_id, []).append((rating_id, count))
+    return [{
+        "name": names[group_id],
+        **_histogram(grouped[group_id], rating_names)
+    } for group_id in sorted(grouped, key=names.get)]
+
+
+@route('/api/progress')
+def progress():
+    """
+    Completion and rating histograms per component, column and row,
+    read from counters maintained by the DB
+
+    Query parameters:
+        rows: Number of most incomplete rows returned (default
+            PROGRESS_ROWS)
+        rater: Progress of this rater instead of the default rater
+    """
+
+    query = request.query.decode()
+    try:
+        n_rows = min(int(query.get('rows', PROGRESS_ROWS)), MAX_PROGRESS_ROWS)
+    except ValueError:
+        response.status = 400
+        return "Invalid number of rows"
+
+    rater = _rater()
+    rating_names = {
+        r.id if r else None: _rating(r)['name']
+        for r in queries.get_avilable_ratings()
+    }
+    counts = queries.get_rating_counts(rater)
+
+    total_rows, complete_rows, incomplete = queries.get_row_progress(
+        max(n_rows, 0), rater)
+    row_ids = [row_id for row_id, _, _, _ in incomplete]
+    row_counts = {}
+    for row_id, rating_id, count in queries.get_row_rating_counts(
+            row_ids, rater):
+        row_counts.setdefault(row_id, []).append((rating_id, count))
+
+    return _json({
+        **_histogram(((rating, count) for _, _, rating, count in counts),
+                     rating_names),
+        "components":
+        _group_progress(((component, rating, count)
+                         for component, _, rating, count in counts),
+                        queries.get_component_names(), rating_names),
+        "columns":
+        _group_progress(((column, rating, count)
+                         for _, column, rating, count in counts),
+                        queries.get_column_names(), rating_names),
+        "rows": {
+            "total": total_rows,
+            "complete": complete_rows,
+            "incomplete": [{
+                "name": row_name,
+                **_histogram(row_counts[row_id], rating_names)
+            } for row_id, row_name, _, _ in incomplete]
+        }
+    })
+
+
 @route('/api/ratings')
 def ratings():
     """
@@ -71,49 +316,93 @@ def ratings():
     return {"validRatings": valid_rating}
 
 
-@route('/api/spreadsheet')
-def spreadsheet():
+def _spreadsheet_entities(records, image_prefix, thumbnail_prefix):
     """
-    Query database for information required to construct
-    interactive table, yields for each TableRow it's
-    set of entities
+    Build the spreadsheet payload of each Entity record from
+    queries.get_entity_records
     """
-    entities = queries.get_denormalized_entities()
 
-    # Need to remove base path
-    payload = {
-        "entities": [{
+    default_rating = {'id': None, 'name': db_defaults.DEFAULT_RATING}
+    default_annotation = {'id': None, 'name': db_defaults.DEFAULT_ANNOTATION}
+
+    entities = []
+    for (entity_id, name, comment, version, row_name, column_name,
+         rating_id, rating_name, annotation_id, annotation_name,
+         images) in records:
+
+        images = _image_paths(images)
+        entities.append({
             "rowName":
-            e.rowname.name,
+            row_name,
             "columnName":
-            e.columnname.name,
-            "imagePaths":
-            [_fileserver(i.path, request.app.config) for i in e.images],
+            column_name,
+            "imagePaths": [image_prefix + i for i in images],
+            "thumbnailPaths":
+            [_thumbnail(i, image_prefix, thumbnail_prefix) for i in images],
             "comment":
-            e.comment,
+            comment,
             "rating":
-            _rating(e.rating),
+            default_rating if rating_id is None else {
+                'id': rating_id,
+                'name': rating_name
+            },
             "id":
-            e.id,
+            entity_id,
             "name":
-            e.name,
+            name,
+            "version":
+            version,
             "annotation":
-            _annotation(e.annotation)
-        } for e in entities]
-    }
-    return payload
+            default_annotation if annotation_id is None else {
+                'id': annotation_id,
+                'name': annotation_name
+            }
+        })
+    return entities
+
+
+@route('/api/spreadsheet')
+def spreadsheet():
+    """
+    Query database for information required to construct
+    interactive table, yields for each TableRow it's
+    set of entities
+    """
+
+    rater = _rater()
+    cache = _read_cache(rater)
+    if cache is not None:
+        response.content_type = 'application/json'
+        return cache.spreadsheet
+
+    entities = _spreadsheet_entities(queries.get_entity_records(rater),
+                                     _fileserver(request.app.config),
+                                     _thumbnailer(request.app.config))
+    return _json({"entities": entities})
 
 
 @route('/api/entity/<entity_id:int>')
 def get_entity_info(entity_id):
     try:
-        entity = queries.get_denormalized_entity_by_id(entity_id)
+        return _entity_info(entity_id, _rater())
     except ValueError as e:
         logger.error(f"Issue with obtaining Entity with id {entity_id}")
         logger.error(f"Error msg: {e}")
-        response.status_code = 400
+        response.status = 400
         return
 
+
+def _entity_info(entity_id, rater=None):
+    entity = queries.get_denormalized_entity_by_id(entity_id)
+    if rater is not None:
+        rater_rating = queries.get_rater_rating(entity_id, rater)
+        entity.rating = rater_rating and rater_rating.rating
+        entity.annotation = rater_rating and rater_rating.annotation
+        entity.comment = rater_rating.comment if rater_rating else ""
+        entity.version = rater_rating.version if rater_rating else 0
+
+    image_prefix = _fileserver(request.app.config)
+    thumbnail_prefix = _thumbnailer(request.app.config)
     payload = {
         "name":
         entity.name,
@@ -123,18 +412,116 @@ def get_entity_info(entity_id):
         entity.comment,
         "rating":
         _rating(entity.rating),
-        "imagePaths":
-        [_fileserver(i.path, request.app.config) for i in entity.images],
+        "imagePaths": [image_prefix + i.path for i in entity.images],
+        "thumbnailPaths": [
+            _thumbnail(i.path, image_prefix, thumbnail_prefix)
+            for i in entity.images
+        ],
         "id":
         entity.id,
         "rowName":
         entity.rowname.name,
         "columnName":
-        entity.columnname.name
+        entity.columnname.name,
+        "version":
+        entity.version
     }
     return payload
 
 
+def _entity_view(record, annotations, image_prefix, thumbnail_prefix):
+    """
+    Build the view payload of an Entity record from
+    queries.get_entity_views
+    """
+
+    (entity_id, name, comment, version, component_id, rating_id,
+     rating_name, annotation_id, annotation_name, images) = record
+    images = _image_paths(images)
+    return {
+        "entityId":
+        entity_id,
+        "entityName":
+        name,
+        "entityAnnotation":
+        _annotation(None) if annotation_id is None else {
+            'id': annotation_id,
+            'name': annotation_name
+        },
+        "entityComment":
+        comment,
+        "entityVersion":
+        version,
+        "entityAvailableAnnotations":
+        [_annotation(None)] +
+        [_annotation(a) for a in annotations[component_id]],
+        "entityImages": [image_prefix + i for i in images],
+        "entityThumbnails":
+        [_thumbnail(i, image_prefix, thumbnail_prefix) for i in images],
+        "entityRating":
+        _rating(None) if rating_id is None else {
+            'id': rating_id,
+            'name': rating_name
+        }
+    }
+
+
+def _entity_views(entity_ids, rater=None):
+    records = queries.get_entity_views(entity_ids, rater)
+    annotations = queries.get_component_annotations({r[4] for r in records})
+    image_prefix = _fileserver(request.app.config)
+    thumbnail_prefix = _thumbnailer(request.app.config)
+    return [
+        _entity_view(r, annotations, image_prefix, thumbnail_prefix)
+        for r in records
+    ]
+
+
+def build_read_cache(app_config):
+    """
+    Precompute the spreadsheet and Entity views of the default rater,
+    to be stored as `niviz_rater.read_cache` in `app_config` when
+    serving a read-only DB
+    """
+
+    image_prefix = _fileserver(app_config)
+    thumbnail_prefix = _thumbnailer(app_config)
+    records = list(queries.get_entity_records())
+    spreadsheet = _encode({
+        "entities":
+        _spreadsheet_entities(records, image_prefix, thumbnail_prefix)
+    })
+
+    # Spreadsheet order is by row name then column name
+    records.sort(key=lambda r: (r[4], r[5], r[0]))
+    order = [r[0] for r in records]
+    unrated = [i for i, r in enumerate(records) if r[6] is None]
+
+    records = list(queries.iter_entity_views())
+    annotations = queries.get_component_annotations(
+        {r[4]
+         for r in records})
+    views = {}
+    for record in records:
+        view = _entity_view(record, annotations, image_prefix,
+                            thumbnail_prefix)
+        views[record[0]] = (_encode(view), view["entityImages"])
+
+    return ReadCache(spreadsheet, views, order,
+                     {entity_id: i
+                      for i, entity_id in enumerate(order)}, unrated)
+
+
+def _read_cache(rater=None):
+    """
+    Return the ReadCache if responses for `rater` are precomputed
+    """
+
+    if rater is not None:
+        return None
+    return request.app.config.get('niviz_rater.read_cache')
+
+
 @route('/api/entity/<entity_id:int>/view')
 def get_entity_view(entity_id):
     """
@@ -146,102 +533,463 @@ def get_entity_view(entity_id):
         current annotation for a given entity
     """
 
-    entity = queries.get_denormalized_entity_by_id(entity_id)
-    available_annotations = [
-        _annotation(a) for a in queries.get_available_annotations(entity)
-    ]
+    rater = _rater()
+    cache = _read_cache(rater)
+    if cache is not None:
+        if entity_id not in cache.views:
+            response.status = 404
+            return {"error": f"Entity {entity_id} does not exist"}
+        response.content_type = 'application/json'
+        return cache.views[entity_id][0]
 
-    response = {
-        "entityId":
-        entity.id,
-        "entityName":
-        entity.name,
-        "entityAnnotation":
-        _annotation(entity.annotation),
-        "entityComment":
-        entity.comment,
-        "entityAvailableAnnotations":
-        available_annotations,
-        "entityImages":
-        [_fileserver(i.path, request.app.config) for i in entity.images],
-        "entityRating":
-        _rating(entity.rating)
+    views = _entity_views([entity_id], rater)
+    if not views:
+        response.status = 404
+        return {"error": f"Entity {entity_id} does not exist"}
+    _record(VIEW_EVENT, entity_id, rater)
+    return views[0]
+
+
+def _preload(images):
+    """
+    List `images` as preload Link headers of the response
+    """
+
+    links = [f"<{image}>; rel=preload; as=image" for image in images]
+    if links:
+        response.set_header('Link', ", ".join(links))
+
+
+@route('/api/entity/<entity_id:int>/next')
+def get_next_entity_views(entity_id):
+    """
+    Retrieve the views of the Entities following an Entity in
+    spreadsheet order, so the client can prefetch them. Their images
+    are listed as preload Link headers
+
+    Query parameters:
+        count: Number of views to return (default NEXT_VIEWS)
+        unrated: If 1, only return Entities that have not been rated
+        rater: Rater to return ratings of, defaults to the rater stored
+            on Entities
+
+    Yields:
+        array of entity views as in /api/entity/<entity_id>/view
+    """
+
+    query = request.query.decode()
+    try:
+        count = min(int(query.get('count', NEXT_VIEWS)), MAX_NEXT_VIEWS)
+    except ValueError as e:
+        logger.error(f"Invalid count: {e}")
+        response.status = 400
+        return {"error": "count must be an integer"}
+
+    rater = _rater()
+    unrated = query.get('unrated') == '1'
+    cache = _read_cache(rater)
+    if cache is not None:
+        entity_ids = cache.next_entity_ids(entity_id, max(count, 0), unrated)
+        if entity_ids is None:
+            response.status = 404
+            return {"error": f"Entity {entity_id} does not exist"}
+
+        cached = [cache.views[i] for i in entity_ids]
+        _preload([image for _, images in cached for image in images])
+        response.content_type = 'application/json'
+        return b'{"views":[' + b",".join(view for view, _ in cached) + b']}'
+
+    try:
+        entity_ids = queries.get_next_entity_ids(entity_id,
+                                                 max(count, 0),
+                                                 unrated=unrated,
+                                                 rater=rater)
+    except DoesNotExist:
+        response.status = 404
+        return {"error": f"Entity {entity_id} does not exist"}
+
+    views = _entity_views(entity_ids, rater)
+    _preload([image for view in views for image in view["entityImages"]])
+    return {"views": views}
+
+
+@route('/api/queue/next', method='POST')
+@_writes
+def queue_next():
+    """
+    Lease the next unrated Entity of a column or component to a rater
+
+    Query parameters:
+        holder: Identifier of the rater, releases its previous lease
+        rater: Lease Entities this rater has not rated, instead of
+            Entities the default rater has not rated
+        column: Name of the column to rate
+        component: Name of the component to rate, if no column is given
+        after: Only return Entities with an id greater than `after`
+        prefetch: Number of following Entity ids to return
+
+    Yields:
+        id of the leased Entity, null if no unrated Entities are left
+        expiry time of the lease in seconds since the epoch
+        ids of the following unrated Entities
+    """
+
+    query = request.query.decode()
+    holder = query.get('holder')
+    try:
+        if not holder:
+            raise ValueError("A holder is required")
+
+        after = int(query['after']) if query.get('after') else None
+        prefetch = min(int(query.get('prefetch', QUEUE_PREFETCH)),
+                       QUEUE_MAX_PREFETCH)
+
+        column = component = None
+        if query.get('column'):
+            column = queries.get_column(query['column'])
+        elif query.get('component'):
+            component = queries.get_component(query['component'])
+        else:
+            raise ValueError("Either a column or component is required")
+    except ValueError as e:
+        logger.error(f"Invalid queue request: {e}")
+        response.status = 400
+        return {"error": str(e)}
+    except DoesNotExist:
+        logger.error("Invalid queue request: unknown column or component")
+        response.status = 404
+        return {"error": "Unknown column or component"}
+
+    lease, next_ids = queries.lease_next_entity(holder,
+                                                column=column,
+                                                component=component,
+                                                after=after,
+                                                prefetch=max(prefetch, 0),
+                                                rater=_rater())
+    return {
+        "id": lease.entity_id if lease is not None else None,
+        "expires": lease.expires if lease is not None else None,
+        "next": next_ids
     }
-    return response
+
+
+@route('/api/thumbnail/<path:path>')
+def thumbnail(path):
+    """
+    Serve a thumbnail of the image at `path` relative to the base
+    directory, redirecting to the full image while it is generated or
+    if one cannot be made
+
+    Thumbnail URLs do not change when an image is regenerated, so
+    browsers revalidate cached thumbnails against an ETag derived from
+    the image's size and modification time
+    """
+
+    service = request.app.config.get('niviz_rater.thumbnails')
+    thumb = service.get(path) if service is not None else None
+    if thumb is None:
+        redirect(_fileserver(request.app.config) + path)
+
+    # Cache entries are named by a hash of their source's path, size
+    # and modification time
+    resp = static_file(thumb.name, root=str(thumb.parent), etag=thumb.stem)
+    resp.set_header('Cache-Control', 'no-cache')
+    return resp
 
 
 @route('/api/entity', method='POST')
+@_writes
 def update_entity():
     """
     Post body should contain information about:
+        -   id
+        -   version of the Entity the changes are based on
         -   annotation_id
         -   comment
         -   qc_rating
+        -   rater (optional), defaults to the rater stored on Entities
+
+    Responds with 409 Conflict and the current state of the Entity if
+    it was modified since `version`
     """
     expected_keys = {'annotation', 'comment', 'rating'}
     data = request.json
     if data is None:
-        logger.info("No changes requested...")
+        logger.debug("No changes requested...")
         return
-    logger.info("Received message from application!")
     update_keys = expected_keys.intersection(data.keys())
-    logger.info("Updating keys")
-    logger.info(update_keys)
+    logger.debug("Updating keys %s of Entity: %s", update_keys, data)
+
+    if 'id' not in data:
+        response.status = 400
+        return {"error": "Entity id is required"}
+
+    if data.get('version') is None:
+        logger.warning(
+            "No version given for Entity %s, overwriting any "
+            "concurrent changes", data['id'])
 
-    # Select entity
-    entity = queries.get_denormalized_entity_by_id(data['id'])
-    logger.info(data)
+    rater = _rater(data.get('rater') or '', create=True)
+    try:
+        version = queries.update_entity(data['id'],
+                                        {k: data[k]
+                                         for k in update_keys},
+                                        version=data.get('version'),
+                                        rater=rater)
+    except DoesNotExist:
+        response.status = 404
+        return {"error": f"Entity {data['id']} does not exist"}
+    except exceptions.VersionConflict as e:
+        logger.warning(str(e))
+        response.status = 409
+        return {
+            "error": str(e),
+            "entity": _entity_info(data['id'], rater)
+        }
+    except IntegrityError as e:
+        logger.error(f"Failed to update Entity {data['id']}: {e}")
+        response.status = 400
+        return {"error": "Invalid rating or annotation"}
+
+    _record(SAVE_EVENT, data['id'], rater)
+    return {"id": data['id'], "version": version}
+
+
+@route('/api/entity/<entity_id:int>/undo', method='POST')
+@_writes
+def undo_entity(entity_id):
+    """
+    Revert the last change to an Entity that has not been undone, so
+    repeated undos step back through its history, and respond with its
+    restored state. Post body may contain:
+        -   version of the Entity the undo is based on
+        -   rater (optional), defaults to the rater stored on Entities
+
+    Responds with 409 Conflict and the current state of the Entity if
+    it was modified since `version`
+    """
 
-    # Update entity with available keys
-    db = fetch_db_from_config(request.app.config)
+    data = request.json or {}
+    rater = _rater(data.get('rater') or '')
+    try:
+        version = queries.undo_change(entity_id,
+                                      version=data.get('version'),
+                                      rater=rater)
+    except DoesNotExist:
+        response.status = 404
+        return {"error": f"Entity {entity_id} does not exist"}
+    except exceptions.VersionConflict as e:
+        logger.warning(str(e))
+        response.status = 409
+        return {"error": str(e), "entity": _entity_info(entity_id, rater)}
+
+    if version is None:
+        response.status = 404
+        return {"error": f"Entity {entity_id} has no changes to undo"}
+    return _entity_info(entity_id, rater)
+
+
+@route("/api/history")
+def history():
+    """
+    Stream changes to ratings by all raters as JSON Lines, in order of
+    time, for auditing
+
+    Query parameters:
+        since: Only return changes made at or after this time, in
+            seconds since the epoch
+    """
+
+    query = request.query.decode()
+    try:
+        since = float(query['since']) if query.get('since') else None
+    except ValueError:
+        response.status = 400
+        return "Invalid since time"
 
-    # TODO: Pull this out into a query function
-    with db.atomic():
-        for k in update_keys:
-            setattr(entity, k, data[k])
-        try:
-            entity.save()
-        except:
-            response.status_code = 400
-    return
+    response.content_type = 'application/x-ndjson; charset=utf-8'
+    return export.iter_history(since)
 
 
 @route("/api/export")
 def export_csv():
     """
-    Export participants.tsv CSV file
+    Export participants.tsv CSV file, streamed in chunks of rows
+
+    Query parameters:
+        format: Export format, one of export.FORMATS (default tsv)
+        columns: Comma-separated list of columns to export
+        component: Only export columns of this component
+        rater: Export ratings of this rater instead of the default rater
     """
 
-    rows = queries.get_denormalized_rows()
-    columns = queries.get_columns()
+    query = request.query.decode()
+    columns = [
+        c for value in query.getall('columns') for c in value.split(',') if c
+    ] or None
+    component = query.get('component') or None
+    fmt = query.get('format') or 'tsv'
+    try:
+        stream = export.iter_export(fmt,
+                                    columns=columns,
+                                    component=component,
+                                    rater=query.get('rater') or None)
+    except ValueError as e:
+        logger.error(f"Invalid export request: {e}")
+        response.status = 400
+        return str(e)
 
-    rows = [_make_row(r, columns) for r in rows]
-    header = [
-        f"{c.name}\t{c.name}_passfail\t{c.name}_comment" for c in columns
-    ]
-    header = "\t".join(["subjects"] + header)
-    csv = "\n".join([header] + rows)
-    return csv
-
-
-def _make_row(row, columns):
-    """
-    Given a set of Entities for a given row, create
-    column entries
-    """
-    p = 0
-    entities = row.entities
-    entries = [row.name if row.name is not None else '']
-    empty = ("", "", "")
-    for c in columns:
-        try:
-            e = entities[p]
-            if e.columnname == c:
-                entries.extend(e.entry)
-                p += 1
-            else:
-                entries.extend(empty)
-        except IndexError:
-            entries.extend(empty)
-
-    return "\t".join(entries)
+    export_format = export.FORMATS[fmt]
+    response.content_type = export_format.content_type
+    response.set_header(
+        'Content-Disposition',
+        f'attachment; filename="{export_format.filename}"')
+    return stream
+
+
+@route("/api/agreement")
+def agreement_report():
+    """
+    Inter-rater agreement over all Entities and per component/column
+
+    Query parameters:
+        raters: Comma-separated list of raters to compare, defaults
+            to the default rater and all raters
+        limit: Maximum number of disagreements listed per component
+            or column (default agreement.DISAGREEMENTS)
+    """
+
+    if agreement.np is None:
+        response.status = 501
+        return "Agreement statistics require numpy"
+
+    query = request.query.decode()
+    raters = [
+        r for value in query.getall('raters') for r in value.split(',') if r
+    ] or None
+    try:
+        limit = max(0, int(query.get('limit', agreement.DISAGREEMENTS)))
+        report = agreement.agreement_report(raters, limit)
+    except ValueError as e:
+        logger.error(f"Invalid agreement request: {e}")
+        response.status = 400
+        return str(e)
+
+    return _json(report)
+
+
+@route("/api/throughput")
+def throughput_report():
+    """
+    Ratings per hour and median time spent per Entity, overall and per
+    rater, component and column, from the times Entity views were
+    opened and ratings saved
+
+    Query parameters:
+        since: Only include events at or after this time, in seconds
+            since the epoch
+    """
+
+    query = request.query.decode()
+    try:
+        since = float(query['since']) if query.get('since') else None
+    except ValueError:
+        response.status = 400
+        return "Invalid since time"
+
+    buffer = request.app.config.get('niviz_rater.telemetry')
+    if buffer is not None:
+        buffer.flush()
+    return _json(telemetry.throughput_report(since))
+
+
+@route("/metrics")
+def server_metrics():
+    """
+    Request latencies, response sizes, in-flight and error counts per
+    route and DB statement timings, in the Prometheus text format
+    """
+
+    registry = request.app.config.get('niviz_rater.metrics')
+    if registry is None:
+        response.status = 501
+        return "Metrics are not enabled"
+
+    response.content_type = metrics.CONTENT_TYPE
+    return registry.render()
+
+
+def _snapshot_status(snapshot: backup.BackgroundSnapshot) -> dict:
+    status = {"snapshot": snapshot.path.name, "status": snapshot.status}
+    if snapshot.result is not None:
+        status.update({
+            "size": snapshot.result.size,
+            "seconds": snapshot.result.seconds,
+            "restarts": snapshot.result.restarts,
+            "removed": [p.name for p in snapshot.result.removed]
+        })
+    if snapshot.error is not None:
+        status["error"] = snapshot.error
+    return status
+
+
+@route("/api/admin/backup", method='POST')
+@_writes
+def backup_db():
+    """
+    Start writing a snapshot of the DB to the backup directory given to
+    runserver on a background thread, removing the oldest snapshots
+    beyond the configured number to keep once it is written. Responds
+    202 with the name of the snapshot, whose progress is given by
+    /api/admin/backup/<snapshot>
+
+    Query parameters:
+        vacuum: Write a compacted snapshot with VACUUM INTO if "true"
+    """
+
+    config = request.app.config
+    directory = config.get('niviz_rater.backup.dir')
+    if directory is None:
+        response.status = 501
+        return "Backups are not enabled, use runserver --backup-dir"
+
+    vacuum = request.query.get('vacuum', '').lower() == 'true'
+    with _snapshots_lock:
+        if any(s.is_alive() for s in _snapshots.values()):
+            response.status = 409
+            return "A snapshot is already being written"
+
+        snapshot = backup.BackgroundSnapshot(
+            config['niviz_rater.db.file'],
+            directory,
+            keep=config.get('niviz_rater.backup.keep'),
+            vacuum=vacuum)
+        _snapshots[snapshot.path.name] = snapshot
+        snapshot.start()
+        for name in list(_snapshots)[:-SNAPSHOT_STATUSES - 1]:
+            del _snapshots[name]
+
+    logger.info(f"Writing snapshot {snapshot.path}")
+    response.status = 202
+    response.set_header('Location',
+                        f"/api/admin/backup/{snapshot.path.name}")
+    return _snapshot_status(snapshot)
+
+
+@route("/api/admin/backup/<name>")
+def backup_status(name):
+    """
+    Status of a snapshot started with POST /api/admin/backup, one of
+    "running", "done" or "failed". Only the statuses of the latest
+    SNAPSHOT_STATUSES finished snapshots are kept
+    """
+
+    if request.app.config.get('niviz_rater.backup.dir') is None:
+        response.status = 501
+        return "Backups are not enabled, use runserver --backup-dir"
+
+    snapshot = _snapshots.get(name)
+    if snapshot is None:
+        response.status = 404
+        return f"No snapshot {name} was started"
+    return _snapshot_status(snapshot)
@@ -1,30 +1,50 @@
 from __future__ import annotations
-from typing import Any, Dict, Callable, TYPE_CHECKING
+from typing import Any, Dict, Callable, List, Optional, TYPE_CHECKING
 
 from bottle import route, run, static_file, debug, default_app
+from peewee import DatabaseError
 
-import os
+import sys
 import argparse
 import logging
 import inspect
-from pathlib import Path
-
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import json
+import gzip
+import tempfile
+import time
+from socketserver import ThreadingMixIn
 from threading import Thread
-from functools import partial
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
 
-from niviz_rater.api import apiRoutes
+from niviz_rater.api import apiRoutes, build_read_cache
+from niviz_rater.cache import FileCache
+from niviz_rater.fileserver import launch_fileserver, precompress
+from niviz_rater.thumbnails import ThumbnailService
+from niviz_rater.telemetry import TelemetryBuffer
+from niviz_rater.metrics import MetricsMiddleware, Registry
+from niviz_rater.querylog import QueryLog, QueryLogMiddleware, QUERY_BUDGET
+from niviz_rater.loadtest import LoadTest, exceeded_budgets, format_report
+from niviz_rater.profiling import Profile, format_summary, stage
 import niviz_rater.db.utils as dbutils
+import niviz_rater.db.migrations as migrations
+import niviz_rater.db.merge as merge
+import niviz_rater.db.backup as backup
+import niviz_rater.export as export
+import niviz_rater.importer as importer
+import niviz_rater.agreement as agreement
 import niviz_rater.db.exceptions as exceptions
 from niviz_rater.utils import get_bids_layout, update_bids_configuration
 from niviz_rater.spec import SpecConfig, db_settings_from_config
 
 from niviz_rater.validation import validate_config
 
-from niviz_rater.db.models import database_proxy
+from niviz_rater.db.models import database_proxy, DB_TABLES
 
 if TYPE_CHECKING:
     from bids import BIDSLayout
+    from niviz_rater.spec import ComponentEntities
 
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.INFO)
@@ -35,6 +55,29 @@ FILE = Path(__file__).parent
 DEFAULT_BIDS_CONFIGURATION = FILE / "data/bids.json"
 CONFIGURABLE_DB_SETTINGS = ['Ratings']
 
+# Issues of import_ratings logged when not written to a file
+IMPORT_ISSUES_LOGGED = 10
+
+SNAPSHOT_HELP = ("Read a temporary copy of the DB instead of reading it in "
+                 "place. Only needed if the DB is not yet in write-ahead "
+                 "log mode, where raters could not save during the read")
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    WSGI server handling each request in its own thread
+    """
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    WSGI request handler that does not log each request
+    """
+
+    def log_message(self, format, *args):
+        pass
+
 
 def is_subcommand(func: Callable):
 
@@ -69,37 +112,35 @@ def user_path():
     return str(app.config['niviz_rater.base_path'])
 
 
-def launch_fileserver(base_directory, port=5002, hostname='localhost'):
+def precompress_images(cache: Optional[FileCache],
+                       component_entity: ComponentEntities) -> None:
     """
-    Launch background TCP server at `base_directory`
+    Store compressed copies of a component's images in `cache`
     """
-    path = os.path.abspath(base_directory)
-    handler = partial(SimpleHTTPRequestHandler, directory=path)
-    httpd = HTTPServer((hostname, port), handler)
-
-    address = f"http://{httpd.server_name}:{httpd.server_port}"
-
-    def serve(httpd):
-        with httpd:
-            logger.info(f"Creating server at {port}")
-            httpd.serve_forever()
-
-    thread = Thread(target=serve, args=(httpd, ))
-    thread.setDaemon(True)
-    thread.start()
+    if cache is None:
+        return
 
-    return httpd, address
+    logger.info(f"Pre-compressing images for "
+                f"{component_entity.component_name}")
+    with stage(f"compress/{component_entity.component_name}"):
+        n_compressed = precompress(cache,
+                                   (i for e in component_entity.entities
+                                    for i in e.images))
+    logger.info(f"Compressed {n_compressed} images, "
+                f"cache size is {cache.size} bytes")
 
 
 @is_subcommand
 def initialize_db(db_settings: Dict[str, Any], config: SpecConfig,
-                  bids_layout: BIDSLayout) -> None:
+                  bids_layout: BIDSLayout, base_directory: Path,
+                  compression_cache: Optional[FileCache]) -> None:
 
     db = dbutils.fetch_db_from_config(app.config)
 
     logging.info("Creating Database tables...")
     try:
-        dbutils.initialize_tables(db, db_settings)
+        with stage("db/tables"):
+            dbutils.initialize_tables(db, db_settings)
     except exceptions.IsInitialized:
         logger.error(f"DB { app.config['niviz_rater.db.file'] }"
                      " is already initialized!")
@@ -115,12 +156,18 @@ def initialize_db(db_settings: Dict[str, Any], config: SpecConfig,
         logger.info(
             f"Attempting to add {len(component_entity.entities)} records")
 
-        dbutils.component_entities_to_db(db, component_entity)
+        with stage(f"db/{component_entity.component_name}"):
+            dbutils.component_entities_to_db(db,
+                                             component_entity,
+                                             base_path=base_directory)
+        precompress_images(compression_cache, component_entity)
 
 
 @is_subcommand
 def update_db(db_file, config: SpecConfig, bids_layout: BIDSLayout,
-              update_existing: bool, no_reset_on_update: bool):
+              base_directory: Path, update_existing: bool,
+              no_reset_on_update: bool,
+              compression_cache: Optional[FileCache]):
 
     if not Path(db_file).exists():
         logger.error(f"Did not find existing db_file: {db_file}")
@@ -135,27 +182,482 @@ def update_db(db_file, config: SpecConfig, bids_layout: BIDSLayout,
             f"Remove DB {Path(db_file).absolute()} then use `initialize_db`!")
         return
 
+    if migrations.needs_migration(db):
+        logger.error("Database was created by an older version of "
+                     "niviz-rater")
+        logger.error("Use `migrate_db` subcommand to upgrade the DB!")
+        return
+
     logging.info("Updating database with new entities...")
     for component_entity in config.entities_by_component(bids_layout):
         logger.info(f"Working on {component_entity.component_name}\n")
         logger.info(
             f"Attempting to add {len(component_entity.entities)} records")
 
-        dbutils.component_entities_to_db(
-            db,
-            component_entity,
-            update_existing=update_existing,
-            reset_on_update=not no_reset_on_update)
+        with stage(f"db/{component_entity.component_name}"):
+            dbutils.component_entities_to_db(
+                db,
+                component_entity,
+                update_existing=update_existing,
+                reset_on_update=not no_reset_on_update,
+                base_path=base_directory)
+        precompress_images(compression_cache, component_entity)
+
+
+@is_subcommand
+def migrate_db(db_file, base_directory: Optional[Path]):
+
+    if not Path(db_file).exists():
+        logger.error(f"Did not find existing db_file: {db_file}")
+        return
+
+    db = dbutils.fetch_db_from_config(app.config)
+    if not dbutils.is_initialized(db):
+        logger.error("Database is not yet initialized, use `initialize_db`!")
+        return
+
+    if not migrations.needs_migration(db):
+        logger.info("Database is up-to-date!")
+        return
+
+    if base_directory is None and migrations.needs_base_path(db):
+        logger.error("Database stores absolute image paths, use "
+                     "-i/--base-directory to give the directory they are "
+                     "made relative to")
+        return
+
+    version = migrations.migrate(db, base_path=base_directory)
+    logger.info(f"Migrated database to schema version {version}")
+
+
+@is_subcommand
+def merge_db(db_file, sources: List[Path], policy: str,
+             raters: Optional[List[str]]):
+
+    if raters is not None and len(raters) != len(sources):
+        logger.error("A rater name is required for each source database")
+        return
+
+    db = _open_existing_db(db_file)
+    if db is None:
+        return
+
+    for i, source in enumerate(sources):
+        try:
+            result = merge.merge_db(db, source, policy,
+                                    raters[i] if raters else None)
+        except ValueError as e:
+            logger.error(f"Unable to merge {source}: {e}")
+            return
+
+        logger.info(f"Merged {source}: {result.matched} matching Entities "
+                    f"({result.unmatched} not found), {result.updated} "
+                    f"updated, {result.kept} kept, "
+                    f"{result.rater_ratings} rater ratings merged")
+
+
+@is_subcommand
+def backup_db(db_file, destination: Path, keep: Optional[int], vacuum: bool):
+
+    if not Path(db_file).exists():
+        logger.error(f"Did not find existing db_file: {db_file}")
+        return
+
+    db = dbutils.fetch_db_from_config(app.config)
+    try:
+        if destination.is_dir():
+            result = backup.snapshot_db(db,
+                                        destination,
+                                        Path(db_file).name,
+                                        keep=keep,
+                                        vacuum=vacuum)
+        elif keep is not None:
+            logger.error("--keep requires a directory of snapshots")
+            return
+        else:
+            result = backup.backup_db(db, destination, vacuum=vacuum)
+    except (OSError, DatabaseError) as e:
+        logger.error(f"Unable to back up {db_file}: {e}")
+        return
+
+    logger.info(f"Backed up {db_file} to {result.path} "
+                f"({result.size / 1024**2:.1f} MB in {result.seconds:.1f}s)")
+    for snapshot in result.removed:
+        logger.info(f"Removed old snapshot {snapshot}")
 
 
 @is_subcommand
-def runserver(base_directory: str, fileserver_port: int, port: int):
-    _, address = launch_fileserver(base_directory, port=fileserver_port)
+def restore_db(db_file, backup_file: Path):
+
+    db = dbutils.fetch_db_from_config(app.config)
+    try:
+        backup.restore_db(backup_file, db)
+    except ValueError as e:
+        logger.error(f"Unable to restore: {e}")
+        return
+
+    logger.info(f"Restored {db_file} from {backup_file}")
+    if migrations.needs_migration(db):
+        logger.info("Use `migrate_db` subcommand to upgrade the restored DB")
+
+
+def _open_existing_db(db_file):
+    """
+    Return the DB of `db_file` if it exists and is up-to-date,
+    otherwise log why it cannot be read and return None
+    """
+
+    if not Path(db_file).exists():
+        logger.error(f"Did not find existing db_file: {db_file}")
+        return None
+
+    db = dbutils.fetch_db_from_config(app.config)
+    if not dbutils.is_initialized(db):
+        logger.error("Database is not yet initialized, use `initialize_db`!")
+        return None
+
+    if migrations.needs_migration(db):
+        logger.error("Database was created by an older version of "
+                     "niviz-rater")
+        logger.error("Use `migrate_db` subcommand to upgrade the DB!")
+        return None
+
+    return db
+
+
+@contextmanager
+def _consistent_read(db, snapshot: bool = False):
+    """
+    Read `db` in a single read transaction, so every query sees the same
+    ratings. Databases opened for writing are in write-ahead log mode, where
+    raters keep saving while the transaction is open. `snapshot` instead
+    copies `db` to a temporary file and binds models to the copy, for
+    databases still in rollback journal mode where saves would wait
+    """
+
+    if not snapshot:
+        with db.atomic():
+            yield db
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with stage("db/snapshot"):
+            copy = dbutils.snapshot_db(db, Path(tmpdir) / "snapshot.db")
+        db.close()
+        try:
+            with copy.bind_ctx(DB_TABLES):
+                yield copy
+        finally:
+            copy.close()
+
+
+@is_subcommand
+def export_ratings(db_file, output: str, columns: Optional[List[str]],
+                   component: Optional[str], export_format: str,
+                   rater: Optional[str], snapshot: bool):
+
+    db = _open_existing_db(db_file)
+    if db is None:
+        return
+
+    with _consistent_read(db, snapshot):
+        _write_export(output, columns, component, export_format, rater)
+
+
+def _write_export(output: str, columns: Optional[List[str]],
+                  component: Optional[str], export_format: str,
+                  rater: Optional[str]):
+
+    try:
+        stream = export.iter_export(export_format,
+                                    columns=columns,
+                                    component=component,
+                                    rater=rater)
+    except ValueError as e:
+        logger.error(f"Unable to export ratings: {e}")
+        return
+
+    binary = export.FORMATS[export_format].binary
+    if output == "-":
+        out = sys.stdout.buffer if binary else sys.stdout
+        with stage("export"):
+            for chunk in stream:
+                out.write(chunk)
+            out.flush()
+        return
+
+    f = open(output, "wb") if binary else open(output, "w", newline="")
+    with f, stage("export"):
+        for chunk in stream:
+            f.write(chunk)
+    logger.info(f"Exported ratings to {output}")
+
+
+@contextmanager
+def _open_output(path: str):
+    """
+    Text file opened for writing, standard output if `path` is "-"
+    """
+
+    if path == "-":
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+
+    with open(path, "w", newline="") as f:
+        yield f
+
+
+@contextmanager
+def _open_input(path: str):
+    """
+    Text file opened for reading, gzip decompressed if `path` ends
+    with .gz and standard input if `path` is "-"
+    """
+
+    if path == "-":
+        yield sys.stdin
+        return
+
+    if path.endswith(".gz"):
+        f = gzip.open(path, "rt", encoding="utf-8", newline="")
+    else:
+        f = open(path, encoding="utf-8", newline="")
+    with f:
+        yield f
+
+
+def _diff_writer(f) -> importer.OnChange:
+    """
+    Write each changed cell of imported ratings to `f` as a TSV line
+    """
+
+    f.write("line\tsubjects\tcolumn\told\tnew\n")
+
+    def write(change: importer.Change):
+        for suffix, old, new in zip(importer.SUFFIXES, change.old,
+                                    change.new):
+            if old != new:
+                f.write(f"{change.line}\t{change.row}\t{change.column}"
+                        f"{suffix}\t{old}\t{new}\n")
+
+    return write
+
+
+@is_subcommand
+def import_ratings(db_file, input_file: str, rater: Optional[str],
+                   dry_run: bool, diff: Optional[str], errors: Optional[str]):
+
+    db = _open_existing_db(db_file)
+    if db is None:
+        return
+
+    if diff is None and dry_run:
+        diff = "-"
+
+    with ExitStack() as stack:
+        on_change = None
+        if diff is not None:
+            on_change = _diff_writer(stack.enter_context(_open_output(diff)))
+
+        try:
+            f = stack.enter_context(_open_input(input_file))
+            result = importer.import_tsv(f, rater, dry_run, on_change)
+        except (OSError, ValueError) as e:
+            logger.error(f"Unable to import ratings: {e}")
+            return
+
+    verb = "Would change" if dry_run else "Changed"
+    logger.info(f"Read {result.rows} rows: {verb} {result.changed} "
+                f"ratings, {result.unchanged} unchanged, "
+                f"{len(result.issues)} issues")
+
+    if errors is not None:
+        with _open_output(errors) as f:
+            f.write("line\tcolumn\tmessage\n")
+            for issue in result.issues:
+                f.write(f"{issue.line}\t{issue.column}\t{issue.message}\n")
+        return
+
+    for issue in result.issues[:IMPORT_ISSUES_LOGGED]:
+        logger.warning(f"Line {issue.line}, column {issue.column}: "
+                       f"{issue.message}")
+    if len(result.issues) > IMPORT_ISSUES_LOGGED:
+        logger.warning("Write all issues to a file with --errors")
+
+
+@is_subcommand
+def agreement_report(db_file, output: str, raters: Optional[List[str]],
+                     limit: int, snapshot: bool):
+
+    if agreement.np is None:
+        logger.error("Agreement statistics require numpy, install with "
+                     "`pip install niviz_rater[agreement]`")
+        return
+
+    db = _open_existing_db(db_file)
+    if db is None:
+        return
+
+    with _consistent_read(db, snapshot):
+        try:
+            report = agreement.agreement_report(raters, limit)
+        except ValueError as e:
+            logger.error(f"Unable to compute agreement: {e}")
+            return
+
+    if output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote agreement report to {output}")
+
+
+@is_subcommand
+def runserver(base_directory: str, fileserver_port: int, port: int,
+              compression_cache: Optional[FileCache],
+              thumbnail_cache: Optional[Path], thumbnail_cache_size: int,
+              thumbnail_size: int, thumbnail_workers: int,
+              backup_dir: Optional[Path], backup_keep: Optional[int],
+              db_file: Path, immutable: bool, telemetry: bool,
+              query_budget: int):
+    if immutable and dbutils.has_wal(db_file):
+        logger.error(f"{db_file} has changes in its write-ahead log, "
+                     "it may still be in use")
+        logger.error("Serve a copy written by the `backup` subcommand "
+                     "with --read-only instead")
+        return
+
+    db = dbutils.fetch_db_from_config(app.config)
+    if migrations.needs_migration(db):
+        logger.error("Database was created by an older version of "
+                     "niviz-rater")
+        logger.error("Use `migrate_db` subcommand to upgrade the DB!")
+        return
+
+    _, address = launch_fileserver(base_directory,
+                                   port=fileserver_port,
+                                   cache=compression_cache)
 
     app.config['niviz_rater.fileserver'] = address
+    if thumbnail_cache:
+        app.config['niviz_rater.thumbnails'] = ThumbnailService(
+            base_directory,
+            FileCache(thumbnail_cache, thumbnail_cache_size * 1024**2),
+            size=thumbnail_size,
+            max_workers=thumbnail_workers)
+    if backup_dir:
+        app.config['niviz_rater.backup.dir'] = backup_dir
+        app.config['niviz_rater.backup.keep'] = backup_keep
     app.merge(apiRoutes)
+
+    server_options = {}
+    if immutable:
+        # The DB cannot change, so responses are computed once and
+        # readers are served concurrently without locking
+        start = time.perf_counter()
+        app.config['niviz_rater.read_only'] = True
+        app.config['niviz_rater.read_cache'] = build_read_cache(app.config)
+        logger.info(f"Precomputed responses in "
+                    f"{time.perf_counter() - start:.2f}s")
+        server_options['server_class'] = ThreadingWSGIServer
+
+    buffer = None
+    if telemetry and not immutable:
+        buffer = TelemetryBuffer()
+        buffer.start()
+        app.config['niviz_rater.telemetry'] = buffer
+
+    registry = Registry()
+    app.config['niviz_rater.metrics'] = registry
+    dbutils.add_statement_hook(db, registry.observe_statement)
+    query_log = QueryLog(budget=query_budget or None)
+    dbutils.add_statement_hook(db, query_log.observe_statement)
+
     debug(True)
-    run(host='localhost', port=port)
+    try:
+        run(app=MetricsMiddleware(QueryLogMiddleware(app, query_log),
+                                  registry),
+            host='localhost',
+            port=port,
+            **server_options)
+    finally:
+        if buffer is not None:
+            buffer.stop()
+
+
+@is_subcommand
+def loadtest(db_file, base_directory: Optional[str], raters: int,
+             duration: float, think_time: float, p95_budget: Optional[float],
+             p99_budget: Optional[float], output: Optional[str]):
+
+    db = _open_existing_db(db_file)
+    if db is None:
+        return
+
+    budgets = {
+        p: budget
+        for p, budget in ((95, p95_budget), (99, p99_budget))
+        if budget is not None
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir, ExitStack() as stack:
+        # Saves of the simulated raters are made to a copy of the DB
+        copy = Path(tmpdir) / Path(db_file).name
+        backup.backup_db(db, copy)
+        db.close()
+        copy_db = dbutils.get_or_create_db(str(copy))
+        database_proxy.initialize(copy_db)
+        stack.callback(copy_db.close)
+        app.config['niviz_rater.db.file'] = str(copy)
+
+        app.config['niviz_rater.fileserver'] = ""
+        if base_directory:
+            fileserver, address = launch_fileserver(base_directory,
+                                                    port=0,
+                                                    log_requests=False)
+            stack.callback(fileserver.shutdown)
+            app.config['niviz_rater.fileserver'] = address
+        app.merge(apiRoutes)
+
+        buffer = TelemetryBuffer()
+        buffer.start()
+        stack.callback(buffer.stop)
+        app.config['niviz_rater.telemetry'] = buffer
+
+        # Served one request at a time as by runserver
+        server = make_server('localhost',
+                             0,
+                             app,
+                             handler_class=QuietRequestHandler)
+        stack.callback(server.server_close)
+        Thread(target=server.serve_forever, daemon=True).start()
+        stack.callback(server.shutdown)
+
+        logger.info(f"Running {raters} raters for {duration:g}s")
+        report = LoadTest(f"http://localhost:{server.server_port}",
+                          raters=raters,
+                          duration=duration,
+                          think_time=think_time,
+                          fetch_images=bool(base_directory)).run()
+
+    print(format_report(report))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Wrote load test report to {output}")
+
+    if not budgets:
+        return
+    failures = exceeded_budgets(report, budgets)
+    if report["errors"]:
+        failures.append(f"{report['errors']} requests failed")
+    for failure in failures:
+        logger.error(failure)
+    return 1 if failures else None
 
 
 def main():
@@ -165,14 +667,16 @@ def main():
     parser.add_argument("--base-directory",
                         "-i",
                         type=Path,
-                        required=True,
-                        help="Base directory of BIDS-organized QC directory")
+                        help="Base directory of BIDS-organized QC directory. "
+                        "Required by `initialize_db`, `update_db` and "
+                        "`runserver`, and by `migrate_db` when migrating a "
+                        "database that stores absolute image paths")
     parser.add_argument("--qc-specification-file",
                         "-c",
                         type=Path,
-                        required=True,
                         help="Path to QC rating specification file to use"
-                        " when rating images")
+                        " when rating images. Required by `initialize_db`, "
+                        "`update_db` and `runserver`")
     parser.add_argument("--bids-settings",
                         type=Path,
                         default=DEFAULT_BIDS_CONFIGURATION,
@@ -183,7 +687,28 @@ def main():
                         required=False,
                         default="niviz.db",
                         help="Path to store SQLite DB containing state")
+    parser.add_argument("--compress-cache",
+                        type=Path,
+                        required=False,
+                        help="Directory to store gzip/brotli compressed "
+                        "copies of SVG images in. Images are compressed when "
+                        "added to the DB and on first request. "
+                        "Disabled if not provided")
+    parser.add_argument("--compress-cache-size",
+                        type=int,
+                        default=1024,
+                        help="Maximum size of the compressed image cache "
+                        "in MB, least recently used images are evicted "
+                        "beyond this size")
+
+    parser.add_argument("--profile",
+                        type=Path,
+                        help="Profile the subcommand, writing call "
+                        "statistics to PROFILE.pstats and a JSON summary "
+                        "of stage timings, peak memory and top allocation "
+                        "sites to PROFILE.json")
 
+    parser.set_defaults(requires_spec=True, read_only=False, immutable=False)
     subparsers = parser.add_subparsers(help='sub-command help')
 
     create_db_parser = subparsers.add_parser('initialize_db',
@@ -206,6 +731,137 @@ def main():
                                   action="store_true")
     update_db_parser.set_defaults(func=update_db)
 
+    migrate_db_parser = subparsers.add_parser(
+        'migrate_db',
+        help='Upgrade database created by an older version of niviz-rater')
+    migrate_db_parser.set_defaults(func=migrate_db, requires_spec=False)
+
+    merge_db_parser = subparsers.add_parser(
+        'merge_db', help='Merge ratings of other databases into the DB')
+    merge_db_parser.add_argument("sources",
+                                 nargs="+",
+                                 type=Path,
+                                 help="Databases to merge ratings from")
+    merge_db_parser.add_argument(
+        "--policy",
+        choices=merge.POLICIES,
+        default="newest",
+        help="How to merge Entities rated in both databases: take the "
+        "most recent rating (newest), only fill in unrated Entities "
+        "(prefer-rated) or keep the source's ratings as a separate rater "
+        "(keep-both) (default: newest)")
+    merge_db_parser.add_argument(
+        "--raters",
+        nargs="+",
+        help="With keep-both, names of the raters given the ratings of "
+        "each source, defaults to the source file names")
+    merge_db_parser.set_defaults(func=merge_db, requires_spec=False)
+
+    backup_parser = subparsers.add_parser(
+        'backup', help='Back up the DB while raters are using it')
+    backup_parser.add_argument("destination",
+                               type=Path,
+                               help="File to write the backup to, or a "
+                               "directory to write a timestamped snapshot to")
+    backup_parser.add_argument("--keep",
+                               type=int,
+                               help="Only keep this many of the newest "
+                               "snapshots in the destination directory")
+    backup_parser.add_argument("--vacuum",
+                               default=False,
+                               action="store_true",
+                               help="Write a compacted copy with VACUUM "
+                               "INTO instead of copying pages incrementally")
+    backup_parser.set_defaults(func=backup_db, requires_spec=False)
+
+    restore_parser = subparsers.add_parser(
+        'restore',
+        help='Replace the DB with a backup, stop runserver before '
+        'restoring')
+    restore_parser.add_argument("backup_file",
+                                metavar="backup",
+                                type=Path,
+                                help="Backup or snapshot to restore")
+    restore_parser.set_defaults(func=restore_db, requires_spec=False)
+
+    export_parser = subparsers.add_parser(
+        'export', help='Export ratings to a participants.tsv spreadsheet')
+    export_parser.add_argument("--output",
+                               "-o",
+                               default="-",
+                               help="File to write spreadsheet to, "
+                               "writes to stdout by default")
+    export_parser.add_argument("--columns",
+                               nargs="+",
+                               help="Only export these columns")
+    export_parser.add_argument("--component",
+                               help="Only export columns of this component")
+    export_parser.add_argument("--format",
+                               dest="export_format",
+                               choices=list(export.FORMATS),
+                               default="tsv",
+                               help="Export format, parquet and arrow "
+                               "require pyarrow (default: tsv)")
+    export_parser.add_argument("--rater",
+                               help="Export ratings of this rater instead "
+                               "of the default rater")
+    export_parser.add_argument("--snapshot",
+                               default=False,
+                               action="store_true",
+                               help=SNAPSHOT_HELP)
+    export_parser.set_defaults(func=export_ratings,
+                               requires_spec=False,
+                               read_only=True)
+
+    import_parser = subparsers.add_parser(
+        'import_ratings',
+        help='Import ratings from a participants.tsv spreadsheet')
+    import_parser.add_argument("input_file",
+                               metavar="input",
+                               help="Spreadsheet in the layout written by "
+                               "`export`, may be gzip compressed. Use - to "
+                               "read from stdin")
+    import_parser.add_argument("--rater",
+                               help="Import ratings of this rater instead "
+                               "of the default rater")
+    import_parser.add_argument("--dry-run",
+                               default=False,
+                               action="store_true",
+                               help="Report changes without saving them")
+    import_parser.add_argument("--diff",
+                               help="File to write changed cells to, "
+                               "written to stdout by default with "
+                               "--dry-run")
+    import_parser.add_argument("--errors",
+                               help="File to write lines and cells that "
+                               "could not be imported to")
+    import_parser.set_defaults(func=import_ratings, requires_spec=False)
+
+    agreement_parser = subparsers.add_parser(
+        'agreement', help='Report inter-rater agreement of ratings')
+    agreement_parser.add_argument("--output",
+                                  "-o",
+                                  default="-",
+                                  help="File to write JSON report to, "
+                                  "writes to stdout by default")
+    agreement_parser.add_argument("--raters",
+                                  nargs="+",
+                                  help="Raters to compare, use `default` "
+                                  "for the default rater. Compares the "
+                                  "default rater and all raters by default")
+    agreement_parser.add_argument("--limit",
+                                  type=int,
+                                  default=agreement.DISAGREEMENTS,
+                                  help="Maximum number of disagreements "
+                                  "listed per component and column")
+    agreement_parser.add_argument("--snapshot",
+                                  default=False,
+                                  action="store_true",
+                                  help=SNAPSHOT_HELP)
+    agreement_parser.set_defaults(func=agreement_report,
+                                  requires_spec=False,
+                                  read_only=True)
+
     runserver_parser = subparsers.add_parser('runserver',
                                              help='Run bottle web interface')
     runserver_parser.add_argument("--port",
@@ -217,30 +873,151 @@ def main():
         type=int,
         help="Port to use for serving local image files",
         default=5001)
+    runserver_parser.add_argument(
+        "--thumbnail-cache",
+        type=Path,
+        help="Directory to store thumbnails of PNG/JPEG images in. "
+        "Thumbnails are generated on first request. "
+        "Disabled if not provided")
+    runserver_parser.add_argument(
+        "--thumbnail-cache-size",
+        type=int,
+        default=256,
+        help="Maximum size of the thumbnail cache in MB, least "
+        "recently used thumbnails are evicted beyond this size")
+    runserver_parser.add_argument(
+        "--thumbnail-size",
+        type=int,
+        default=256,
+        help="Maximum width/height of thumbnails in pixels")
+    runserver_parser.add_argument(
+        "--thumbnail-workers",
+        type=int,
+        default=2,
+        help="Number of threads used to generate thumbnails")
+    runserver_parser.add_argument(
+        "--backup-dir",
+        type=Path,
+        help="Directory to write snapshots of the DB to when requested "
+        "with POST /api/admin/backup. Disabled if not provided")
+    runserver_parser.add_argument(
+        "--backup-keep",
+        type=int,
+        help="Only keep this many of the newest snapshots in "
+        "--backup-dir, all snapshots are kept by default")
+    runserver_parser.add_argument(
+        "--read-only",
+        dest="immutable",
+        action="store_true",
+        help="Serve a DB that will not change, such as a finished study, "
+        "to reviewers who only browse it. The DB is opened immutable and "
+        "memory-mapped, write endpoints are rejected and responses are "
+        "precomputed. The DB must not be modified while it is served")
+    runserver_parser.add_argument(
+        "--no-telemetry",
+        dest="telemetry",
+        action="store_false",
+        help="Do not record when raters open and save images, used to "
+        "report rater throughput at /api/throughput")
+    runserver_parser.add_argument(
+        "--query-budget",
+        type=int,
+        default=QUERY_BUDGET,
+        help="Log a warning with the slowest statements of requests that "
+        "execute more DB statements than this, 0 to disable. Requests "
+        "repeating a statement many times are always logged")
     runserver_parser.set_defaults(func=runserver)
 
+    loadtest_parser = subparsers.add_parser(
+        'loadtest',
+        help='Measure the latency of the web interface under simulated '
+        'raters')
+    loadtest_parser.add_argument("--raters",
+                                 type=int,
+                                 default=20,
+                                 help="Number of concurrent raters")
+    loadtest_parser.add_argument("--duration",
+                                 type=float,
+                                 default=30.0,
+                                 help="Seconds to run for")
+    loadtest_parser.add_argument("--think-time",
+                                 type=float,
+                                 default=0.0,
+                                 help="Mean seconds each rater waits "
+                                 "between requests, 0 to send requests as "
+                                 "fast as they are answered")
+    loadtest_parser.add_argument("--p95-budget",
+                                 type=float,
+                                 help="Fail if the 95th percentile latency "
+                                 "of any route exceeds this many "
+                                 "milliseconds, or any request fails")
+    loadtest_parser.add_argument("--p99-budget",
+                                 type=float,
+                                 help="Fail if the 99th percentile latency "
+                                 "of any route exceeds this many "
+                                 "milliseconds, or any request fails")
+    loadtest_parser.add_argument("--output",
+                                 "-o",
+                                 help="File to write the JSON report to")
+    loadtest_parser.set_defaults(func=loadtest, requires_spec=False)
+
     args = parser.parse_args()
-    bids_configs = update_bids_configuration(args.bids_settings)
+    if args.profile is None:
+        return _run(parser, args)
+
+    with Profile() as profile:
+        result = _run(parser, args)
+    summary = profile.write(args.profile)
+    print(format_summary(summary), file=sys.stderr)
+    logger.info(f"Wrote profile to {args.profile}.pstats and "
+                f"{args.profile}.json")
+    return result
+
+
+def _run(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    """
+    Prepare the specification, configuration and DB required by the
+    subcommand of `args` then run it
+    """
+
+    if args.requires_spec:
+        if args.base_directory is None or args.qc_specification_file is None:
+            parser.error("the following arguments are required: "
+                         "-i/--base-directory, -c/--qc-specification-file")
+
+        bids_configs = update_bids_configuration(args.bids_settings)
 
-    # Config parsing
-    qc_spec = validate_config(args.qc_specification_file, bids_configs)
-    db_settings = db_settings_from_config(qc_spec, CONFIGURABLE_DB_SETTINGS)
-    config = SpecConfig.from_validated(qc_spec)
+        # Config parsing
+        with stage("spec/validate"):
+            qc_spec = validate_config(args.qc_specification_file,
+                                      bids_configs)
+        args.db_settings = db_settings_from_config(qc_spec,
+                                                   CONFIGURABLE_DB_SETTINGS)
+        args.config = SpecConfig.from_validated(qc_spec)
+        with stage("layout"):
+            args.bids_layout = get_bids_layout(args.base_directory)
 
-    bids_layout = get_bids_layout(args.base_directory)
+    compression_cache = None
+    if args.compress_cache:
+        compression_cache = FileCache(args.compress_cache,
+                                      args.compress_cache_size * 1024**2)
 
     # Setup application configuration and DB
     app.config['niviz_rater.base_path'] = args.base_directory
     app.config['niviz_rater.db.file'] = args.db_file
 
-    database_proxy.initialize(dbutils.fetch_db_from_config(app.config))
+    if args.immutable:
+        db = dbutils.get_immutable_db(args.db_file)
+    elif args.read_only:
+        db = dbutils.get_read_only_db(args.db_file)
+    else:
+        db = dbutils.fetch_db_from_config(app.config)
+    database_proxy.initialize(db)
     app.config['niviz_rater.db.instance'] = database_proxy
 
-    args.config = config
-    args.bids_layout = bids_layout
-    args.db_settings = db_settings
-    args.func(args)
+    args.compression_cache = compression_cache
+    return args.func(args)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Size-bounded on-disk cache for files derived from QC images
+"""
+
+from __future__ import annotations
+from typing import BinaryIO, Iterator, Optional, Union
+from contextlib import contextmanager
+from pathlib import Path
+import hashlib
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+PathLike = Union[str, Path]
+TMP_SUFFIX = ".tmp"
+
+
+class FileCache:
+    """
+    Content-addressed store of variants (compressed copies, thumbnails)
+    of source image files
+
+    Entries are addressed by a hash of the source file's real path, size
+    and modification time so that modifying a source image invalidates
+    all of its cached variants. Stale entries are never hit again and are
+    eventually removed by eviction.
+
+    Once the total size of the cache exceeds `max_size` bytes the least
+    recently used entries are evicted
+    """
+
+    def __init__(self, directory: PathLike, max_size: int):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._size = sum(p.stat().st_size for p in self._entries())
+
+    def __repr__(self):
+        return (f"<FileCache: {self.directory},"
+                f" size: {self._size}/{self.max_size}>")
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _entries(self) -> Iterator[Path]:
+        return (p for p in self.directory.iterdir()
+                if p.is_file() and p.suffix != TMP_SUFFIX)
+
+    def path_for(self, source: PathLike, variant: str) -> Path:
+        """
+        Return the cache location of `variant` of `source`
+
+        Raises:
+            FileNotFoundError: If `source` does not exist
+        """
+        stat = os.stat(source)
+        key = f"{os.path.realpath(source)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return self.directory / f"{digest}.{variant}"
+
+    def get(self, source: PathLike, variant: str) -> Optional[Path]:
+        """
+        Return path to cached `variant` of `source` if it exists
+        and is up-to-date, marking it as recently used
+        """
+        try:
+            entry = self.path_for(source, variant)
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return entry
+
+    @contextmanager
+    def writer(self, source: PathLike, variant: str) -> Iterator[BinaryIO]:
+        """
+        Open a file to stream `variant` of `source` into, stored once
+        the block exits without error then evicting least recently used
+        entries if the cache is over budget
+        """
+
+        entry = self.path_for(source, variant)
+        tmp = entry.with_suffix(f"{entry.suffix}.{threading.get_ident()}"
+                                f"{TMP_SUFFIX}")
+        try:
+            with open(tmp, "wb") as f:
+                yield f
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        size = tmp.stat().st_size
+
+        with self._lock:
+            try:
+                self._size -= entry.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, entry)
+            self._size += size
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def put(self, source: PathLike, variant: str, data: bytes) -> Path:
+        """
+        Store `data` as `variant` of `source` then evict least
+        recently used entries if the cache is over budget
+        """
+
+        with self.writer(source, variant) as f:
+            f.write(data)
+        return self.path_for(source, variant)
+
+    def evict(self) -> int:
+        """
+        Remove least recently used entries until the cache fits
+        within its size budget
+
+        Returns:
+            n_removed (int): Number of entries removed
+        """
+
+        n_removed = 0
+        with self._lock:
+            if self._size <= self.max_size:
+                return n_removed
+
+            entries = []
+            for p in self._entries():
+                try:
+                    entries.append((p.stat(), p))
+                except FileNotFoundError:
+                    continue
+
+            for stat, p in sorted(entries, key=lambda x: x[0].st_mtime_ns):
+                if self._size <= self.max_size:
+                    break
+                try:
+                    p.unlink()
+                except FileNotFoundError:
+                    continue
+                self._size -= stat.st_size
+                n_removed += 1
+
+        logger.debug("Evicted %d entries from %s", n_removed, self)
+        return n_removed
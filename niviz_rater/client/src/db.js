@@ -2,6 +2,17 @@
  * Utilities to interact with the back-end DB serving entities
  */
 
+// Rater given by the page's ?rater= parameter, the default rater if null
+const RATER = new URLSearchParams(window.location.search).get('rater');
+
+function withRater(endpoint){
+	// Add the rater to an API endpoint's query parameters
+	if (RATER === null){
+		return endpoint;
+	}
+	const sep = endpoint.includes('?') ? '&' : '?';
+	return `${endpoint}${sep}rater=${encodeURIComponent(RATER)}`;
+}
 
 async function postDB(endpoint, content){
 	// Generic post function for pushing JSON data to the DB
@@ -19,7 +30,7 @@ async function postDB(endpoint, content){
 }
 
 export async function fetchEntities(){
-	const response = await fetch('./api/spreadsheet')
+	const response = await fetch(withRater('./api/spreadsheet'))
 	let entities = await response.json();
 
 	// Return sorted entities
@@ -39,8 +50,12 @@ export async function fetchRatings(){
 
 export const updateRating = async function(rating){
 
-	const statusCode = await postDB('./api/entity', rating);
-	if (statusCode != 200){
+	viewCache.delete(rating.id);
+	const statusCode = await postDB('./api/entity', { ...rating, rater: RATER });
+	if (statusCode == 409){
+		alert("This scan was updated by another rater, "
+			+ "your changes were not saved!");
+	} else if (statusCode != 200){
 		alert("Failed to POST to DB!");
 	}
 	const entities = await fetchEntities();
@@ -48,23 +63,48 @@ export const updateRating = async function(rating){
 }
 
 export const getOverview = async function(){
-	const response = await fetch("./api/overview");
+	const response = await fetch(withRater("./api/overview"));
 	return await response.json();
 }
 
 export async function exportCsv(){
-	const response = await fetch('./api/export');
+	const response = await fetch(withRater('./api/export'));
 	return await response.text()
 };
 
-export async function getEntityView(id){
+// Entity views prefetched from /api/entity/<id>/next keyed by entity id
+const viewCache = new Map();
+const PREFETCH_COUNT = 5;
+
+export async function prefetchEntityViews(id, unrated=false){
+	/* Fetch views of the entities following id and warm the image cache */
+	const response = await fetch(withRater(
+		`./api/entity/${id}/next?count=${PREFETCH_COUNT}&unrated=${unrated ? 1 : 0}`
+	));
+	const next = await response.json();
+	next.views.forEach(view => {
+		viewCache.set(view.entityId, view);
+		view.entityImages.forEach(src => {
+			const img = new Image();
+			img.src = src;
+		});
+	});
+}
+
+export async function getEntityView(id, skipRated=false){
 	/* Fetch view for entity */
-	let response = await fetch(`./api/entity/${id}/view`)
-	let entity_view = await response.json();
+	let entity_view = viewCache.get(id);
+	if (entity_view === undefined){
+		let response = await fetch(withRater(`./api/entity/${id}/view`))
+		entity_view = await response.json();
+	}
+	viewCache.delete(id);
+	prefetchEntityViews(id, skipRated);
   return {
     rating: entity_view.entityRating,
     comment: entity_view.entityComment,
     id: entity_view.entityId,
+    version: entity_view.entityVersion,
     annotation: entity_view.entityAnnotation,
     availableAnnotations: entity_view.entityAvailableAnnotations,
     images: entity_view.entityImages,
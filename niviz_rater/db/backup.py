@@ -0,0 +1,305 @@
+"""
+Online backups, compacted snapshots and restores of a database that
+raters may be using
+"""
+
+from __future__ import annotations
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from datetime import datetime
+from pathlib import Path
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from peewee import DatabaseError, SqliteDatabase
+
+import niviz_rater.db.utils as dbutils
+
+logger = logging.getLogger(__name__)
+
+# Pages copied per backup step, the source is only locked during a step
+BACKUP_PAGES = 1024
+
+# Seconds to wait before retrying a step when the source is locked
+BACKUP_SLEEP = 0.01
+
+# Incremental backups restart whenever another connection writes to
+# the source, after this many restarts the rest is copied in one step
+MAX_RESTARTS = 10
+
+SNAPSHOT_TIME_FORMAT = "%Y%m%d-%H%M%S-%f"
+SNAPSHOT_PATTERN = re.compile(r"-\d{8}-\d{6}-\d{6}\.db$")
+
+Progress = Callable[[int, int], None]
+
+
+class BackupResult(NamedTuple):
+    """
+    Attributes:
+        path: Backup file written
+        size: Size of the backup in bytes
+        seconds: Time taken to write the backup
+        restarts: Times an incremental backup was restarted by writes
+        removed: Snapshots removed by rotation
+    """
+    path: Path
+    size: int
+    seconds: float
+    restarts: int = 0
+    removed: Tuple[Path, ...] = ()
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _temporary(destination: Path) -> Path:
+    """
+    File the backup is written to before it is moved to `destination`,
+    so an incomplete backup never replaces an existing one
+    """
+
+    temporary = destination.with_name(f".{destination.name}.tmp")
+    temporary.unlink(missing_ok=True)
+    return temporary
+
+
+def _copy(db: SqliteDatabase,
+          destination: Path,
+          pages: int,
+          progress: Optional[Progress] = None) -> int:
+    """
+    Copy `db` to `destination` with the backup API in steps of `pages`
+    pages, releasing the source's lock between steps so writers are
+    not blocked
+
+    Returns:
+        restarts: Number of times the backup was restarted
+    """
+
+    restarts = 0
+    last_remaining = None
+
+    def step(status, remaining, total):
+        nonlocal restarts, last_remaining
+        # Steps that could not lock the source are retried
+        if status in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED):
+            return
+
+        # Pages remaining only decrease unless the backup restarted
+        if last_remaining is not None and remaining >= last_remaining:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+        if progress is not None:
+            progress(total - remaining, total)
+
+    target = SqliteDatabase(str(destination))
+    with target.connection_context():
+        try:
+            db.connection().backup(target.connection(),
+                                   pages=pages,
+                                   progress=step,
+                                   sleep=BACKUP_SLEEP)
+        except _TooManyRestarts:
+            logger.warning(f"Backup restarted {restarts} times by "
+                           "concurrent writes, copying the rest in a "
+                           "single step")
+            db.connection().backup(target.connection())
+
+    return restarts
+
+
+def backup_db(db: SqliteDatabase,
+              destination: Path,
+              vacuum: bool = False,
+              pages: int = BACKUP_PAGES,
+              progress: Optional[Progress] = None) -> BackupResult:
+    """
+    Write a consistent copy of `db` to `destination` while it is in use
+
+    Arguments:
+        db: Database to back up
+        destination: File to write, replaced once the backup is complete
+        vacuum: Write a compacted copy with VACUUM INTO instead of
+            copying pages. This reads the whole database in a single
+            transaction, which only blocks writers in rollback journal
+            mode
+        pages: Pages copied per step of the backup API, -1 copies the
+            whole database in a single step
+        progress: Called with the number of pages copied and the total
+            number of pages after each step
+    """
+
+    start = time.perf_counter()
+    destination = Path(destination)
+    temporary = _temporary(destination)
+    restarts = 0
+    try:
+        if vacuum:
+            db.execute_sql("VACUUM INTO ?", (str(temporary), ))
+        else:
+            restarts = _copy(db, temporary, pages, progress)
+        os.replace(temporary, destination)
+    finally:
+        temporary.unlink(missing_ok=True)
+
+    return BackupResult(destination,
+                        destination.stat().st_size,
+                        time.perf_counter() - start,
+                        restarts=restarts)
+
+
+def list_snapshots(directory: Path, name: str) -> List[Path]:
+    """
+    Snapshots of the database `name` written by snapshot_db to
+    `directory`, oldest first
+    """
+
+    prefix = Path(name).stem
+    return sorted(p for p in Path(directory).glob(f"{prefix}-*.db")
+                  if SNAPSHOT_PATTERN.fullmatch(p.name[len(prefix):]))
+
+
+def rotate_snapshots(directory: Path, name: str, keep: int) -> List[Path]:
+    """
+    Remove all but the `keep` newest snapshots of database `name`
+
+    Returns:
+        removed: Removed snapshots
+    """
+
+    snapshots = list_snapshots(directory, name)
+    removed = snapshots[:max(0, len(snapshots) - keep)]
+    for snapshot in removed:
+        snapshot.unlink()
+        logger.info(f"Removed snapshot {snapshot}")
+    return removed
+
+
+def snapshot_path(directory: Path, name: str) -> Path:
+    """
+    Path of a new timestamped snapshot of database `name` in `directory`
+    """
+
+    timestamp = datetime.now().strftime(SNAPSHOT_TIME_FORMAT)
+    return Path(directory) / f"{Path(name).stem}-{timestamp}.db"
+
+
+def snapshot_db(db: SqliteDatabase,
+                directory: Path,
+                name: str,
+                keep: Optional[int] = None,
+                vacuum: bool = False,
+                path: Optional[Path] = None) -> BackupResult:
+    """
+    Back up `db` to a new timestamped snapshot in `directory`
+
+    Arguments:
+        name: File name of the database, snapshots are named after it
+        keep: Only keep this many of the newest snapshots, all
+            snapshots are kept if None
+        vacuum: Write a compacted snapshot with VACUUM INTO
+        path: Snapshot to write, as given by snapshot_path, a new one
+            is named if None
+    """
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    result = backup_db(db,
+                       path or snapshot_path(directory, name),
+                       vacuum=vacuum)
+
+    if keep is not None:
+        result = result._replace(
+            removed=tuple(rotate_snapshots(directory, name, keep)))
+    return result
+
+
+class BackgroundSnapshot(threading.Thread):
+    """
+    Snapshot of a database file written by a background thread with its
+    own connection, so requests are served while it is written
+
+    Attributes:
+        path: Snapshot being written
+        result: Result of the snapshot once written
+        error: Why the snapshot could not be written, if it failed
+    """
+
+    def __init__(self,
+                 db_file: str,
+                 directory: Path,
+                 keep: Optional[int] = None,
+                 vacuum: bool = False):
+        super().__init__(name="snapshot", daemon=True)
+        self.db_file = db_file
+        self.directory = Path(directory)
+        self.keep = keep
+        self.vacuum = vacuum
+        self.path = snapshot_path(directory, Path(db_file).name)
+        self.result: Optional[BackupResult] = None
+        self.error: Optional[str] = None
+
+    @property
+    def status(self) -> str:
+        if self.result is not None:
+            return "done"
+        if self.error is not None:
+            return "failed"
+        return "running"
+
+    def run(self):
+        db = dbutils.get_or_create_db(str(self.db_file))
+        try:
+            with db.connection_context():
+                self.result = snapshot_db(db,
+                                          self.directory,
+                                          Path(self.db_file).name,
+                                          keep=self.keep,
+                                          vacuum=self.vacuum,
+                                          path=self.path)
+        except (OSError, DatabaseError) as e:
+            self.error = str(e)
+            logger.error(f"Unable to write snapshot {self.path}: {e}")
+            return
+        except Exception as e:
+            # Record any other failure too, else the snapshot would be
+            # reported as running forever
+            self.error = f"{type(e).__name__}: {e}"
+            logger.exception(f"Unable to write snapshot {self.path}")
+            return
+
+        logger.info(f"Wrote snapshot {self.path} in "
+                    f"{self.result.seconds:.2f}s")
+
+
+def restore_db(backup_file: Path, db: SqliteDatabase) -> None:
+    """
+    Replace the contents of `db` with the backup `backup_file`, which
+    is checked for corruption first. Raters should not be using `db`
+
+    Raises:
+        ValueError: If `backup_file` does not exist, is corrupt or is
+            not a niviz-rater database
+    """
+
+    if not Path(backup_file).is_file():
+        raise ValueError(f"Did not find backup {backup_file}")
+
+    source = dbutils.get_read_only_db(backup_file)
+    with source.connection_context():
+        try:
+            check = source.execute_sql("PRAGMA quick_check").fetchone()[0]
+        except DatabaseError as e:
+            raise ValueError(f"{backup_file} is not a database: {e}")
+        if check != "ok":
+            raise ValueError(f"Backup {backup_file} is corrupt: {check}")
+        if not dbutils.is_initialized(source):
+            raise ValueError(f"{backup_file} is not a niviz-rater database")
+
+        source.connection().backup(db.connection())
@@ -1,2 +1,14 @@
 class IsInitialized(Exception):
     pass
+
+
+class VersionConflict(Exception):
+    """
+    Entity was modified since the version an update was based on
+    """
+
+    def __init__(self, entity_id: int, version: int):
+        super().__init__(f"Entity {entity_id} was modified, "
+                         f"current version is {version}")
+        self.entity_id = entity_id
+        self.version = version
@@ -0,0 +1,316 @@
+"""
+Merge ratings from other niviz-rater databases
+
+Source databases are ATTACHed to the target database and Entities
+are matched by their (row name, column name, component name) with
+set-based SQL, rather than looked up one at a time
+"""
+
+from __future__ import annotations
+from typing import NamedTuple, Optional, Tuple
+from pathlib import Path
+
+from peewee import SqliteDatabase
+
+import niviz_rater.db.migrations as migrations
+
+SOURCE = "merge_source"
+
+# Conflict policies:
+#   newest: Take the most recently modified rating
+#   prefer-rated: Only fill in Entities that have not been rated
+#   keep-both: Keep both ratings, storing the source's default ratings
+#       as ratings of a separate Rater
+POLICIES = ("newest", "prefer-rated", "keep-both")
+
+# Rater id of default ratings in the merge_candidate table
+DEFAULT_RATER = 0
+
+
+class MergeResult(NamedTuple):
+    """
+    Attributes:
+        matched: Source Entities matching an Entity of the target
+        unmatched: Source Entities without a matching Entity
+        updated: Target Entities given the source's rating
+        kept: Target Entities whose differing rating was kept
+        rater_ratings: Rater ratings inserted or updated
+    """
+    matched: int
+    unmatched: int
+    updated: int
+    kept: int
+    rater_ratings: int
+
+
+def _take_source(policy: str, source: str, target: str) -> str:
+    """
+    SQL condition under which the rating of `source` replaces that
+    of `target`, both aliases of rows with rating_id and modified columns
+    """
+
+    prefer_rated = (f'({source}."rating_id" IS NOT NULL '
+                    f'AND {target}."rating_id" IS NULL)')
+    if policy == "prefer-rated":
+        return prefer_rated
+
+    # Ratings made before modification times were recorded are oldest,
+    # ties fall back to preferring rated Entities
+    source_modified = f'COALESCE({source}."modified", 0)'
+    target_modified = f'COALESCE({target}."modified", 0)'
+    return (f'({source_modified} > {target_modified} OR '
+            f'({source_modified} = {target_modified} AND {prefer_rated}))')
+
+
+def _differs(source: str, target: str) -> str:
+    return (f'NOT ({source}."rating_id" IS {target}."rating_id" AND '
+            f'{source}."annotation_id" IS {target}."annotation_id" AND '
+            f'{source}."comment" = {target}."comment")')
+
+
+def _count(db: SqliteDatabase, sql: str, params=()) -> int:
+    return db.execute_sql(sql, params).fetchone()[0]
+
+
+def _add_names(db: SqliteDatabase, keep_both_rater: Optional[str]) -> None:
+    """
+    Add Ratings, Annotations and Raters of the source missing from
+    the target, matched by name
+    """
+
+    db.execute_sql(
+        f'INSERT INTO "rating" ("name") SELECT s."name" '
+        f'FROM {SOURCE}."rating" AS s WHERE s."name" NOT IN '
+        f'(SELECT "name" FROM main."rating")')
+    db.execute_sql(
+        f'INSERT INTO "annotation" ("name", "component_id") '
+        f'SELECT s."name", c."id" FROM {SOURCE}."annotation" AS s '
+        f'JOIN {SOURCE}."component" AS sc ON sc."id" = s."component_id" '
+        f'JOIN main."component" AS c ON c."name" = sc."name" '
+        f'WHERE NOT EXISTS (SELECT 1 FROM main."annotation" AS a '
+        f'WHERE a."name" = s."name" AND a."component_id" = c."id")')
+    db.execute_sql(
+        f'INSERT OR IGNORE INTO "rater" ("name") '
+        f'SELECT "name" FROM {SOURCE}."rater"')
+    if keep_both_rater is not None:
+        db.execute_sql('INSERT OR IGNORE INTO "rater" ("name") VALUES (?)',
+                       (keep_both_rater, ))
+
+
+def _map_ids(db: SqliteDatabase) -> None:
+    """
+    Map ids of source Entities, Ratings, Annotations and Raters
+    to the target in temporary tables
+    """
+
+    tables = ("tablerow", "tablecolumn", "component", "rating", "rater",
+              "annotation", "entity")
+    for table in tables:
+        db.execute_sql(f'DROP TABLE IF EXISTS temp."merge_{table}"')
+        db.execute_sql(
+            f'CREATE TEMP TABLE "merge_{table}" ('
+            f'"source_id" INTEGER NOT NULL PRIMARY KEY, '
+            f'"target_id" INTEGER NOT NULL)')
+
+    # Tables of uniquely named rows
+    for table in tables[:5]:
+        db.execute_sql(f'INSERT INTO temp."merge_{table}" '
+                       f'SELECT s."id", t."id" FROM {SOURCE}."{table}" AS s '
+                       f'JOIN main."{table}" AS t ON t."name" = s."name"')
+
+    db.execute_sql(
+        f'INSERT INTO temp."merge_annotation" '
+        f'SELECT s."id", t."id" FROM {SOURCE}."annotation" AS s '
+        f'JOIN temp."merge_component" AS c '
+        f'ON c."source_id" = s."component_id" '
+        f'JOIN main."annotation" AS t ON t."name" = s."name" '
+        f'AND t."component_id" = c."target_id"')
+
+    # CROSS JOINs fix the join order so target Entities are looked up
+    # by the unique (column, row) index rather than scanned by component
+    db.execute_sql(
+        f'INSERT INTO temp."merge_entity" '
+        f'SELECT s."id", t."id" FROM {SOURCE}."entity" AS s '
+        f'CROSS JOIN temp."merge_tablerow" AS r '
+        f'ON r."source_id" = s."rowname_id" '
+        f'CROSS JOIN temp."merge_tablecolumn" AS c '
+        f'ON c."source_id" = s."columnname_id" '
+        f'CROSS JOIN temp."merge_component" AS co '
+        f'ON co."source_id" = s."component_id" '
+        f'CROSS JOIN main."entity" AS t '
+        f'ON t."columnname_id" = c."target_id" '
+        f'AND t."rowname_id" = r."target_id" '
+        f'AND t."component_id" = co."target_id"')
+
+
+def _select_candidates(db: SqliteDatabase, default_rater: int) -> None:
+    """
+    Collect the rated or commented source ratings of matched Entities,
+    in target ids, into temp.merge_candidate. Default ratings are
+    given to rater `default_rater`
+    """
+
+    db.execute_sql('DROP TABLE IF EXISTS temp."merge_candidate"')
+    db.execute_sql(
+        'CREATE TEMP TABLE "merge_candidate" ('
+        '"rater_id" INTEGER NOT NULL, "entity_id" INTEGER NOT NULL, '
+        '"rating_id" INTEGER, "annotation_id" INTEGER, '
+        '"comment" TEXT NOT NULL, "modified" REAL, '
+        'PRIMARY KEY ("rater_id", "entity_id"))')
+
+    rated = ('(s."rating_id" IS NOT NULL OR s."annotation_id" IS NOT NULL '
+             'OR s."comment" != \'\')')
+    columns = ('e."target_id", r."target_id", a."target_id", s."comment", '
+               's."modified"')
+
+    def joins(entity_column):
+        return (f'JOIN temp."merge_entity" AS e '
+                f'ON e."source_id" = s."{entity_column}" '
+                f'LEFT JOIN temp."merge_rating" AS r '
+                f'ON r."source_id" = s."rating_id" '
+                f'LEFT JOIN temp."merge_annotation" AS a '
+                f'ON a."source_id" = s."annotation_id"')
+
+    db.execute_sql(
+        f'INSERT INTO temp."merge_candidate" '
+        f'SELECT ?, {columns} FROM {SOURCE}."entity" AS s '
+        f'{joins("id")} WHERE {rated}', (default_rater, ))
+    db.execute_sql(
+        f'INSERT OR REPLACE INTO temp."merge_candidate" '
+        f'SELECT m."target_id", {columns} FROM {SOURCE}."raterrating" AS s '
+        f'JOIN temp."merge_rater" AS m ON m."source_id" = s."rater_id" '
+        f'{joins("entity_id")} WHERE {rated}')
+
+
+def _merge_default_ratings(db: SqliteDatabase,
+                           policy: str) -> Tuple[int, int]:
+    """
+    Update Entities from default rater candidates allowed by `policy`
+
+    Returns:
+        updated: Number of Entities updated
+        kept: Number of differing Entities not updated
+    """
+
+    db.execute_sql('DROP TABLE IF EXISTS temp."merge_update"')
+    db.execute_sql(
+        f'CREATE TEMP TABLE "merge_update" AS '
+        f'SELECT c.* FROM temp."merge_candidate" AS c '
+        f'JOIN main."entity" AS t ON t."id" = c."entity_id" '
+        f'WHERE c."rater_id" = {DEFAULT_RATER} AND {_differs("c", "t")}')
+    n_differing = _count(db, 'SELECT COUNT(*) FROM temp."merge_update"')
+
+    db.execute_sql(
+        f'DELETE FROM temp."merge_update" WHERE "entity_id" IN ('
+        f'SELECT c."entity_id" FROM temp."merge_update" AS c '
+        f'JOIN main."entity" AS t ON t."id" = c."entity_id" '
+        f'WHERE NOT {_take_source(policy, "c", "t")})')
+    db.execute_sql('CREATE UNIQUE INDEX temp."merge_update_entity_id" '
+                   'ON "merge_update" ("entity_id")')
+
+    updated = db.execute_sql(
+        'UPDATE "entity" SET ("rating_id", "annotation_id", "comment", '
+        '"modified", "version") = (SELECT u."rating_id", u."annotation_id", '
+        'u."comment", u."modified", "entity"."version" + 1 '
+        'FROM temp."merge_update" AS u WHERE u."entity_id" = "entity"."id") '
+        'WHERE "id" IN (SELECT "entity_id" FROM temp."merge_update")'
+    ).rowcount
+    return updated, n_differing - updated
+
+
+def _merge_rater_ratings(db: SqliteDatabase, policy: str) -> int:
+    """
+    Insert or update RaterRatings from rater candidates, existing
+    ratings are replaced according to `policy`
+
+    Returns:
+        n_changed: Number of RaterRatings inserted or updated
+    """
+
+    return db.execute_sql(
+        f'INSERT INTO "raterrating" ("rater_id", "entity_id", "rating_id", '
+        f'"annotation_id", "comment", "modified", "version") '
+        f'SELECT "rater_id", "entity_id", "rating_id", "annotation_id", '
+        f'"comment", "modified", 1 FROM temp."merge_candidate" '
+        f'WHERE "rater_id" != {DEFAULT_RATER} '
+        f'ON CONFLICT ("rater_id", "entity_id") DO UPDATE SET '
+        f'"rating_id" = excluded."rating_id", '
+        f'"annotation_id" = excluded."annotation_id", '
+        f'"comment" = excluded."comment", '
+        f'"modified" = excluded."modified", '
+        f'"version" = "raterrating"."version" + 1 '
+        f'WHERE {_differs("excluded", "raterrating")} AND '
+        f'{_take_source(policy, "excluded", "raterrating")}').rowcount
+
+
+def merge_db(db: SqliteDatabase,
+             source_file: str,
+             policy: str = "newest",
+             rater: Optional[str] = None) -> MergeResult:
+    """
+    Merge ratings, annotations and comments of the database
+    `source_file` into `db`
+
+    Ratings of Raters are merged into ratings of the Rater with the same
+    name. Ratings, Annotations and Raters missing from `db` are added
+
+    Arguments:
+        db: Target database
+        source_file: Database to merge into `db`, created from the same
+            QC specification
+        policy: One of POLICIES, how to resolve Entities rated in both.
+            Rater ratings are merged newest first with keep-both
+        rater: Name of the Rater given the source's default ratings
+            with keep-both, defaults to the name of `source_file`
+
+    Raises:
+        ValueError: If `policy` is unknown, `source_file` does not exist
+            or was created by an older version of niviz-rater
+    """
+
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown merge policy {policy}, available "
+                         f"policies are {', '.join(POLICIES)}")
+    if not Path(source_file).is_file():
+        raise ValueError(f"Did not find database {source_file}")
+
+    keep_both_rater = None
+    if policy == "keep-both":
+        keep_both_rater = rater or Path(source_file).stem
+
+    db.execute_sql(f'ATTACH DATABASE ? AS {SOURCE}', (str(source_file), ))
+    try:
+        version = _count(db, f'PRAGMA {SOURCE}.user_version')
+        if version != migrations.SCHEMA_VERSION:
+            raise ValueError(f"Database {source_file} has schema version "
+                             f"{version}, expected "
+                             f"{migrations.SCHEMA_VERSION}. Use "
+                             f"`migrate_db` to upgrade it first")
+
+        with db.atomic():
+            _add_names(db, keep_both_rater)
+            _map_ids(db)
+
+            default_rater = DEFAULT_RATER
+            if keep_both_rater is not None:
+                default_rater = _count(
+                    db, 'SELECT "id" FROM "rater" WHERE "name" = ?',
+                    (keep_both_rater, ))
+            _select_candidates(db, default_rater)
+
+            updated, kept = _merge_default_ratings(db, policy)
+            rater_policy = "newest" if policy == "keep-both" else policy
+            rater_ratings = _merge_rater_ratings(db, rater_policy)
+
+            matched = _count(db, 'SELECT COUNT(*) FROM temp."merge_entity"')
+            unmatched = _count(
+                db, f'SELECT COUNT(*) FROM {SOURCE}."entity"') - matched
+
+            for table in ("tablerow", "tablecolumn", "component", "rating",
+                          "rater", "annotation", "entity", "candidate",
+                          "update"):
+                db.execute_sql(f'DROP TABLE IF EXISTS temp."merge_{table}"')
+    finally:
+        db.execute_sql(f'DETACH DATABASE {SOURCE}')
+
+    return MergeResult(matched, unmatched, updated, kept, rater_ratings)
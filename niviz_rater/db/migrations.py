@@ -0,0 +1,212 @@
+"""
+Schema migrations for databases created by older versions of Niviz-Rater
+
+The schema version of a database is stored in SQLite's `user_version`
+pragma. Each migration upgrades the schema by a single version and
+is applied within a transaction
+"""
+
+from __future__ import annotations
+from typing import Callable, List, Optional
+import logging
+import os
+from peewee import SqliteDatabase
+
+import niviz_rater.db.models as models
+
+logger = logging.getLogger(__name__)
+
+# Tables present in all versions of the schema
+BASE_TABLE_NAMES = [
+    'component', 'annotation', 'rating', 'tablecolumn', 'tablerow', 'entity',
+    'image'
+]
+
+CHUNK_SIZE = 10000
+
+Migration = Callable[[SqliteDatabase, Optional[str]], None]
+
+
+def get_version(db: SqliteDatabase) -> int:
+    return db.pragma('user_version')
+
+
+def set_version(db: SqliteDatabase, version: int) -> None:
+    db.pragma('user_version', version)
+
+
+def needs_migration(db: SqliteDatabase) -> bool:
+    return get_version(db) < SCHEMA_VERSION
+
+
+def needs_base_path(db: SqliteDatabase) -> bool:
+    """
+    Check whether migrating `db` requires the base directory of QC
+    images, to make its absolute image paths relative
+    """
+
+    return get_version(db) <= MIGRATIONS.index(_relative_image_paths)
+
+
+def migrate(db: SqliteDatabase, base_path: Optional[str] = None) -> int:
+    """
+    Apply all outstanding migrations to `db`
+
+    Arguments:
+        base_path: Base directory of QC images, required to
+            migrate databases storing absolute image paths
+
+    Returns:
+        version (int): Schema version of the migrated database
+    """
+
+    version = get_version(db)
+    for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Migrating database to schema version {i}: "
+                    f"{migration.__doc__.strip().splitlines()[0]}")
+        with db.atomic():
+            migration(db, base_path)
+            set_version(db, i)
+    return get_version(db)
+
+
+def _relative_image_paths(db: SqliteDatabase,
+                          base_path: Optional[str]) -> None:
+    """
+    Store image paths relative to the base directory,
+    split into shared directories and image names
+    """
+
+    if base_path is None:
+        raise ValueError("Base directory is required to make image paths "
+                         "relative!")
+
+    db.execute_sql('ALTER TABLE "image" RENAME TO "image_old"')
+    old_indexes = db.execute_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = 'image_old' AND sql IS NOT NULL").fetchall()
+    for (index, ) in old_indexes:
+        db.execute_sql(f'DROP INDEX "{index}"')
+
+    db.create_tables([models.ImageDirectory, models.Image])
+
+    base_prefix = os.path.join(os.path.abspath(base_path), "")
+    directories = {}
+    cursor = db.execute_sql(
+        'SELECT "id", "path", "entity_id" FROM "image_old" ORDER BY "id"')
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+
+        images = []
+        for image_id, path, entity_id in rows:
+            if path.startswith(base_prefix):
+                relpath = path[len(base_prefix):]
+            else:
+                relpath = os.path.relpath(path, base_path)
+            dirname, name = models.split_image_path(relpath)
+            if dirname not in directories:
+                directories[dirname] = db.execute_sql(
+                    'INSERT INTO "imagedirectory" ("path") VALUES (?)',
+                    (dirname, )).lastrowid
+            images.append((image_id, directories[dirname], name, entity_id))
+
+        db.cursor().executemany(
+            'INSERT INTO "image" ("id", "directory_id", "name", "entity_id") '
+            'VALUES (?, ?, ?, ?)', images)
+
+    db.execute_sql('DROP TABLE "image_old"')
+
+
+def _work_queue(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Add Entity leases and the indexes used to find unrated Entities
+    """
+
+    db.create_tables([models.Lease])
+    models.Entity._schema.create_indexes(safe=True)
+
+
+def _row_name_index(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Index row names used to page through Entities in spreadsheet order
+    """
+
+    models.TableRow._schema.create_indexes(safe=True)
+
+
+def _entity_versions(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Add Entity versions used to detect concurrent updates
+    """
+
+    db.execute_sql('ALTER TABLE "entity" ADD COLUMN "version" INTEGER '
+                   'NOT NULL DEFAULT 0')
+
+
+def _raters(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Add Raters and their ratings of Entities
+    """
+
+    db.create_tables([models.Rater, models.RaterRating])
+
+
+def _progress_counters(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Add rating counters of components/columns and rows, maintained by
+    triggers on Entity
+    """
+
+    db.create_tables([models.RatingCount, models.RowProgress])
+    db.execute_sql(
+        'INSERT INTO "ratingcount" ("component", "columnname", "rating", '
+        '"count") SELECT "component_id", "columnname_id", '
+        'COALESCE("rating_id", 0), COUNT(*) FROM "entity" '
+        'GROUP BY "component_id", "columnname_id", COALESCE("rating_id", 0)')
+    db.execute_sql(
+        'INSERT INTO "rowprogress" ("rowname", "total", "unrated") '
+        'SELECT "rowname_id", COUNT(*), COUNT(*) - COUNT("rating_id") '
+        'FROM "entity" GROUP BY "rowname_id"')
+    for trigger in models.PROGRESS_TRIGGERS:
+        db.execute_sql(trigger)
+
+
+def _modified_times(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Add modification times of ratings used to merge databases
+    """
+
+    # RaterRating already has the column if created by _raters
+    for table in ("entity", "raterrating"):
+        if "modified" not in {c.name for c in db.get_columns(table)}:
+            db.execute_sql(
+                f'ALTER TABLE "{table}" ADD COLUMN "modified" REAL')
+
+
+def _rating_history(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Add the history of rating changes, logged by triggers on Entity and
+    RaterRating from now on
+    """
+
+    db.create_tables([models.RatingHistory])
+    for trigger in models.HISTORY_TRIGGERS:
+        db.execute_sql(trigger)
+
+
+def _rater_events(db: SqliteDatabase, base_path: Optional[str]) -> None:
+    """
+    Add view and save times of Entities used to measure rater throughput
+    """
+
+    db.create_tables([models.RaterEvent])
+
+
+MIGRATIONS: List[Migration] = [
+    _relative_image_paths, _work_queue, _row_name_index, _entity_versions,
+    _raters, _progress_counters, _modified_times, _rating_history,
+    _rater_events
+]
+SCHEMA_VERSION = len(MIGRATIONS)
@@ -3,11 +3,12 @@ Niviz Data Models
 """
 
 from __future__ import annotations
-from pathlib import Path
-from typing import Union, List, TYPE_CHECKING
+from pathlib import Path, PurePath
+from typing import Union, List, Tuple, TYPE_CHECKING
 import logging
 from peewee import (Model, ForeignKeyField, TextField, CharField,
-                    DatabaseProxy, IntegrityError, SqliteDatabase)
+                    FloatField, IntegerField, DatabaseProxy, IntegrityError,
+                    SqliteDatabase, CompositeKey)
 
 if TYPE_CHECKING:
     from niviz_rater.spec import QCEntity
@@ -80,7 +81,8 @@ class TableColumn(BaseModel):
 
 
 class TableRow(BaseModel):
-    name = CharField()
+    # Indexed to page through Entities in spreadsheet order
+    name = CharField(index=True)
 
 
 class Entity(BaseModel):
@@ -95,9 +97,20 @@ class Entity(BaseModel):
     rating = ForeignKeyField(Rating, null=True)
     annotation = ForeignKeyField(Annotation, null=True)
 
+    # Incremented on every change, used to detect concurrent updates
+    version = IntegerField(default=0)
+    # Time of the last change to the rating, annotation or comment in
+    # seconds since the epoch, used to merge databases
+    modified = FloatField(null=True)
+
     class Meta:
         database = database_proxy
-        indexes = ((("columnname", "rowname"), True), )
+        indexes = (
+            (("columnname", "rowname"), True),
+            # Next unrated Entity of a column/component in id order
+            (("columnname", "rating", "id"), False),
+            (("component", "rating", "id"), False),
+        )
 
     @classmethod
     def from_qc_entity(cls, db: SqliteDatabase, qc_entity: QCEntity,
@@ -153,16 +166,21 @@ class Entity(BaseModel):
 
     def add_image(self, image_path: Path) -> Image:
         """
-        Add image to Entity
+        Add image to Entity, `image_path` should be relative
+        to the base directory
         """
-        image = Image(path=str(image_path), entity=self)
+        dirname, name = split_image_path(image_path)
         try:
             with self.db.atomic():
-                image.save()
+                directory, _ = ImageDirectory.get_or_create(path=dirname)
+                image = Image.create(directory=directory,
+                                     name=name,
+                                     entity=self)
         except IntegrityError:
             logger.error(f"Image { image_path } is already being used for"
                          f" the Entity { self.name }")
-            intended_image = Image.get((Image.path == str(image_path))
+            intended_image = Image.get((Image.directory == directory)
+                                       & (Image.name == name)
                                        & (Image.entity == self))
             return intended_image
 
@@ -244,24 +262,263 @@ class Entity(BaseModel):
             self.rating = None
 
 
+class ImageDirectory(BaseModel):
+    '''
+    Directory containing Images, relative to the base directory
+
+    Paths are stored with a trailing separator so that an Image's
+    path is the concatenation of its directory and name
+    '''
+    path = TextField(unique=True)
+
+
 class Image(BaseModel):
     '''
     Images used for an Entity to assess quality
     '''
-    path = TextField(unique=True)
+    directory = ForeignKeyField(ImageDirectory, backref='images')
+    name = TextField()
     entity = ForeignKeyField(Entity, backref='images')
 
     class Meta:
         database = database_proxy
 
-        # Unique constraint on path-entity tuples
-        indexes = ((("path", "entity"), True), )
+        # Unique constraint on directory-name tuples
+        indexes = ((("directory", "name"), True), )
+
+    @property
+    def path(self) -> str:
+        return self.directory.path + self.name
+
+
+class Rater(BaseModel):
+    '''
+    Rater of Entities in addition to the default rater, whose rating
+    is stored on the Entity itself
+    '''
+    name = CharField(unique=True)
+
+
+class RaterRating(BaseModel):
+    '''
+    Rating, annotation and comment of an Entity by a Rater
+    '''
+    # Indexed by the unique (rater, entity) index
+    rater = ForeignKeyField(Rater, backref='ratings', index=False)
+    entity = ForeignKeyField(Entity,
+                             backref='rater_ratings',
+                             on_delete='CASCADE')
+    # Indexed by the (rater, rating) index
+    rating = ForeignKeyField(Rating, null=True, index=False)
+    annotation = ForeignKeyField(Annotation, null=True)
+    comment = TextField(default="")
+    version = IntegerField(default=0)
+    modified = FloatField(null=True)
+
+    class Meta:
+        database = database_proxy
+        indexes = (
+            (("rater", "entity"), True),
+            # Per-rater progress
+            (("rater", "rating"), False),
+        )
+
+
+class Lease(BaseModel):
+    '''
+    Time-limited claim of a rater on an Entity handed out by the queue
+    '''
+    entity = ForeignKeyField(Entity, unique=True, on_delete='CASCADE')
+    holder = CharField(index=True)
+    expires = FloatField(index=True)
+
+
+class RatingCount(BaseModel):
+    '''
+    Number of Entities of each component and column given each rating
+    by the default rater, maintained by PROGRESS_TRIGGERS
+    '''
+    component = IntegerField()
+    columnname = IntegerField()
+    # 0 for unrated Entities
+    rating = IntegerField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey('component', 'columnname', 'rating')
+
+
+class RowProgress(BaseModel):
+    '''
+    Number of Entities and of Entities not rated by the default rater
+    in each TableRow, maintained by PROGRESS_TRIGGERS
+    '''
+    rowname = IntegerField(primary_key=True)
+    total = IntegerField(default=0)
+    unrated = IntegerField(default=0)
+
+
+# Most incomplete rows, in row id order among rows with as many unrated
+RowProgress.add_index(RowProgress.unrated.desc())
+
+
+class RatingHistory(BaseModel):
+    '''
+    Append-only log of changes to the rating, annotation and comment of
+    Entities by all raters, maintained by HISTORY_TRIGGERS
+    '''
+    entity = IntegerField()
+    # NULL for the default rater
+    rater = IntegerField(null=True)
+    # Seconds since the epoch
+    time = FloatField()
+    # Version of the Entity or RaterRating after the change
+    version = IntegerField()
+    old_rating = IntegerField(null=True)
+    old_annotation = IntegerField(null=True)
+    rating = IntegerField(null=True)
+    annotation = IntegerField(null=True)
+    # Comments are NULL unless changed, to keep the log compact
+    old_comment = TextField(null=True)
+    comment = TextField(null=True)
+    # Change reverted by this change, if it was made by an undo
+    undoes = IntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            # Changes of an Entity, e.g to undo its last change
+            (("entity", "time"), False),
+            # Changes since a time for incremental audit exports
+            (("time", ), False),
+        )
+
+
+class RaterEvent(BaseModel):
+    '''
+    Time a rater opened the view of an Entity or saved its rating,
+    buffered and written in batches by niviz_rater.telemetry
+    '''
+    entity = IntegerField()
+    # NULL for the default rater
+    rater = IntegerField(null=True)
+    # VIEW_EVENT or SAVE_EVENT
+    kind = IntegerField()
+    # Seconds since the epoch
+    time = FloatField(index=True)
+
+
+VIEW_EVENT = 0
+SAVE_EVENT = 1
+
+
+def split_image_path(image_path: Union[str, PurePath]) -> Tuple[str, str]:
+    """
+    Split an image path into its (directory, name), the directory
+    retains its trailing separator
+    """
+    dirname, sep, name = PurePath(image_path).as_posix().rpartition("/")
+    return dirname + sep, name
 
 
 DB_TABLES = [
-    Component, Annotation, Rating, TableColumn, TableRow, Entity, Image
+    Component, Annotation, Rating, TableColumn, TableRow, Entity,
+    ImageDirectory, Image, Lease, Rater, RaterRating, RatingCount,
+    RowProgress, RatingHistory, RaterEvent
 ]
 DB_TABLE_NAMES = [
     'component', 'annotation', 'rating', 'tablecolumn', 'tablerow', 'entity',
-    'image'
+    'imagedirectory', 'image', 'lease', 'rater', 'raterrating', 'ratingcount',
+    'rowprogress', 'ratinghistory', 'raterevent'
+]
+
+_COUNT_ENTITY = """
+    INSERT INTO "ratingcount" ("component", "columnname", "rating", "count")
+    VALUES (NEW."component_id", NEW."columnname_id",
+            COALESCE(NEW."rating_id", 0), 1)
+    ON CONFLICT ("component", "columnname", "rating")
+    DO UPDATE SET "count" = "count" + 1;
+    INSERT INTO "rowprogress" ("rowname", "total", "unrated")
+    VALUES (NEW."rowname_id", 1, NEW."rating_id" IS NULL)
+    ON CONFLICT ("rowname")
+    DO UPDATE SET "total" = "total" + 1,
+                  "unrated" = "unrated" + excluded."unrated";
+"""
+
+_UNCOUNT_ENTITY = """
+    UPDATE "ratingcount" SET "count" = "count" - 1
+    WHERE "component" = OLD."component_id"
+        AND "columnname" = OLD."columnname_id"
+        AND "rating" = COALESCE(OLD."rating_id", 0);
+    UPDATE "rowprogress" SET "total" = "total" - 1,
+                             "unrated" = "unrated" - (OLD."rating_id" IS NULL)
+    WHERE "rowname" = OLD."rowname_id";
+"""
+
+# Keep RatingCount and RowProgress up to date with Entities so that
+# progress is read from a handful of rows rather than counted
+PROGRESS_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS "entity_progress_insert"
+    AFTER INSERT ON "entity"
+    BEGIN {_COUNT_ENTITY} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS "entity_progress_delete"
+    AFTER DELETE ON "entity"
+    BEGIN {_UNCOUNT_ENTITY} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS "entity_progress_update"
+    AFTER UPDATE OF "rating_id", "component_id", "columnname_id",
+        "rowname_id" ON "entity"
+    WHEN OLD."rating_id" IS NOT NEW."rating_id"
+        OR OLD."component_id" != NEW."component_id"
+        OR OLD."columnname_id" != NEW."columnname_id"
+        OR OLD."rowname_id" != NEW."rowname_id"
+    BEGIN {_UNCOUNT_ENTITY} {_COUNT_ENTITY} END""",
+]
+
+
+def _record_change(entity: str, rater: str, old_rating: str,
+                   old_annotation: str, old_comment: str) -> str:
+    """
+    Statement logging a change to the NEW row of a trigger, from the
+    old values given as SQL expressions, to RatingHistory
+    """
+
+    comment_changed = f'{old_comment} IS NOT NEW."comment"'
+    return f"""
+    INSERT INTO "ratinghistory" ("entity", "rater", "time", "version",
+        "old_rating", "old_annotation", "rating", "annotation",
+        "old_comment", "comment")
+    VALUES ({entity}, {rater},
+        COALESCE(NEW."modified", (julianday('now') - 2440587.5) * 86400.0),
+        NEW."version", {old_rating}, {old_annotation},
+        NEW."rating_id", NEW."annotation_id",
+        CASE WHEN {comment_changed} THEN {old_comment} END,
+        CASE WHEN {comment_changed} THEN NEW."comment" END);
+"""
+
+
+_CHANGED = ('OLD."rating_id" IS NOT NEW."rating_id" '
+            'OR OLD."annotation_id" IS NOT NEW."annotation_id" '
+            'OR OLD."comment" IS NOT NEW."comment"')
+
+# Log every change to ratings in the transaction making it, rows saved
+# without changes are not logged. RaterRatings are usually inserted
+# unrated before being updated, but may be inserted rated by imports
+# and merges
+HISTORY_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS "entity_history_update"
+    AFTER UPDATE OF "rating_id", "annotation_id", "comment" ON "entity"
+    WHEN {_CHANGED}
+    BEGIN {_record_change('NEW."id"', "NULL", 'OLD."rating_id"',
+                          'OLD."annotation_id"', 'OLD."comment"')} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS "raterrating_history_insert"
+    AFTER INSERT ON "raterrating"
+    WHEN NEW."rating_id" IS NOT NULL OR NEW."annotation_id" IS NOT NULL
+        OR NEW."comment" != ''
+    BEGIN {_record_change('NEW."entity_id"', 'NEW."rater_id"', "NULL",
+                          "NULL", "''")} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS "raterrating_history_update"
+    AFTER UPDATE OF "rating_id", "annotation_id", "comment" ON "raterrating"
+    WHEN {_CHANGED}
+    BEGIN {_record_change('NEW."entity_id"', 'NEW."rater_id"',
+                          'OLD."rating_id"', 'OLD."annotation_id"',
+                          'OLD."comment"')} END""",
 ]
@@ -1,13 +1,25 @@
 from __future__ import annotations
 
-from typing import Optional, Tuple, List
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, List
+import heapq
+import json
 import logging
-from peewee import JOIN, ModelSelect
+import time
+from peewee import JOIN, SQL, Expression, ModelSelect, Select, fn
+import niviz_rater.db.exceptions as exceptions
 from niviz_rater.db.models import (Entity, Component, TableColumn, TableRow,
-                                   Rating, Image, Annotation)
+                                   Rating, Image, ImageDirectory, Annotation,
+                                   Lease, Rater, RaterRating, RatingCount,
+                                   RaterEvent, RatingHistory, RowProgress)
 
 logger = logging.getLogger(__name__)
 
+# Separates image paths aggregated into a single column
+IMAGE_SEPARATOR = "\x1f"
+
+# Seconds a rater holds an Entity handed out by the queue
+LEASE_DURATION = 300
+
 
 def get_component(component_name: str, create=False) -> Component:
 
@@ -19,6 +31,64 @@ def get_component(component_name: str, create=False) -> Component:
     return component
 
 
+def get_column(column_name: str) -> TableColumn:
+    return TableColumn.get(TableColumn.name == column_name)
+
+
+def get_rater(rater_name: str, create=False) -> Rater:
+    """
+    Return Rater by name, a Rater that does not exist yet is created
+    if `create`, otherwise an unsaved Rater without any ratings
+    is returned
+    """
+
+    if create:
+        rater, _ = Rater.get_or_create(name=rater_name)
+        return rater
+    return Rater.get_or_none(Rater.name == rater_name) or Rater(
+        name=rater_name)
+
+
+def get_raters() -> List[Rater]:
+    """
+    Returns ordered list of all Raters
+    """
+    return Rater.select().order_by(Rater.name, Rater.id)
+
+
+def _join_ratings(q: ModelSelect, rater: Optional[Rater]) -> ModelSelect:
+    """
+    Join the Rating and Annotation of Entities in `q` given by `rater`,
+    or by the default rater if None
+    """
+
+    if rater is None:
+        return q.join_from(Entity, Rating, JOIN.LEFT_OUTER).join_from(
+            Entity, Annotation, JOIN.LEFT_OUTER)
+
+    return q.join_from(
+        Entity,
+        RaterRating,
+        JOIN.LEFT_OUTER,
+        on=((RaterRating.entity == Entity.id)
+            & (RaterRating.rater == rater.id))).join_from(
+                RaterRating, Rating, JOIN.LEFT_OUTER).join_from(
+                    RaterRating, Annotation, JOIN.LEFT_OUTER)
+
+
+def _rating_fields(rater: Optional[Rater]) -> tuple:
+    """
+    Rating id and comment/version columns of `rater` for a query
+    joined by _join_ratings, Entities not rated by `rater` have an
+    empty comment and version 0
+    """
+
+    if rater is None:
+        return Entity.rating, Entity.comment, Entity.version
+    return (RaterRating.rating, fn.COALESCE(RaterRating.comment, ''),
+            fn.COALESCE(RaterRating.version, 0))
+
+
 def get_entity_by_row_col(row_name: str, col_name: str) -> Optional[Entity]:
     """
     Return an Entity by it's unique row/col combination
@@ -40,25 +110,171 @@ def get_entity_by_row_col(row_name: str, col_name: str) -> Optional[Entity]:
     return result.first()
 
 
-def get_summary() -> Tuple[int, int, int]:
+def get_summary(rater: Optional[Rater] = None) -> Tuple[int, int, int]:
     """
     Get number of Entities that have yet to be rated
 
+    Arguments:
+        rater: Count ratings of this Rater instead of the default rater
+
     Returns:
         summary: (total_entities, number_rated, number_unrated)
     """
 
     total = Entity.select().count()
-    n_unrated = Entity.select().where(Entity.rating.is_null()).count()
-    n_rated = total - n_unrated
+    if rater is None:
+        n_unrated = Entity.select().where(Entity.rating.is_null()).count()
+        n_rated = total - n_unrated
+    else:
+        # Counted from the (rater, rating) index
+        n_rated = RaterRating.select().where(
+            (RaterRating.rater == rater.id)
+            & RaterRating.rating.is_null(False)).count()
+        n_unrated = total - n_rated
 
     return total, n_rated, n_unrated
 
 
+def get_component_names() -> Dict[int, str]:
+    return dict(_execute(Component.select(Component.id, Component.name)))
+
+
+def get_column_names() -> Dict[int, str]:
+    return dict(_execute(TableColumn.select(TableColumn.id,
+                                            TableColumn.name)))
+
+
+def get_row_count() -> int:
+    return TableRow.select().count()
+
+
+def _rater_counts(rater: Rater, *group_by) -> ModelSelect:
+    """
+    Count Entities rated by `rater` grouped by Entity fields `group_by`,
+    reading only the ratings of `rater` from the (rater, rating) index
+    """
+
+    return (RaterRating.select(*group_by, fn.COUNT(RaterRating.id)).join(
+        Entity, on=(RaterRating.entity == Entity.id)).where(
+            (RaterRating.rater == rater.id)
+            & RaterRating.rating.is_null(False)).group_by(*group_by))
+
+
+def get_rating_counts(
+        rater: Optional[Rater] = None
+) -> List[Tuple[int, int, Optional[int], int]]:
+    """
+    Number of Entities of each component and column given each rating,
+    read from the RatingCount counters of the default rater
+
+    Arguments:
+        rater: Count ratings of this Rater instead of the default
+            rater, aggregated from the Rater's ratings
+
+    Returns:
+        counts: (component_id, column_id, rating_id, count) tuples,
+            with a rating_id of None for unrated Entities
+    """
+
+    totals = _execute(
+        RatingCount.select(RatingCount.component, RatingCount.columnname,
+                           RatingCount.rating,
+                           RatingCount.count).where(RatingCount.count > 0))
+    if rater is None:
+        return [(component, column, rating or None, count)
+                for component, column, rating, count in totals]
+
+    unrated = {}
+    for component, column, _, count in totals:
+        key = (component, column)
+        unrated[key] = unrated.get(key, 0) + count
+
+    counts = list(
+        _execute(
+            _rater_counts(rater, Entity.component, Entity.columnname,
+                          RaterRating.rating)))
+    for component, column, _, count in counts:
+        unrated[(component, column)] -= count
+
+    return counts + [(component, column, None, count)
+                     for (component, column), count in unrated.items()
+                     if count > 0]
+
+
+def get_row_progress(
+        limit: int,
+        rater: Optional[Rater] = None) -> Tuple[int, int, List[tuple]]:
+    """
+    Completion of TableRows, read from the RowProgress counters of the
+    default rater
+
+    Arguments:
+        limit: Number of most incomplete TableRows to return
+        rater: Completion of ratings by this Rater instead of the
+            default rater, aggregated from the Rater's ratings
+
+    Returns:
+        n_rows: Number of TableRows with Entities
+        n_complete: Number of TableRows with all Entities rated
+        incomplete: (row_id, row_name, n_entities, n_unrated) of up to
+            `limit` TableRows with the most unrated Entities, ordered
+            by number of unrated Entities then row id
+    """
+
+    n_rows = RowProgress.select().where(RowProgress.total > 0).count()
+    if rater is None:
+        n_incomplete = RowProgress.select().where(
+            RowProgress.unrated > 0).count()
+        q = (RowProgress.select(
+            RowProgress.rowname, TableRow.name, RowProgress.total,
+            RowProgress.unrated).join(
+                TableRow, on=(TableRow.id == RowProgress.rowname)).where(
+                    RowProgress.unrated > 0).order_by(
+                        RowProgress.unrated.desc(),
+                        RowProgress.rowname).limit(limit))
+        return n_rows, n_rows - n_incomplete, list(_execute(q))
+
+    rated = dict(_execute(_rater_counts(rater, Entity.rowname)))
+    progress = [(row, total, total - rated.get(row, 0))
+                for row, total in _execute(
+                    RowProgress.select(RowProgress.rowname, RowProgress.total).
+                    where(RowProgress.total > 0))]
+    incomplete = [p for p in progress if p[2] > 0]
+    top = heapq.nsmallest(limit, incomplete, key=lambda p: (-p[2], p[0]))
+    names = dict(
+        _execute(
+            TableRow.select(TableRow.id, TableRow.name).where(
+                TableRow.id.in_([row for row, _, _ in top]))))
+    return n_rows, n_rows - len(incomplete), [
+        (row, names[row], total, unrated) for row, total, unrated in top
+    ]
+
+
+def get_row_rating_counts(
+        row_ids: List[int],
+        rater: Optional[Rater] = None) -> Iterator[Tuple[int, int, int]]:
+    """
+    Number of Entities of each of `row_ids` given each rating
+
+    Arguments:
+        rater: Count ratings of this Rater instead of the default rater
+
+    Returns:
+        counts: Cursor yielding (row_id, rating_id, count) tuples, with
+            a rating_id of None for unrated Entities
+    """
+
+    rating, _, _ = _rating_fields(rater)
+    q = Entity.select(Entity.rowname, rating,
+                      fn.COUNT(Entity.id)).where(Entity.rowname.in_(row_ids))
+    return _execute(
+        _join_ratings(q, rater).group_by(Entity.rowname, rating))
+
+
 def _denormalized_query() -> ModelSelect:
     """
     Return denormalized Entity query with all foreign keys joined
-    To attach images use a `prefetch`
+    To attach images use a `prefetch` of Image and ImageDirectory
     """
 
     q = (Entity.select(
@@ -79,7 +295,7 @@ def get_denormalized_entities() -> List[Entity]:
         entities (List[Entity]): List of all entities with foreign keys
             joined and Images prefetched
     """
-    q = _denormalized_query().prefetch(Image)
+    q = _denormalized_query().prefetch(Image, ImageDirectory)
     return q
 
 
@@ -94,13 +310,486 @@ def get_denormalized_entity_by_id(entity_id: int) -> Entity:
     Raises:
         ValueError: If more than 1 entity is found to contain a given ID
     """
-    q = _denormalized_query().where(Entity.id == entity_id).prefetch(Image)
+    q = _denormalized_query().where(Entity.id == entity_id).prefetch(
+        Image, ImageDirectory)
 
     if len(q) != 1:
         raise ValueError(f"Expected 1 Entity, received {len(q)}!")
     return q[0]
 
 
+def _image_paths_subquery() -> Select:
+    """
+    Correlated subquery aggregating an Entity's image paths, ordered
+    by insertion, into a single IMAGE_SEPARATOR delimited string
+    """
+
+    ordered = (Image.select(
+        ImageDirectory.path.concat(Image.name).alias('path')).join(
+            ImageDirectory).where(Image.entity == Entity.id).order_by(
+                Image.id)).alias('ordered_images')
+    return Select(from_list=[ordered],
+                  columns=[fn.group_concat(ordered.c.path, IMAGE_SEPARATOR)])
+
+
+def _execute(query: ModelSelect) -> Iterator[tuple]:
+    """
+    Execute `query` returning the raw DB cursor, skipping peewee's
+    per-row model/type conversion for bulk reads
+    """
+    return query.model._meta.database.execute(query)
+
+
+def get_entity_records(rater: Optional[Rater] = None) -> Iterator[tuple]:
+    """
+    Return lightweight tuples of all Entities with dimension tables
+    joined and image paths aggregated, ordered by Entity id
+
+    Arguments:
+        rater: Return ratings of this Rater instead of the default rater
+
+    Returns:
+        records: Cursor yielding tuples of
+            (id, name, comment, version, row_name, column_name,
+             rating_id, rating_name, annotation_id, annotation_name,
+             image_paths)
+            where image_paths is an IMAGE_SEPARATOR delimited
+            string or None if the Entity has no images
+    """
+
+    _, comment, version = _rating_fields(rater)
+    q = (Entity.select(Entity.id, Entity.name, comment, version,
+                       TableRow.name, TableColumn.name, Rating.id,
+                       Rating.name, Annotation.id, Annotation.name,
+                       _image_paths_subquery().alias('images')).join_from(
+                           Entity, TableRow).join_from(Entity, TableColumn))
+    return _execute(_join_ratings(q, rater).order_by(Entity.id))
+
+
+def _entity_view_query(rater: Optional[Rater] = None) -> ModelSelect:
+    _, comment, version = _rating_fields(rater)
+    q = (Entity.select(Entity.id, Entity.name, comment, version,
+                       Entity.component, Rating.id, Rating.name,
+                       Annotation.id, Annotation.name,
+                       _image_paths_subquery().alias('images')).join_from(
+                           Entity, TableRow).join_from(Entity, TableColumn))
+    return _join_ratings(q, rater)
+
+
+def get_next_entity_ids(entity_id: int,
+                        count: int,
+                        unrated: bool = False,
+                        rater: Optional[Rater] = None) -> List[int]:
+    """
+    Return ids of the Entities following `entity_id` in spreadsheet
+    order, by row name then column name
+
+    Arguments:
+        entity_id: Entity to start after
+        count: Maximum number of ids to return
+        unrated: Only return Entities that have not been rated
+        rater: Rater whose ratings `unrated` refers to, the default
+            rater if None
+
+    Raises:
+        Entity.DoesNotExist: If no Entity with `entity_id` exists
+    """
+
+    row_name, column_name = (Entity.select(
+        TableRow.name, TableColumn.name).join_from(
+            Entity, TableRow).join_from(Entity, TableColumn).where(
+                Entity.id == entity_id).tuples().get())
+
+    following = (TableRow.name >= row_name) & (
+        (TableRow.name > row_name) | (TableColumn.name > column_name) |
+        ((TableColumn.name == column_name) & (Entity.id > entity_id)))
+    if unrated:
+        following &= _rating_fields(rater)[0].is_null()
+
+    # CROSS JOIN forces SQLite to walk TableRows in name index order
+    # and stop after `count` Entities rather than sorting all Entities
+    q = (TableRow.select(Entity.id).join(Entity, JOIN.CROSS).join_from(
+        Entity, TableColumn).where((Entity.rowname == TableRow.id)
+                                   & following).order_by(
+                                       TableRow.name, TableColumn.name,
+                                       Entity.id).limit(count))
+    if unrated and rater is not None:
+        q = q.join_from(Entity,
+                        RaterRating,
+                        JOIN.LEFT_OUTER,
+                        on=((RaterRating.entity == Entity.id)
+                            & (RaterRating.rater == rater.id)))
+    return [r[0] for r in _execute(q)]
+
+
+def get_entity_views(entity_ids: List[int],
+                     rater: Optional[Rater] = None) -> List[tuple]:
+    """
+    Return Entities with dimension tables joined and image
+    paths aggregated, in the order of `entity_ids`
+
+    Arguments:
+        rater: Return ratings of this Rater instead of the default rater
+
+    Returns:
+        records: List of tuples of
+            (id, name, comment, version, component_id, rating_id,
+             rating_name, annotation_id, annotation_name, image_paths)
+    """
+
+    records = {
+        r[0]: r
+        for r in _execute(
+            _entity_view_query(rater).where(Entity.id.in_(entity_ids)))
+    }
+    return [records[i] for i in entity_ids if i in records]
+
+
+def iter_entity_views(rater: Optional[Rater] = None) -> Iterator[tuple]:
+    """
+    Return a cursor yielding the records of get_entity_views for all
+    Entities, in no particular order
+    """
+
+    return _execute(_entity_view_query(rater))
+
+
+def get_rater_rating(entity_id: int, rater: Rater) -> Optional[RaterRating]:
+    """
+    Return the RaterRating of an Entity by `rater` with its Rating and
+    Annotation joined, None if `rater` has not rated the Entity
+    """
+
+    return (RaterRating.select(RaterRating, Rating, Annotation).join_from(
+        RaterRating, Rating, JOIN.LEFT_OUTER).join_from(
+            RaterRating, Annotation,
+            JOIN.LEFT_OUTER).where((RaterRating.entity == entity_id)
+                                   & (RaterRating.rater == rater.id)).first())
+
+
+def get_entity_names(entity_ids: Iterable[int]) -> Dict[int, str]:
+    """
+    Map Entity ids to names, looked up in batches to stay within
+    SQLite's limit on query parameters
+    """
+
+    entity_ids = list(entity_ids)
+    names = {}
+    for start in range(0, len(entity_ids), 500):
+        q = Entity.select(Entity.id, Entity.name).where(
+            Entity.id.in_(entity_ids[start:start + 500]))
+        names.update(_execute(q))
+    return names
+
+
+def get_component_annotations(
+        component_ids: Iterable[int]) -> Dict[int, List[Annotation]]:
+    """
+    Return the available Annotations of each Component in a single query
+    """
+
+    annotations = {c: [] for c in component_ids}
+    for annotation in Annotation.select().where(
+            Annotation.component.in_(list(annotations))).order_by(
+                Annotation.id):
+        annotations[annotation.component_id].append(annotation)
+    return annotations
+
+
+def update_entity(entity_id: int,
+                  changes: Dict[str, Any],
+                  version: Optional[int] = None,
+                  rater: Optional[Rater] = None) -> int:
+    """
+    Update the rating, annotation and/or comment of an Entity, without
+    locking, if it has not been modified since `version`
+
+    Arguments:
+        entity_id: Entity to update
+        changes: Mapping of fields to update to their new values, ratings
+            and annotations are given by id
+        version: Version of the Entity the changes were based on, the
+            Entity is updated unconditionally if None
+        rater: Update the RaterRating of this saved Rater instead of
+            the Entity, versions then refer to the RaterRating
+
+    Returns:
+        version: Version of the Entity after the update
+
+    Raises:
+        Entity.DoesNotExist: If no Entity with `entity_id` exists
+        VersionConflict: If the Entity was modified since `version`,
+            unless it already holds `changes`
+    """
+
+    with Entity._meta.database.atomic():
+        if rater is None:
+            model, where = Entity, Entity.id == entity_id
+        else:
+            model = RaterRating
+            where = (RaterRating.rater == rater) & (RaterRating.entity
+                                                    == entity_id)
+            if not Entity.select().where(Entity.id == entity_id).exists():
+                raise Entity.DoesNotExist(
+                    f"Entity {entity_id} does not exist")
+            RaterRating.insert(rater=rater,
+                               entity=entity_id).on_conflict_ignore().execute()
+
+        if changes:
+            q = model.update(**changes,
+                             version=model.version + 1,
+                             modified=time.time()).where(where)
+            if version is not None:
+                q = q.where(model.version == version)
+            updated = q.execute()
+        else:
+            updated = 0
+
+        current = model.get(where)
+        if updated or all(
+                getattr(current, model._meta.fields[k].column_name) == v
+                for k, v in changes.items()):
+            return current.version
+
+    raise exceptions.VersionConflict(entity_id, current.version)
+
+
+def _history_of(entity_id: int, rater: Optional[Rater]) -> Expression:
+    where = RatingHistory.entity == entity_id
+    if rater is None:
+        return where & RatingHistory.rater.is_null()
+    return where & (RatingHistory.rater == rater.id)
+
+
+def undo_change(entity_id: int,
+                version: Optional[int] = None,
+                rater: Optional[Rater] = None) -> Optional[int]:
+    """
+    Revert the last change to the rating, annotation and comment of an
+    Entity that has not been undone yet. The revert is itself logged
+    as a change, marked as undoing the reverted change, so repeated
+    undos step back through the history of the Entity
+
+    Arguments:
+        version: Version of the Entity the undo is based on, the last
+            change is undone unconditionally if None
+        rater: Undo a change by this Rater instead of the default rater
+
+    Returns:
+        version: Version of the Entity after the undo, None if it has
+            no changes to undo
+
+    Raises:
+        Entity.DoesNotExist: If no Entity with `entity_id` exists
+        VersionConflict: If the Entity was modified since `version`
+    """
+
+    with Entity._meta.database.atomic(lock_type="IMMEDIATE"):
+        if not Entity.select().where(Entity.id == entity_id).exists():
+            raise Entity.DoesNotExist(f"Entity {entity_id} does not exist")
+        if rater is not None and rater.id is None:
+            return None
+
+        latest = None
+        undone = set()
+        for (change_id, undoes, old_rating, old_annotation, old_comment,
+             comment) in _execute(
+                 RatingHistory.select(
+                     RatingHistory.id, RatingHistory.undoes,
+                     RatingHistory.old_rating, RatingHistory.old_annotation,
+                     RatingHistory.old_comment, RatingHistory.comment).where(
+                         _history_of(entity_id, rater)).order_by(
+                             RatingHistory.id.desc())):
+            latest = latest or change_id
+            if undoes is not None:
+                undone.add(undoes)
+            elif change_id not in undone:
+                break
+        else:
+            return None
+
+        changes = {'rating': old_rating, 'annotation': old_annotation}
+        # Comments are only logged when changed
+        if comment is not None:
+            changes['comment'] = old_comment
+        version = update_entity(entity_id, changes, version, rater)
+
+        # Mark the change logged by the revert
+        marked = RatingHistory.update(undoes=change_id).where(
+            _history_of(entity_id, rater)
+            & (RatingHistory.id > latest)).execute()
+        if not marked:
+            # The Entity already held the reverted values, so no change
+            # was logged. Log the revert anyway to mark the change undone
+            RatingHistory.insert(entity=entity_id,
+                                 rater=rater and rater.id,
+                                 time=time.time(),
+                                 version=version,
+                                 old_rating=old_rating,
+                                 old_annotation=old_annotation,
+                                 rating=old_rating,
+                                 annotation=old_annotation,
+                                 undoes=change_id).execute()
+    return version
+
+
+def get_history(since: Optional[float] = None) -> Iterator[tuple]:
+    """
+    Return changes to ratings by all raters made at or after `since`,
+    in order of time
+
+    Returns:
+        records: Cursor yielding tuples of
+            (id, time, rater_id, entity_id, entity_name, row_name,
+             column_name, version, old_rating_id, old_annotation_id,
+             rating_id, annotation_id, old_comment, comment, undoes)
+            where rater_id is None for the default rater, names are
+            None for deleted Entities and comments are None if unchanged
+    """
+
+    q = (RatingHistory.select(
+        RatingHistory.id, RatingHistory.time, RatingHistory.rater,
+        RatingHistory.entity, Entity.name, TableRow.name, TableColumn.name,
+        RatingHistory.version, RatingHistory.old_rating,
+        RatingHistory.old_annotation, RatingHistory.rating,
+        RatingHistory.annotation, RatingHistory.old_comment,
+        RatingHistory.comment, RatingHistory.undoes).join(
+            Entity,
+            JOIN.LEFT_OUTER,
+            on=(RatingHistory.entity == Entity.id)).join_from(
+                Entity, TableRow, JOIN.LEFT_OUTER).join_from(
+                    Entity, TableColumn,
+                    JOIN.LEFT_OUTER).order_by(RatingHistory.time,
+                                              RatingHistory.id))
+    if since is not None:
+        q = q.where(RatingHistory.time >= since)
+    return _execute(q)
+
+
+def save_rater_events(events: List[tuple]) -> None:
+    """
+    Insert (entity_id, rater_id, kind, time) RaterEvents in a single
+    transaction
+    """
+
+    with RaterEvent._meta.database.atomic():
+        for start in range(0, len(events), 500):
+            RaterEvent.insert_many(events[start:start + 500],
+                                   fields=[
+                                       RaterEvent.entity, RaterEvent.rater,
+                                       RaterEvent.kind, RaterEvent.time
+                                   ]).execute()
+
+
+def get_rater_events(since: Optional[float] = None) -> Iterator[tuple]:
+    """
+    Return RaterEvents at or after `since` of existing Entities, ordered
+    by rater, Entity and time
+
+    Returns:
+        records: Cursor yielding tuples of
+            (rater_id, entity_id, kind, time, component_id, column_id)
+    """
+
+    q = (RaterEvent.select(RaterEvent.rater, RaterEvent.entity,
+                           RaterEvent.kind, RaterEvent.time,
+                           Entity.component, Entity.columnname).join(
+                               Entity,
+                               on=(RaterEvent.entity == Entity.id)).order_by(
+                                   RaterEvent.rater, RaterEvent.entity,
+                                   RaterEvent.time))
+    if since is not None:
+        q = q.where(RaterEvent.time >= since)
+    return _execute(q)
+
+
+def get_rating_states(row_ids: List[int],
+                      column_ids: List[int],
+                      rater: Optional[Rater] = None) -> Iterator[tuple]:
+    """
+    Stream the current rating of Entities in TableRows `row_ids`
+    and TableColumns `column_ids`
+
+    Arguments:
+        rater: Return ratings of this Rater instead of the default rater
+
+    Returns:
+        records: Cursor yielding (row_id, column_id, entity_id,
+            component_id, annotation_id, rating_id, comment) tuples
+    """
+
+    q = Entity.select(Entity.rowname, Entity.columnname, Entity.id,
+                      Entity.component)
+    if rater is None:
+        q = q.select_extend(Entity.annotation, Entity.rating, Entity.comment)
+    else:
+        q = q.select_extend(RaterRating.annotation, RaterRating.rating,
+                            fn.COALESCE(RaterRating.comment, '')).join(
+                                RaterRating,
+                                JOIN.LEFT_OUTER,
+                                on=((RaterRating.entity == Entity.id)
+                                    & (RaterRating.rater == rater.id)))
+
+    # A single JSON parameter avoids binding each id
+    return _execute(
+        q.where(
+            Entity.rowname.in_(
+                SQL('(SELECT "value" FROM json_each(?))',
+                    [json.dumps(row_ids)]))
+            & Entity.columnname.in_(column_ids)))
+
+
+def save_ratings(ratings: List[tuple], rater: Optional[Rater] = None) -> int:
+    """
+    Set the annotation, rating and comment of many Entities, bumping
+    their versions. Ratings are staged in a temporary table with
+    executemany and saved with a single statement, which is much faster
+    than an UPDATE per Entity when Entity triggers and foreign keys
+    are enabled
+
+    Arguments:
+        ratings: (entity_id, annotation_id, rating_id, comment) tuples,
+            at most one per Entity
+        rater: Save ratings of this saved Rater instead of the
+            default rater
+
+    Returns:
+        n_saved: Number of Entities/RaterRatings updated or inserted
+    """
+
+    db = Entity._meta.database
+    db.execute_sql('CREATE TEMP TABLE IF NOT EXISTS "saved_rating" '
+                   '("entity_id" INTEGER PRIMARY KEY, "annotation_id", '
+                   '"rating_id", "comment")')
+    db.execute_sql('DELETE FROM temp."saved_rating"')
+    db.cursor().executemany(
+        'INSERT INTO temp."saved_rating" VALUES (?, ?, ?, ?)', ratings)
+
+    modified = time.time()
+    if rater is None:
+        return db.execute_sql(
+            'UPDATE "entity" SET ("annotation_id", "rating_id", "comment", '
+            '"modified", "version") = (SELECT s."annotation_id", '
+            's."rating_id", s."comment", ?, "entity"."version" + 1 '
+            'FROM temp."saved_rating" AS s '
+            'WHERE s."entity_id" = "entity"."id") '
+            'WHERE "id" IN (SELECT "entity_id" FROM temp."saved_rating")',
+            (modified, )).rowcount
+
+    return db.execute_sql(
+        'INSERT INTO "raterrating" ("rater_id", "entity_id", '
+        '"annotation_id", "rating_id", "comment", "modified", "version") '
+        'SELECT ?, "entity_id", "annotation_id", "rating_id", "comment", ?, '
+        '1 FROM temp."saved_rating" WHERE true '
+        'ON CONFLICT ("rater_id", "entity_id") DO UPDATE SET '
+        '"annotation_id" = excluded."annotation_id", '
+        '"rating_id" = excluded."rating_id", '
+        '"comment" = excluded."comment", '
+        '"modified" = excluded."modified", '
+        '"version" = "raterrating"."version" + 1',
+        (rater.id, modified)).rowcount
+
+
 def get_available_annotations(entity: Entity) -> List[Optional[Annotation]]:
 
     annotations = Annotation.select().where(
@@ -122,8 +811,200 @@ def get_denormalized_rows() -> List[TableRow]:
     return rows
 
 
-def get_columns() -> List[TableColumn]:
+def get_export_cells(column_ids: Optional[List[int]] = None,
+                     component: Optional[Component] = None,
+                     rater: Optional[Rater] = None) -> Iterator[tuple]:
+    """
+    Stream the exportable fields of every Entity for each TableRow,
+    TableRows without Entities yield a single record with a None column
+
+    Arguments:
+        column_ids: Only include Entities in these TableColumns
+        component: Only include Entities of this Component
+        rater: Export ratings of this Rater instead of the default rater
+
+    Returns:
+        records: Cursor yielding tuples of
+            (row_id, row_name, column_id, annotation_name,
+             rating_name, comment) ordered by row name then column name
+    """
+
+    on = Entity.rowname == TableRow.id
+    if column_ids is not None:
+        on &= Entity.columnname.in_(column_ids)
+    if component is not None:
+        on &= Entity.component == component
+
+    _, comment, _ = _rating_fields(rater)
+    q = (TableRow.select(TableRow.id, TableRow.name, Entity.columnname,
+                         Annotation.name, Rating.name, comment).join(
+                             Entity, JOIN.LEFT_OUTER, on=on).join_from(
+                                 Entity, TableColumn, JOIN.LEFT_OUTER))
+    return _execute(
+        _join_ratings(q, rater).order_by(TableRow.name, TableRow.id,
+                                         TableColumn.name, TableColumn.id))
+
+
+def get_rating_matrix_records(
+        raters: List[Optional[Rater]]) -> Iterator[tuple]:
+    """
+    Stream the rating of every Entity by each of `raters` in a single
+    query, joining each Rater's RaterRatings on the (rater, entity) index
+
+    Arguments:
+        raters: Raters to include, None is the default rater
+
+    Returns:
+        records: Cursor yielding tuples of
+            (entity_id, component_id, column_id, *rating_ids) ordered
+            by Entity id, with a rating id of 0 for unrated Entities
+    """
+
+    fields = []
+    q = Entity.select()
+    for rater in raters:
+        if rater is None:
+            fields.append(fn.COALESCE(Entity.rating, 0))
+            continue
+
+        rater_rating = RaterRating.alias()
+        q = q.join_from(Entity,
+                        rater_rating,
+                        JOIN.LEFT_OUTER,
+                        on=((rater_rating.entity == Entity.id)
+                            & (rater_rating.rater == rater.id)))
+        fields.append(fn.COALESCE(rater_rating.rating, 0))
+
+    return _execute(
+        q.select(Entity.id, Entity.component, Entity.columnname,
+                 *fields).order_by(Entity.id))
+
+
+def get_columns(names: Optional[List[str]] = None,
+                component: Optional[Component] = None) -> List[TableColumn]:
     """
     Returns ordered list of all TableColumn models
+
+    Arguments:
+        names: Only return TableColumns with these names
+        component: Only return TableColumns containing Entities
+            of this Component
+    """
+    q = TableColumn.select()
+    if names is not None:
+        q = q.where(TableColumn.name.in_(names))
+    if component is not None:
+        q = q.where(
+            TableColumn.id.in_(
+                Entity.select(Entity.columnname).where(
+                    Entity.component == component)))
+    return q.order_by(TableColumn.name, TableColumn.id)
+
+
+def _unrated_entities_query(column: Optional[TableColumn] = None,
+                            component: Optional[Component] = None,
+                            after: Optional[int] = None,
+                            rater: Optional[Rater] = None) -> ModelSelect:
+
+    if column is None and component is None:
+        raise ValueError("Either a column or component is required")
+
+    q = (Entity.select(Entity.id).join(
+        Lease, JOIN.LEFT_OUTER,
+        on=(Lease.entity == Entity.id)).where(
+            _rating_fields(rater)[0].is_null() & Lease.id.is_null()))
+    if rater is not None:
+        # Anti-join scanning the Entities rated by `rater` before the
+        # first unrated one, see get_unrated_entity_ids
+        q = q.join_from(Entity,
+                        RaterRating,
+                        JOIN.LEFT_OUTER,
+                        on=((RaterRating.entity == Entity.id)
+                            & (RaterRating.rater == rater.id)))
+    if column is not None:
+        q = q.where(Entity.columnname == column)
+    else:
+        q = q.where(Entity.component == component)
+    if after is not None:
+        q = q.where(Entity.id > after)
+
+    return q.order_by(Entity.id)
+
+
+def get_unrated_entity_ids(column: Optional[TableColumn] = None,
+                           component: Optional[Component] = None,
+                           after: Optional[int] = None,
+                           limit: int = 1,
+                           rater: Optional[Rater] = None) -> List[int]:
+    """
+    Ids of unrated Entities of a column or component without a lease,
+    in id order. Uses the (column/component, rating, id) indexes of
+    Entity so finding the next Entity does not scan rated Entities.
+    Ratings of a named `rater` are not in those indexes, so its rated
+    Entities of the column or component are scanned in id order, each
+    checked with the (rater, entity) index of RaterRating, until an
+    unrated one is found. This is timed by the queue_rater benchmark
+
+    Arguments:
+        column: Only include Entities in this TableColumn
+        component: Only include Entities of this Component
+        after: Only include Entities with an id greater than `after`
+        limit: Maximum number of ids to return
+        rater: Rater whose ratings are checked, the default rater
+            if None
     """
-    return TableColumn.select().order_by(TableColumn.name)
+
+    q = _unrated_entities_query(column, component, after,
+                                rater).limit(limit)
+    return [r[0] for r in _execute(q)]
+
+
+def lease_next_entity(
+    holder: str,
+    column: Optional[TableColumn] = None,
+    component: Optional[Component] = None,
+    after: Optional[int] = None,
+    prefetch: int = 0,
+    duration: float = LEASE_DURATION,
+    rater: Optional[Rater] = None
+) -> Tuple[Optional[Lease], List[int]]:
+    """
+    Lease the next unrated Entity of a column or component to `holder`
+
+    Expired leases are reclaimed and any previous lease of `holder` is
+    released, so each holder leases at most one Entity at a time. A
+    leased Entity is not handed to other holders, whichever rater they
+    rate as
+
+    Arguments:
+        holder: Identifier of the rater requesting an Entity
+        column: Lease the next Entity in this TableColumn
+        component: Lease the next Entity of this Component
+        after: Only lease Entities with an id greater than `after`
+        prefetch: Number of following Entity ids to return
+        duration: Seconds until the lease expires
+        rater: Rater whose unrated Entities are leased, the default
+            rater if None. Slower for a named rater who has rated most
+            of the column or component, see get_unrated_entity_ids
+
+    Returns:
+        lease: Lease on the next Entity, None if all are rated or leased
+        next_ids: Ids of up to `prefetch` Entities following the lease
+    """
+
+    now = time.time()
+
+    # Serialize leasing between concurrent raters
+    with Lease._meta.database.atomic('IMMEDIATE'):
+        Lease.delete().where((Lease.expires <= now)
+                             | (Lease.holder == holder)).execute()
+
+        ids = get_unrated_entity_ids(column, component, after, prefetch + 1,
+                                     rater)
+        if not ids:
+            return None, []
+
+        lease = Lease.create(entity=ids[0],
+                             holder=holder,
+                             expires=now + duration)
+    return lease, ids[1:]
@@ -0,0 +1,180 @@
+import threading
+
+import pytest
+from peewee import SqliteDatabase, fn
+
+import niviz_rater.db.backup as backup
+import niviz_rater.db.models as models
+import niviz_rater.db.utils as dbutils
+
+N_ROWS = 500
+COLUMNS = ["T1w", "bold"]
+
+
+def _make_db(path):
+    db = SqliteDatabase(str(path), pragmas={'foreign_keys': 1})
+    with db.bind_ctx(models.DB_TABLES), db.atomic():
+        dbutils.initialize_tables(db, {"Ratings": ["Pass", "Fail"]})
+        component = models.Component.create(name="qc")
+        columns = [models.TableColumn.create(name=c) for c in COLUMNS]
+        for i in range(N_ROWS):
+            row = models.TableRow.create(name=f"sub-{i:04d}")
+            for column in columns:
+                models.Entity.create(name=f"{row.name} {column.name}",
+                                     rowname=row,
+                                     columnname=column,
+                                     component=component,
+                                     comment="x" * 200)
+    return db
+
+
+def _check(path):
+    """
+    Return the number of rated Entities of a backup after checking it
+    is intact and its progress counters match its Entities
+    """
+
+    db = SqliteDatabase(str(path))
+    with db.bind_ctx(models.DB_TABLES):
+        assert db.execute_sql("PRAGMA quick_check").fetchone()[0] == "ok"
+        Entity = models.Entity
+        counts = dict(
+            Entity.select(fn.COALESCE(Entity.rating, 0),
+                          fn.COUNT(Entity.id)).group_by(
+                              fn.COALESCE(Entity.rating, 0)).tuples())
+        counters = dict(
+            models.RatingCount.select(
+                models.RatingCount.rating,
+                fn.SUM(models.RatingCount.count)).group_by(
+                    models.RatingCount.rating).having(
+                        fn.SUM(models.RatingCount.count) > 0).tuples())
+        assert counts == counters
+        n_rated = Entity.select().where(Entity.rating.is_null(False)).count()
+    db.close()
+    return n_rated
+
+
+@pytest.fixture
+def live_db(tmp_path):
+    db = _make_db(tmp_path / "niviz.db")
+    yield db
+    db.close()
+
+
+def test_backup_while_writers_are_active(live_db, tmp_path):
+
+    stop = threading.Event()
+    writes = []
+    errors = []
+
+    def writer(offset):
+        db = SqliteDatabase(live_db.database,
+                            pragmas={'foreign_keys': 1},
+                            timeout=10)
+        n = 0
+        # Models are not rebound in threads, binding is not thread-local
+        try:
+            while not stop.is_set():
+                entity_id = offset + n % (N_ROWS * len(COLUMNS) // 2)
+                with db.atomic():
+                    db.execute_sql(
+                        'UPDATE "entity" SET "rating_id" = ?, '
+                        '"version" = "version" + 1 WHERE "id" = ?',
+                        (1 + n % 2, entity_id))
+                n += 1
+        except Exception as e:
+            errors.append(e)
+        finally:
+            writes.append(n)
+            db.close()
+
+    threads = [
+        threading.Thread(target=writer, args=(offset, ))
+        for offset in (1, 1 + N_ROWS)
+    ]
+    for t in threads:
+        t.start()
+
+    try:
+        results = [
+            backup.backup_db(live_db, tmp_path / f"backup{i}.db", pages=4)
+            for i in range(3)
+        ]
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    assert errors == []
+    assert all(n > 0 for n in writes)
+    for result in results:
+        assert result.size > 0
+        _check(result.path)
+
+    # The last backup is unaffected by writes made after it
+    with live_db.bind_ctx(models.DB_TABLES):
+        models.Entity.update(rating=None).execute()
+    assert _check(results[-1].path) > 0
+
+
+def test_backup_falls_back_to_single_step(live_db, tmp_path, monkeypatch):
+
+    monkeypatch.setattr(backup, "MAX_RESTARTS", 0)
+    other = SqliteDatabase(live_db.database)
+
+    def progress(copied, total):
+        # Writes by another connection restart the backup
+        other.execute_sql("UPDATE entity SET comment = 'y' WHERE id = 1")
+
+    result = backup.backup_db(live_db,
+                              tmp_path / "backup.db",
+                              pages=1,
+                              progress=progress)
+    other.close()
+
+    assert result.restarts == 1
+    _check(result.path)
+
+
+def test_snapshots_are_rotated(live_db, tmp_path):
+
+    directory = tmp_path / "snapshots"
+    (directory).mkdir()
+    (directory / "notes.db").touch()
+
+    results = [
+        backup.snapshot_db(live_db, directory, "niviz.db", keep=2)
+        for _ in range(3)
+    ]
+    compacted = backup.snapshot_db(live_db,
+                                   directory,
+                                   "niviz.db",
+                                   keep=2,
+                                   vacuum=True)
+
+    assert results[2].removed == (results[0].path, )
+    assert compacted.removed == (results[1].path, )
+    assert backup.list_snapshots(directory, "niviz.db") == [
+        results[2].path, compacted.path
+    ]
+    assert (directory / "notes.db").exists()
+    _check(compacted.path)
+
+
+def test_restore(live_db, tmp_path):
+
+    result = backup.backup_db(live_db, tmp_path / "backup.db")
+    with live_db.bind_ctx(models.DB_TABLES):
+        models.Entity.update(rating=1).execute()
+
+        backup.restore_db(result.path, live_db)
+        assert models.Entity.select().where(
+            models.Entity.rating.is_null(False)).count() == 0
+
+    with pytest.raises(ValueError):
+        backup.restore_db(tmp_path / "missing.db", live_db)
+
+    not_a_db = tmp_path / "notes.db"
+    not_a_db.write_text("not a database " * 100)
+    with pytest.raises(ValueError):
+        backup.restore_db(not_a_db, live_db)
@@ -0,0 +1,183 @@
+import pytest
+from peewee import SqliteDatabase, fn
+
+import niviz_rater.db.merge as merge
+import niviz_rater.db.migrations as migrations
+import niviz_rater.db.models as models
+import niviz_rater.db.utils as dbutils
+
+ROWS = ["A", "B", "C"]
+COLUMNS = ["T1w", "bold"]
+
+
+def _make_db(path, rows=ROWS, ratings=("Pass", "Fail")):
+    db = SqliteDatabase(str(path), pragmas={'foreign_keys': 1})
+    with db.bind_ctx(models.DB_TABLES), db.atomic():
+        dbutils.initialize_tables(db, {"Ratings": list(ratings)})
+        component = models.Component.create(name="qc")
+        models.Annotation.create(name="Motion", component=component)
+        columns = [models.TableColumn.create(name=c) for c in COLUMNS]
+        for row_name in rows:
+            row = models.TableRow.create(name=row_name)
+            for column in columns:
+                models.Entity.create(name=f"{row_name} {column.name}",
+                                     rowname=row,
+                                     columnname=column,
+                                     component=component)
+    return db
+
+
+def _entity(row, column):
+    return (models.Entity.select().join_from(
+        models.Entity, models.TableRow).join_from(
+            models.Entity, models.TableColumn).where(
+                (models.TableRow.name == row)
+                & (models.TableColumn.name == column)).get())
+
+
+def _rate(db, row, column, rating=None, modified=None, comment="",
+          rater=None):
+    with db.bind_ctx(models.DB_TABLES):
+        entity = _entity(row, column)
+        rating = models.Rating.get(
+            models.Rating.name == rating) if rating else None
+        if rater is None:
+            models.Entity.update(rating=rating,
+                                 comment=comment,
+                                 modified=modified).where(
+                                     models.Entity.id == entity.id).execute()
+        else:
+            models.RaterRating.create(
+                rater=models.Rater.get_or_create(name=rater)[0],
+                entity=entity,
+                rating=rating,
+                comment=comment,
+                modified=modified)
+
+
+def _ratings(db):
+    with db.bind_ctx(models.DB_TABLES):
+        return {
+            e.name: (e.rating.name if e.rating else None, e.comment)
+            for e in models.Entity.select()
+        }
+
+
+@pytest.fixture
+def dbs(tmp_path):
+    target = _make_db(tmp_path / "target.db")
+    source = _make_db(tmp_path / "site2.db", rows=ROWS + ["D"])
+
+    _rate(target, "A", "T1w", "Pass", modified=1)
+    _rate(target, "B", "bold", "Pass", modified=5)
+    _rate(source, "A", "T1w", "Fail", modified=2)
+    _rate(source, "B", "T1w", "Pass", modified=1)
+    _rate(source, "B", "bold", "Fail", modified=3)
+    _rate(source, "C", "bold", comment="Check again", modified=4)
+    _rate(source, "D", "T1w", "Pass", modified=1)
+    source.close()
+
+    yield target, tmp_path / "site2.db"
+    target.close()
+
+
+def test_merge_newest(dbs):
+
+    target, source = dbs
+    with target.bind_ctx(models.DB_TABLES):
+        result = merge.merge_db(target, source, "newest")
+
+    assert result == merge.MergeResult(matched=6,
+                                       unmatched=2,
+                                       updated=3,
+                                       kept=1,
+                                       rater_ratings=0)
+    ratings = _ratings(target)
+    assert ratings["A T1w"] == ("Fail", "")
+    assert ratings["B T1w"] == ("Pass", "")
+    assert ratings["B bold"] == ("Pass", "")
+    assert ratings["C bold"] == (None, "Check again")
+
+    with target.bind_ctx(models.DB_TABLES):
+        entity = _entity("A", "T1w")
+        assert (entity.version, entity.modified) == (1, 2)
+
+        # Progress counters follow the merged ratings
+        Entity = models.Entity
+        counted = Entity.select(
+            fn.COUNT(Entity.id)).where(Entity.rating.is_null()).scalar()
+        unrated = models.RatingCount.select(fn.SUM(
+            models.RatingCount.count)).where(
+                models.RatingCount.rating == 0).scalar()
+        assert unrated == counted == 3
+
+
+def test_merge_prefer_rated(dbs):
+
+    target, source = dbs
+    with target.bind_ctx(models.DB_TABLES):
+        result = merge.merge_db(target, source, "prefer-rated")
+
+    assert (result.updated, result.kept) == (1, 3)
+    ratings = _ratings(target)
+    assert ratings["A T1w"] == ("Pass", "")
+    assert ratings["B T1w"] == ("Pass", "")
+    assert ratings["C bold"] == (None, "")
+
+
+def test_merge_keep_both(dbs):
+
+    target, source = dbs
+    _rate(target, "A", "bold", "Fail", modified=1, rater="r1")
+    source_db = SqliteDatabase(str(source))
+    _rate(source_db, "A", "bold", "Pass", modified=2, rater="r1")
+    _rate(source_db, "C", "T1w", "Pass", modified=2, rater="r2")
+    source_db.close()
+
+    before = _ratings(target)
+    with target.bind_ctx(models.DB_TABLES):
+        result = merge.merge_db(target, source, "keep-both")
+
+        assert _ratings(target) == before
+        assert (result.updated, result.rater_ratings) == (0, 6)
+
+        rater_ratings = {(r.rater.name, r.entity.name):
+                         (r.rating.name if r.rating else None, r.version)
+                         for r in models.RaterRating.select()}
+    assert rater_ratings == {
+        ("site2", "A T1w"): ("Fail", 1),
+        ("site2", "B T1w"): ("Pass", 1),
+        ("site2", "B bold"): ("Fail", 1),
+        ("site2", "C bold"): (None, 1),
+        ("r1", "A bold"): ("Pass", 1),
+        ("r2", "C T1w"): ("Pass", 1),
+    }
+
+
+def test_merge_adds_missing_ratings(tmp_path):
+
+    target = _make_db(tmp_path / "target.db")
+    source = _make_db(tmp_path / "source.db", ratings=("Pass", "Maybe"))
+    _rate(source, "A", "T1w", "Maybe", modified=1)
+    source.close()
+
+    with target.bind_ctx(models.DB_TABLES):
+        merge.merge_db(target, tmp_path / "source.db")
+    assert _ratings(target)["A T1w"] == ("Maybe", "")
+
+
+def test_merge_rejects_invalid_sources(dbs, tmp_path):
+
+    target, source = dbs
+    with pytest.raises(ValueError):
+        merge.merge_db(target, source, "oldest")
+    with pytest.raises(ValueError):
+        merge.merge_db(target, tmp_path / "missing.db")
+
+    old = SqliteDatabase(str(source))
+    migrations.set_version(old, migrations.SCHEMA_VERSION - 1)
+    old.close()
+    with pytest.raises(ValueError):
+        merge.merge_db(target, source)
+    assert target.execute_sql("PRAGMA database_list").fetchall()[-1][1] \
+        == "main"
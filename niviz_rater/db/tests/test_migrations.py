@@ -0,0 +1,158 @@
+import pytest
+
+import niviz_rater.db.models as models
+import niviz_rater.db.migrations as migrations
+import niviz_rater.db.utils as dbutils
+
+LEGACY_SCHEMA = [
+    'CREATE TABLE "component" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "annotation" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL, "component_id" INTEGER NOT NULL)',
+    'CREATE TABLE "rating" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "tablecolumn" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "tablerow" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "entity" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL, "columnname_id" INTEGER NOT NULL, '
+    '"rowname_id" INTEGER NOT NULL, "component_id" INTEGER NOT NULL, '
+    '"comment" TEXT NOT NULL, "rating_id" INTEGER, "annotation_id" INTEGER)',
+    'CREATE TABLE "image" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"path" TEXT NOT NULL, "entity_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("entity_id") REFERENCES "entity" ("id"))',
+    'CREATE UNIQUE INDEX "image_path" ON "image" ("path")',
+    'CREATE INDEX "image_entity_id" ON "image" ("entity_id")',
+    'CREATE UNIQUE INDEX "image_path_entity_id" ON "image" '
+    '("path", "entity_id")',
+]
+
+
+@pytest.fixture
+def legacy_db(db):
+    for statement in LEGACY_SCHEMA:
+        db.execute_sql(statement)
+
+    db.execute_sql("INSERT INTO component VALUES (1, 'c')")
+    db.execute_sql("INSERT INTO tablecolumn VALUES (1, 'col')")
+    db.execute_sql("INSERT INTO tablerow VALUES (1, 'row')")
+    db.execute_sql(
+        "INSERT INTO entity VALUES (1, 'e', 1, 1, 1, '', NULL, NULL)")
+    for i, path in enumerate([
+            "/data/qc/sub-A/figures/a.svg", "/data/qc/sub-A/figures/b.svg",
+            "/data/qc/c.svg"
+    ],
+                             start=1):
+        db.execute_sql("INSERT INTO image VALUES (?, ?, 1)", (i, path))
+    return db
+
+
+def test_new_database_does_not_need_migration(db):
+
+    dbutils.initialize_tables(db, {})
+    assert not migrations.needs_migration(db)
+
+
+def test_legacy_database_is_initialized_but_needs_migration(legacy_db):
+
+    assert dbutils.is_initialized(legacy_db)
+    assert migrations.needs_migration(legacy_db)
+
+
+def test_migration_stores_relative_image_paths(legacy_db):
+
+    version = migrations.migrate(legacy_db, base_path="/data/qc")
+
+    assert version == migrations.SCHEMA_VERSION
+    assert not migrations.needs_migration(legacy_db)
+
+    entity = models.Entity.get_by_id(1)
+    paths = [i.path for i in entity.images.order_by(models.Image.id)]
+    assert paths == ["sub-A/figures/a.svg", "sub-A/figures/b.svg", "c.svg"]
+    assert models.ImageDirectory.select().count() == 2
+    assert "image_old" not in legacy_db.get_tables()
+
+
+def test_migration_requires_base_path(legacy_db):
+
+    assert migrations.needs_base_path(legacy_db)
+    with pytest.raises(ValueError):
+        migrations.migrate(legacy_db)
+
+    assert migrations.needs_migration(legacy_db)
+    assert "image" in legacy_db.get_tables()
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+    migrations.set_version(legacy_db, migrations.SCHEMA_VERSION - 1)
+    assert not migrations.needs_base_path(legacy_db)
+    assert migrations.migrate(legacy_db) == migrations.SCHEMA_VERSION
+
+
+def test_migration_adds_work_queue(legacy_db):
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+
+    assert "lease" in legacy_db.get_tables()
+    indexes = {i.name for i in legacy_db.get_indexes("entity")}
+    assert {
+        "entity_columnname_id_rating_id_id", "entity_component_id_rating_id_id"
+    } <= indexes
+
+
+def test_migration_indexes_row_names(legacy_db):
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+
+    assert "tablerow_name" in {
+        i.name
+        for i in legacy_db.get_indexes("tablerow")
+    }
+
+
+def test_migration_adds_raters(legacy_db):
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+
+    assert {"rater", "raterrating"} <= set(legacy_db.get_tables())
+
+
+def test_migration_adds_progress_counters(legacy_db):
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+
+    assert list(models.RatingCount.select().tuples()) == [(1, 1, 0, 1)]
+    assert list(models.RowProgress.select().tuples()) == [(1, 1, 1)]
+
+    legacy_db.execute_sql("INSERT INTO rating VALUES (1, 'Pass')")
+    legacy_db.execute_sql("UPDATE entity SET rating_id = 1 WHERE id = 1")
+
+    assert list(models.RatingCount.select().tuples()) == [(1, 1, 0, 0),
+                                                          (1, 1, 1, 1)]
+    assert list(models.RowProgress.select().tuples()) == [(1, 1, 0)]
+
+
+def test_migration_adds_modified_times(legacy_db):
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+
+    for table in ("entity", "raterrating"):
+        assert "modified" in {c.name for c in legacy_db.get_columns(table)}
+
+
+def test_migration_adds_rating_history(legacy_db):
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+    assert not models.RatingHistory.select().exists()
+
+    legacy_db.execute_sql("UPDATE entity SET comment = 'x' WHERE id = 1")
+    assert models.RatingHistory.select(
+        models.RatingHistory.entity, models.RatingHistory.old_comment,
+        models.RatingHistory.comment).tuples().get() == (1, '', 'x')
+
+
+def test_migration_adds_rater_events(legacy_db):
+
+    migrations.migrate(legacy_db, base_path="/data/qc")
+
+    assert "raterevent" in legacy_db.get_tables()
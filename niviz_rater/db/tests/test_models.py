@@ -60,17 +60,41 @@ def test_entity_add_image_updates_db(configured_db):
     db, settings, _ = configured_db
 
     entity = models.Entity.get_by_id(1)
-    image_path = Path("/this/is/a/path")
+    image_path = Path("this/is/a/path")
     with db.atomic():
         entity.add_image(image_path)
 
-    img = models.Image.get((models.Image.path == str(image_path))
-                           & (models.Image.entity == entity))
+    img = models.Image.select().join(models.ImageDirectory).where(
+        (models.ImageDirectory.path == "this/is/a/")
+        & (models.Image.name == "path")
+        & (models.Image.entity == entity)).get()
 
     assert img.path == str(image_path)
     assert img.entity == entity
 
 
+def test_images_in_same_directory_share_directory(configured_db):
+
+    db, settings, _ = configured_db
+
+    entity = models.Entity.get_by_id(1)
+    with db.atomic():
+        image1 = entity.add_image(Path("sub-A/figures/a.svg"))
+        image2 = entity.add_image(Path("sub-A/figures/b.svg"))
+        image3 = entity.add_image(Path("c.svg"))
+
+    assert image1.directory == image2.directory
+    assert image3.directory.path == ""
+    assert models.ImageDirectory.select().count() == 2
+
+
+def test_split_image_path_keeps_trailing_separator():
+
+    assert models.split_image_path("a/b/c.svg") == ("a/b/", "c.svg")
+    assert models.split_image_path("c.svg") == ("", "c.svg")
+    assert models.split_image_path("/c.svg") == ("/", "c.svg")
+
+
 def test_adding_same_image_to_entity_returns_same_image(configured_db):
 
     db, settings, _ = configured_db
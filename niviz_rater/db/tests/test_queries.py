@@ -74,6 +74,8 @@ def test_get_denormalized_by_id_returns_fully_populated_entity(configured_db):
     db, settings, foreign_keys = configured_db
 
     e2 = _create_entity_column("anentity", "acolumnname", foreign_keys)
+    e2.add_image("sub-A/a.svg")
+    e2.add_image("sub-A/b.svg")
     rating = models.Rating.get_by_id(1)
     _create_entity_column("anotherentity", "anothercolumnname", foreign_keys,
                           rating)
@@ -92,9 +94,10 @@ def test_get_denormalized_by_id_returns_fully_populated_entity(configured_db):
         if result.rating:
             result.rating.name
 
-        [i.path for i in result.images]
+        images = [i.path for i in result.images]
 
     assert counter.count == 0
+    assert images == ["sub-A/a.svg", "sub-A/b.svg"]
 
 
 def test_get_available_annotations(configured_db):
@@ -1,3 +1,5 @@
+import pytest
+from peewee import OperationalError
 from string import Template
 import niviz_rater.db.models as models
 import niviz_rater.db.utils as dbutils
@@ -155,3 +157,53 @@ def component_entities_to_db_correctly_inserts_records(db):
         .join(models.Component) \
         .where(models.Component.name == component_name)
     assert len(annotations) == 3
+
+
+def test_read_only_db_rejects_writes(tmp_path):
+
+    db_file = tmp_path / "niviz.db"
+    db = dbutils.get_or_create_db(str(db_file))
+    with db.bind_ctx(models.DB_TABLES):
+        dbutils.initialize_tables(db, {})
+    db.close()
+
+    read_only = dbutils.get_read_only_db(db_file)
+    with read_only.bind_ctx(models.DB_TABLES):
+        assert dbutils.is_initialized(read_only)
+        with pytest.raises(OperationalError):
+            models.Rating.create(name="new")
+    read_only.close()
+
+
+def test_snapshot_db_copies_database(tmp_path):
+
+    db = dbutils.get_or_create_db(str(tmp_path / "niviz.db"))
+    with db.bind_ctx(models.DB_TABLES):
+        dbutils.initialize_tables(db, {"Ratings": ["A", "B"]})
+
+    snapshot = dbutils.snapshot_db(db, tmp_path / "snapshot.db")
+    with db.bind_ctx(models.DB_TABLES):
+        models.Rating.create(name="C")
+
+    with snapshot.bind_ctx(models.DB_TABLES):
+        assert [r.name for r in models.Rating.select()] == ["A", "B"]
+    snapshot.close()
+    db.close()
+
+
+def test_immutable_db_requires_checkpointed_wal(tmp_path):
+
+    db_file = tmp_path / "niviz.db"
+    db = dbutils.get_or_create_db(str(db_file), {'journal_mode': 'wal'})
+    with db.bind_ctx(models.DB_TABLES):
+        dbutils.initialize_tables(db, {})
+        assert dbutils.has_wal(db_file)
+    db.close()
+    assert not dbutils.has_wal(db_file)
+
+    immutable = dbutils.get_immutable_db(db_file)
+    with immutable.bind_ctx(models.DB_TABLES):
+        assert [r.name for r in models.Rating.select()]
+        with pytest.raises(OperationalError):
+            models.Rating.create(name="new")
+    immutable.close()
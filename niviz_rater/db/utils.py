@@ -1,11 +1,15 @@
 from __future__ import annotations
-from typing import Any, List, Optional, Dict, TYPE_CHECKING
+from typing import Any, Callable, List, Optional, Dict, TYPE_CHECKING
 import logging
-from peewee import SqliteDatabase
+import sqlite3
+import time
+from pathlib import Path
+from peewee import Database, Proxy, SqliteDatabase
 import niviz_rater.db.models as models
 import niviz_rater.db.exceptions as exceptions
 import niviz_rater.config.db_defaults as db_defaults
 import niviz_rater.db.queries as queries
+import niviz_rater.db.migrations as migrations
 from niviz_rater.spec import DBSettings
 
 if TYPE_CHECKING:
@@ -15,17 +19,145 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# SQLite's default upper limit on mmap_size, large enough to map most
+# databases in full
+IMMUTABLE_MMAP_SIZE = 0x7fff0000
+
+
+def _sqlite_db(db_str: str, pragmas: Dict[str, Any]) -> SqliteDatabase:
+    return SqliteDatabase(db_str,
+                          pragmas={
+                              'foreign_keys': 1,
+                              **pragmas
+                          },
+                          uri=True)
+
 
 def get_or_create_db(
         db_str: str,
         additional_pragmas: Dict[str, Any] = None) -> SqliteDatabase:
+    """
+    Open a database for writing in write-ahead log mode, so that long
+    reads such as exports do not block raters' saves and saves do not
+    block reads
+    """
 
-    pragmas = {'foreign_keys': 1}
+    pragmas = {'journal_mode': 'wal'}
     if additional_pragmas:
         pragmas.update(additional_pragmas)
 
-    sqlite_db = SqliteDatabase(db_str, pragmas=pragmas, uri=True)
-    return sqlite_db
+    return _sqlite_db(db_str, pragmas)
+
+
+def get_read_only_db(db_file: str) -> SqliteDatabase:
+    """
+    Open an existing database without write access
+    """
+
+    uri = f"{Path(db_file).resolve().as_uri()}?mode=ro"
+    return _sqlite_db(uri, {'query_only': 1})
+
+
+def get_immutable_db(db_file: str,
+                     mmap_size: int = IMMUTABLE_MMAP_SIZE) -> SqliteDatabase:
+    """
+    Open an existing database that no process will modify while it is
+    open. SQLite then takes no locks and keeps its page cache between
+    transactions, so concurrent readers never contend
+
+    A write-ahead log is ignored when the DB is immutable, so any
+    changes still in the log are not seen
+
+    Arguments:
+        mmap_size: Maximum number of bytes of the DB file memory-mapped
+            by each connection
+    """
+
+    uri = f"{Path(db_file).resolve().as_uri()}?mode=ro&immutable=1"
+    return _sqlite_db(uri, {'query_only': 1, 'mmap_size': mmap_size})
+
+
+def has_wal(db_file: str) -> bool:
+    """
+    Check whether a database has changes in a write-ahead log that have
+    not been checkpointed, as when it is in use
+    """
+
+    wal = Path(f"{db_file}-wal")
+    return wal.exists() and wal.stat().st_size > 0
+
+
+def snapshot_db(db: SqliteDatabase, snapshot_file: str) -> SqliteDatabase:
+    """
+    Copy `db` to `snapshot_file` using the SQLite backup API and return
+    the copy opened without write access
+
+    The copy is made in a single step so `db` is only locked for the
+    duration of the copy, rather than for as long as the snapshot is read
+    """
+
+    destination = SqliteDatabase(str(snapshot_file))
+    with destination.connection_context():
+        db.connection().backup(destination.connection())
+    return get_read_only_db(snapshot_file)
+
+
+StatementHook = Callable[[str, float], Any]
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """
+    Cursor calling statement hooks for executemany, which does not go
+    through Database.execute_sql
+    """
+
+    hooks: List[StatementHook] = []
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            seconds = time.perf_counter() - start
+            for statement_hook in self.hooks:
+                statement_hook(sql, seconds)
+
+
+def add_statement_hook(db: Database, hook: StatementHook) -> None:
+    """
+    Call `hook` with the SQL and duration in seconds of every statement
+    executed on `db`, including statements that fail. A statement run
+    with executemany is reported once. Hooks run on the thread
+    executing the statement, so should be cheap
+
+    Arguments:
+        db: Database or proxy of the database to time
+    """
+
+    if isinstance(db, Proxy):
+        db = db.obj
+    hooks = db.__dict__.get('_statement_hooks')
+    if hooks is None:
+        hooks = db._statement_hooks = []
+        execute_sql = db.execute_sql
+
+        def timed_execute_sql(sql, params=None, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return execute_sql(sql, params, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                for statement_hook in hooks:
+                    statement_hook(sql, seconds)
+
+        def timed_cursor(*args, **kwargs):
+            cursor = db.connection().cursor(_TimedCursor)
+            cursor.hooks = hooks
+            return cursor
+
+        db.execute_sql = timed_execute_sql
+        db.cursor = timed_cursor
+    hooks.append(hook)
 
 
 def fetch_db_from_config(app_config,
@@ -57,7 +189,11 @@ def add_ratings(db: SqliteDatabase, settings: DBSettings) -> SqliteDatabase:
 
 
 def is_initialized(db: SqliteDatabase):
-    return set(db.get_tables()) == set(models.DB_TABLE_NAMES)
+    """
+    Check whether DB tables exist, tables added by migrations
+    may not exist if the DB requires migration
+    """
+    return set(db.get_tables()).issuperset(migrations.BASE_TABLE_NAMES)
 
 
 def initialize_tables(db: SqliteDatabase,
@@ -72,6 +208,9 @@ def initialize_tables(db: SqliteDatabase,
         raise exceptions.IsInitialized
 
     db.create_tables(models.DB_TABLES)
+    for trigger in models.PROGRESS_TRIGGERS + models.HISTORY_TRIGGERS:
+        db.execute_sql(trigger)
+    migrations.set_version(db, migrations.SCHEMA_VERSION)
     db = add_ratings(db, settings)
 
     return db
@@ -104,6 +243,8 @@ def create_or_update_entity(db: SqliteDatabase,
                 logger.info("`reset_on_update` set!\n"
                             "Undoing QC for Entity")
                 entity.remove_qc()
+                entity.modified = time.time()
+            entity.version += 1
             entity.save()
 
     else:
@@ -114,15 +255,20 @@ def create_or_update_entity(db: SqliteDatabase,
 def component_entities_to_db(db: SqliteDatabase,
                              component_entities: ComponentEntities,
                              update_existing: bool = False,
-                             reset_on_update: bool = True):
+                             reset_on_update: bool = True,
+                             base_path: Optional[str] = None):
     """
     Add component with entities to DB, skip adding existing components
 
     Options:
         update_existing: Causes already existing entities to be updated
         reset_on_update: Undo an existing entity's QC rating
+        base_path: Store image paths relative to `base_path`
     """
 
+    if base_path is not None:
+        component_entities = component_entities.relative_to(base_path)
+
     # Create component
     component, _ = models.Component.get_or_create(
         name=component_entities.component_name)
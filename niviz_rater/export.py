@@ -0,0 +1,381 @@
+"""
+Streaming export of QC ratings to a participants.tsv spreadsheet, or
+to compressed, long-format and columnar equivalents
+"""
+
+from __future__ import annotations
+from typing import (Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Tuple, Union)
+from itertools import groupby
+from operator import itemgetter
+import json
+import zlib
+
+import niviz_rater.db.queries as queries
+from niviz_rater.db.models import (Annotation, Component, Rater, Rating,
+                                   TableColumn)
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Number of spreadsheet rows yielded per chunk
+CHUNK_ROWS = 1000
+
+# Approximate number of cells per Parquet row group/Arrow record batch
+BATCH_CELLS = 1 << 18
+
+EMPTY = ("", "", "")
+
+
+def _entry(annotation, rating, comment) -> Tuple[str, str, str]:
+    """
+    Spreadsheet cells (annotation, rating, comment) of a single Entity
+    """
+    return (annotation or "", rating or "", comment.replace("\n", "\\n")
+            or "")
+
+
+def _raw_entry(annotation, rating, comment) -> Tuple[str, str, str]:
+    """
+    Unescaped cells of a single Entity for formats that support newlines
+    """
+    return (annotation or "", rating or "", comment or "")
+
+
+def _header_names(columns: List[TableColumn]) -> List[str]:
+    names = ["subjects"]
+    for c in columns:
+        names.extend((c.name, f"{c.name}_passfail", f"{c.name}_comment"))
+    return names
+
+
+def _header(columns: List[TableColumn]) -> str:
+    return "\t".join(_header_names(columns))
+
+
+def _make_row(row_name,
+              entries: Iterable[tuple],
+              columns: List[TableColumn],
+              entry_cells: Callable[..., tuple] = _entry) -> List[str]:
+    """
+    Merge (column_id, annotation, rating, comment) entries of a row,
+    ordered by column, against `columns` filling in missing cells
+    """
+    entries = iter(entries)
+    entry = next(entries, None)
+    cells = [row_name if row_name is not None else '']
+    for c in columns:
+        if entry is not None and entry[0] == c.id:
+            cells.extend(entry_cells(*entry[1:]))
+            entry = next(entries, None)
+        else:
+            cells.extend(EMPTY)
+
+    return cells
+
+
+def _rows(records: Iterable[tuple],
+          columns: List[TableColumn],
+          entry_cells: Callable[..., tuple] = _entry) -> Iterator[List[str]]:
+    for (_, row_name), group in groupby(records, key=itemgetter(0, 1)):
+        yield _make_row(row_name, (r[2:] for r in group if r[2] is not None),
+                        columns, entry_cells)
+
+
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def resolve_selection(
+    columns: Optional[List[str]] = None,
+    component: Optional[str] = None
+) -> Tuple[List[TableColumn], Optional[Component]]:
+    """
+    Look up the TableColumns and Component to export
+
+    Raises:
+        ValueError: If any of `columns` or `component` do not exist
+    """
+
+    component_model = None
+    if component is not None:
+        try:
+            component_model = queries.get_component(component)
+        except Component.DoesNotExist:
+            raise ValueError(f"Unknown component {component}")
+
+    selected = list(queries.get_columns(columns, component_model))
+    if columns is not None:
+        missing = set(columns) - {c.name for c in selected}
+        if missing:
+            raise ValueError(f"Unknown columns {', '.join(sorted(missing))}")
+
+    return selected, component_model
+
+
+class Selection(NamedTuple):
+    """
+    Resolved columns and component of an export
+    """
+    columns: List[TableColumn]
+    column_ids: Optional[List[int]]
+    component: Optional[Component]
+    rater: Optional[Rater] = None
+
+    def cells(self) -> Iterator[tuple]:
+        return queries.get_export_cells(self.column_ids, self.component,
+                                        self.rater)
+
+
+def _iter_tsv(selection: Selection, chunk_rows: int) -> Iterator[str]:
+
+    yield _header(selection.columns)
+
+    rows = _rows(selection.cells(), selection.columns)
+    for chunk in _batches(rows, chunk_rows):
+        yield "\n" + "\n".join("\t".join(r) for r in chunk)
+
+
+def _iter_tsv_gz(selection: Selection, chunk_rows: int) -> Iterator[bytes]:
+    """
+    Gzip compress the TSV stream as it is produced
+    """
+
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in _iter_tsv(selection, chunk_rows):
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _iter_jsonl(selection: Selection, chunk_rows: int) -> Iterator[str]:
+    """
+    Long format, one JSON object per Entity, including unrated Entities
+    whose rating is null
+    """
+
+    names = {c.id: c.name for c in selection.columns}
+    records = (json.dumps({
+        "row": row_name,
+        "column": names[column_id],
+        "annotation": annotation,
+        "rating": rating,
+        "comment": comment
+    }) for _, row_name, column_id, annotation, rating, comment in
+               selection.cells() if column_id is not None)
+
+    for chunk in _batches(records, chunk_rows):
+        yield "\n".join(chunk) + "\n"
+
+
+class _Sink:
+    """
+    Writable file collecting bytes written by pyarrow until drained
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _record_batches(selection: Selection, batch_rows: int):
+    schema = pyarrow.schema([(name, pyarrow.string())
+                             for name in _header_names(selection.columns)])
+    rows = _rows(selection.cells(), selection.columns, _raw_entry)
+    batches = (pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(cells, pyarrow.string()) for cells in zip(*batch)],
+        schema=schema) for batch in _batches(rows, batch_rows))
+    return schema, batches
+
+
+def _iter_arrow(selection: Selection, chunk_rows: int) -> Iterator[bytes]:
+    """
+    Arrow IPC stream with one record batch per `chunk_rows` rows
+    """
+
+    schema, batches = _record_batches(selection, chunk_rows)
+    sink = _Sink()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _iter_parquet(selection: Selection, chunk_rows: int) -> Iterator[bytes]:
+    """
+    Parquet file with one row group per `chunk_rows` rows
+    """
+
+    schema, batches = _record_batches(selection, chunk_rows)
+    sink = _Sink()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch, row_group_size=chunk_rows)
+            yield sink.drain()
+    yield sink.drain()
+
+
+class ExportFormat(NamedTuple):
+    content_type: str
+    filename: str
+    binary: bool
+    write: Callable[[Selection, int], Iterator[Union[str, bytes]]]
+    chunk_rows: Optional[int] = CHUNK_ROWS
+
+
+FORMATS: Dict[str, ExportFormat] = {
+    "tsv":
+    ExportFormat('text/tab-separated-values; charset=utf-8',
+                 "participants.tsv", False, _iter_tsv),
+    "tsv.gz":
+    ExportFormat('application/gzip', "participants.tsv.gz", True,
+                 _iter_tsv_gz),
+    "jsonl":
+    ExportFormat('application/x-ndjson; charset=utf-8', "participants.jsonl",
+                 False, _iter_jsonl),
+}
+
+if pyarrow is not None:
+    FORMATS.update({
+        "parquet":
+        ExportFormat('application/vnd.apache.parquet',
+                     "participants.parquet", True, _iter_parquet, None),
+        "arrow":
+        ExportFormat('application/vnd.apache.arrow.stream',
+                     "participants.arrow", True, _iter_arrow, None),
+    })
+
+
+def get_format(name: str) -> ExportFormat:
+    """
+    Raises:
+        ValueError: If `name` is not an available export format
+    """
+    try:
+        return FORMATS[name]
+    except KeyError:
+        raise ValueError(f"Unknown export format {name}, available formats "
+                         f"are {', '.join(FORMATS)}")
+
+
+def iter_export(fmt: str = "tsv",
+                columns: Optional[List[str]] = None,
+                component: Optional[str] = None,
+                chunk_rows: Optional[int] = None,
+                rater: Optional[str] = None) -> Iterator[Union[str, bytes]]:
+    """
+    Stream ratings in export format `fmt`, rows are read from a DB
+    cursor and written in chunks of `chunk_rows` rows so memory use is
+    independent of DB size
+
+    Arguments:
+        fmt: Name of an export format in FORMATS
+        columns: Only export these columns
+        component: Only export columns of this component
+        chunk_rows: Rows per chunk, defaults to the format's chunk size
+            or BATCH_CELLS cells for columnar formats
+        rater: Export ratings of this Rater instead of the default rater
+
+    Raises:
+        ValueError: If `fmt`, any of `columns`, `component` or `rater`
+            do not exist
+    """
+
+    export_format = get_format(fmt)
+    selected, component_model = resolve_selection(columns, component)
+    rater_model = None
+    if rater is not None:
+        rater_model = queries.get_rater(rater)
+        if rater_model.id is None:
+            raise ValueError(f"Unknown rater {rater}")
+    column_ids = [c.id for c in selected] if columns is not None else None
+    chunk_rows = chunk_rows or export_format.chunk_rows or max(
+        1, BATCH_CELLS // (1 + 3 * len(selected)))
+    return export_format.write(
+        Selection(selected, column_ids, component_model, rater_model),
+        chunk_rows)
+
+
+def iter_tsv(columns: Optional[List[str]] = None,
+             component: Optional[str] = None,
+             chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    """
+    Stream participants.tsv in chunks of `chunk_rows` rows
+
+    Raises:
+        ValueError: If any of `columns` or `component` do not exist
+    """
+
+    return iter_export("tsv", columns, component, chunk_rows)
+
+
+def iter_history(since: Optional[float] = None,
+                 chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    """
+    Stream changes to ratings made at or after `since`, in seconds
+    since the epoch, as JSON Lines in order of time. Unchanged comments
+    are null. Changes are identified by their `id`, so an incremental
+    export can pass the time of the last change it received and skip
+    changes it has already seen
+    """
+
+    ratings = {r.id: r.name for r in Rating.select()}
+    annotations = {a.id: a.name for a in Annotation.select()}
+    raters = {r.id: r.name for r in queries.get_raters()}
+
+    records = (json.dumps({
+        "id": change_id,
+        "time": time,
+        "rater": raters.get(rater_id),
+        "entity": entity_id,
+        "name": name,
+        "row": row_name,
+        "column": column_name,
+        "version": version,
+        "old": {
+            "rating": ratings.get(old_rating),
+            "annotation": annotations.get(old_annotation),
+            "comment": old_comment
+        },
+        "new": {
+            "rating": ratings.get(rating),
+            "annotation": annotations.get(annotation),
+            "comment": comment
+        },
+        "undoes": undoes
+    }) for (change_id, time, rater_id, entity_id, name, row_name,
+            column_name, version, old_rating, old_annotation, rating,
+            annotation, old_comment, comment,
+            undoes) in queries.get_history(since))
+
+    for chunk in _batches(records, chunk_rows):
+        yield "\n".join(chunk) + "\n"
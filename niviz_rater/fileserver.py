@@ -0,0 +1,225 @@
+"""
+Background fileserver for QC images with support for serving
+pre-compressed copies of large text-based images (i.e SVG reportlets)
+"""
+
+from __future__ import annotations
+from typing import BinaryIO, Iterable, List, Optional
+from pathlib import Path
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from threading import Thread
+from functools import partial
+import gzip
+import logging
+import os
+import shutil
+
+from niviz_rater.cache import FileCache, PathLike
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Image types which benefit from compression, rasters are already compressed
+COMPRESSIBLE_SUFFIXES = {".svg", ".html", ".htm", ".json", ".txt"}
+
+# Supported Content-Encodings in order of preference
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+# Compression levels used when pre-compressing images at initialize_db
+# or update_db time, slow but giving the smallest files
+PRECOMPRESS_LEVELS = {"gzip": 9, "br": 11}
+
+# Compression levels used when an image is compressed on first request
+FAST_LEVELS = {"gzip": 6, "br": 4}
+
+# Bytes read from an image at a time while compressing it
+CHUNK_SIZE = 1024 * 1024
+
+
+def compress_file(source: BinaryIO,
+                  destination: BinaryIO,
+                  encoding: str,
+                  level: int) -> None:
+    """
+    Stream `source` to `destination` compressed with `encoding` at
+    compression `level` (gzip level or brotli quality)
+    """
+
+    if encoding == "gzip":
+        with gzip.GzipFile(fileobj=destination,
+                           mode="wb",
+                           compresslevel=level,
+                           mtime=0) as f:
+            shutil.copyfileobj(source, f, CHUNK_SIZE)
+    elif encoding == "br" and brotli is not None:
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=level)
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            destination.write(compressor.process(chunk))
+        destination.write(compressor.finish())
+    else:
+        raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def is_compressible(path: PathLike) -> bool:
+    return Path(path).suffix.lower() in COMPRESSIBLE_SUFFIXES
+
+
+def get_compressed(cache: FileCache,
+                   path: PathLike,
+                   encoding: str,
+                   create: bool = True,
+                   fast: bool = True) -> Optional[Path]:
+    """
+    Fetch `encoding` compressed copy of `path` from `cache`, if
+    `create` then compress and store on a cache miss
+
+    Arguments:
+        fast: Compress with FAST_LEVELS, as when compressing on request,
+            rather than PRECOMPRESS_LEVELS
+    """
+
+    entry = cache.get(path, encoding)
+    if entry is not None or not create:
+        return entry
+
+    levels = FAST_LEVELS if fast else PRECOMPRESS_LEVELS
+    try:
+        with open(path, "rb") as source, \
+                cache.writer(path, encoding) as destination:
+            compress_file(source, destination, encoding, levels[encoding])
+    except FileNotFoundError:
+        return None
+    return cache.path_for(path, encoding)
+
+
+def precompress(cache: FileCache,
+                paths: Iterable[PathLike],
+                encodings: Optional[List[str]] = None) -> int:
+    """
+    Populate `cache` with compressed copies of compressible `paths`,
+    compressed at PRECOMPRESS_LEVELS
+
+    Returns:
+        n_compressed (int): Number of newly compressed files
+    """
+
+    encodings = encodings or ENCODINGS
+    n_compressed = 0
+    for path in paths:
+        if not is_compressible(path):
+            continue
+        for encoding in encodings:
+            if cache.get(path, encoding) is not None:
+                continue
+            if get_compressed(cache, path, encoding,
+                              fast=False) is not None:
+                n_compressed += 1
+    return n_compressed
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    """
+    Parse an Accept-Encoding header, returning supported encodings
+    in order of server preference
+    """
+
+    accepted = set()
+    for token in accept_encoding.split(","):
+        name, _, params = token.strip().partition(";")
+        name = name.strip().lower()
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name)
+
+    if "*" in accepted:
+        return list(ENCODINGS)
+    return [e for e in ENCODINGS if e in accepted]
+
+
+class CompressingRequestHandler(SimpleHTTPRequestHandler):
+    """
+    SimpleHTTPRequestHandler which serves compressed copies of
+    compressible files from a FileCache when the client accepts them
+    """
+
+    def __init__(self,
+                 *args,
+                 cache: Optional[FileCache] = None,
+                 log_requests: bool = True,
+                 **kwargs):
+        self.cache = cache
+        self.log_requests = log_requests
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        if self.log_requests:
+            super().log_message(format, *args)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if (self.cache is None or not is_compressible(path)
+                or not os.path.isfile(path)):
+            return super().send_head()
+
+        for encoding in accepted_encodings(
+                self.headers.get("Accept-Encoding", "")):
+            entry = get_compressed(self.cache, path, encoding)
+            if entry is not None:
+                break
+        else:
+            return super().send_head()
+
+        try:
+            f = open(entry, "rb")
+        except OSError:
+            return super().send_head()
+
+        self.send_response(200)
+        self.send_header("Content-type", self.guess_type(path))
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Last-Modified",
+                         self.date_time_string(os.stat(path).st_mtime))
+        self.end_headers()
+        return f
+
+
+def launch_fileserver(base_directory,
+                      port=5002,
+                      hostname='localhost',
+                      cache: Optional[FileCache] = None,
+                      log_requests: bool = True):
+    """
+    Launch background TCP server at `base_directory`, if a `cache`
+    is provided compressible images are served compressed
+    """
+    path = os.path.abspath(base_directory)
+    handler = partial(CompressingRequestHandler,
+                      directory=path,
+                      cache=cache,
+                      log_requests=log_requests)
+    httpd = ThreadingHTTPServer((hostname, port), handler)
+
+    address = f"http://{httpd.server_name}:{httpd.server_port}"
+
+    def serve(httpd):
+        with httpd:
+            logger.info(f"Creating server at {port}")
+            httpd.serve_forever()
+
+    thread = Thread(target=serve, args=(httpd, ))
+    thread.daemon = True
+    thread.start()
+
+    return httpd, address
@@ -0,0 +1,349 @@
+"""
+Bulk import of QC ratings from a participants.tsv spreadsheet in the
+layout written by the export
+"""
+
+from __future__ import annotations
+from typing import (Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Tuple)
+from itertools import islice
+
+import niviz_rater.db.queries as queries
+from niviz_rater.db.models import (Annotation, Entity, Rater, Rating,
+                                   TableColumn, TableRow)
+
+# Number of spreadsheet rows imported per transaction
+CHUNK_ROWS = 1000
+
+# Suffixes of the annotation, rating and comment cells of a column
+SUFFIXES = ("", "_passfail", "_comment")
+
+# Row names shared by several TableRows
+_AMBIGUOUS = -1
+
+
+class ImportIssue(NamedTuple):
+    """
+    Spreadsheet line or cell that could not be imported
+    """
+    line: int
+    column: str
+    message: str
+
+
+class Change(NamedTuple):
+    """
+    Changed (annotation, rating, comment) cells of an Entity, as
+    written by the export
+    """
+    line: int
+    row: str
+    column: str
+    old: Tuple[str, str, str]
+    new: Tuple[str, str, str]
+
+
+OnChange = Callable[[Change], None]
+
+
+class ImportResult(NamedTuple):
+    """
+    Attributes:
+        rows: Spreadsheet rows read
+        changed: Entities whose rating, annotation or comment changed
+        unchanged: Entities given the ratings they already had
+        issues: Lines and cells that could not be imported
+    """
+    rows: int
+    changed: int
+    unchanged: int
+    issues: List[ImportIssue]
+
+
+class _Names(NamedTuple):
+    """
+    In-memory maps resolving spreadsheet names to ids and back
+    """
+    rows: Dict[str, int]
+    ratings: Dict[str, int]
+    annotations: Dict[Tuple[int, str], int]
+    rating_names: Dict[int, str]
+    annotation_names: Dict[int, str]
+
+    @classmethod
+    def load(cls) -> _Names:
+        rows: Dict[str, int] = {}
+        for name, row_id in TableRow.select(TableRow.name,
+                                            TableRow.id).tuples():
+            rows[name] = _AMBIGUOUS if name in rows else row_id
+
+        ratings = dict(Rating.select(Rating.name, Rating.id).tuples())
+        annotations = {(component, name): annotation_id
+                       for annotation_id, component, name in Annotation.select(
+                           Annotation.id, Annotation.component,
+                           Annotation.name).tuples()}
+        rating_names = {v: k for k, v in ratings.items()}
+        annotation_names = {v: k[1] for k, v in annotations.items()}
+        return cls(rows, ratings, annotations, rating_names, annotation_names)
+
+    def cells(self, annotation_id: Optional[int], rating_id: Optional[int],
+              comment: str) -> Tuple[str, str, str]:
+        return (self.annotation_names.get(annotation_id, ""),
+                self.rating_names.get(rating_id, ""),
+                comment.replace("\n", "\\n"))
+
+
+def _split(line: str) -> List[str]:
+    return line.rstrip("\r\n").split("\t")
+
+
+def parse_header(
+    cells: List[str], columns: Dict[str, int]
+) -> Tuple[Dict[int, Tuple[str, List[Optional[int]]]], List[ImportIssue]]:
+    """
+    Locate the annotation, rating and comment cells of each TableColumn
+    in a spreadsheet header
+
+    Arguments:
+        cells: Header cells
+        columns: Mapping of TableColumn names to ids
+
+    Returns:
+        layout: Mapping of TableColumn ids to their name and the
+            indices of their (annotation, rating, comment) cells, None
+            for cells missing from the spreadsheet
+        issues: Unknown or duplicate header cells, which are ignored
+
+    Raises:
+        ValueError: If the first cell is not `subjects`
+    """
+
+    if not cells or cells[0] != "subjects":
+        raise ValueError("Expected a spreadsheet with a `subjects` column "
+                         "of row names first")
+
+    layout: Dict[int, Tuple[str, List[Optional[int]]]] = {}
+    issues = []
+    for index, cell in enumerate(cells[1:], 1):
+        found = None
+        if cell in columns:
+            found = (cell, 0)
+        else:
+            for field, suffix in enumerate(SUFFIXES[1:], 1):
+                name = cell[:-len(suffix)]
+                if cell.endswith(suffix) and name in columns:
+                    found = (name, field)
+                    break
+
+        if found is None:
+            issues.append(ImportIssue(1, cell, "Unknown column"))
+            continue
+
+        name, field = found
+        _, indices = layout.setdefault(columns[name],
+                                       (name, [None] * len(SUFFIXES)))
+        if indices[field] is not None:
+            issues.append(ImportIssue(1, cell, "Duplicate column"))
+            continue
+        indices[field] = index
+
+    return layout, issues
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Importer:
+    """
+    State of an import shared between chunks of spreadsheet rows
+    """
+
+    def __init__(self, layout, n_cells: int, names: _Names,
+                 rater: Optional[Rater], on_change: Optional[OnChange]):
+        self.layout = layout
+        self.n_cells = n_cells
+        self.names = names
+        self.rater = rater
+        self.on_change = on_change
+        self.seen = set()
+        self.rows = self.changed = self.unchanged = 0
+        self.issues: List[ImportIssue] = []
+
+    def _parse_rows(self, lines: List[Tuple[int, str]]) -> List[tuple]:
+        """
+        Resolve the row of each spreadsheet line
+
+        Returns:
+            rows: (line, row_name, row_id, cells) of valid lines
+        """
+
+        rows = []
+        for line, text in lines:
+            cells = _split(text)
+            if cells == [""]:
+                continue
+
+            self.rows += 1
+            if len(cells) != self.n_cells:
+                self.issues.append(
+                    ImportIssue(
+                        line, "", f"Expected {self.n_cells} cells, found "
+                        f"{len(cells)}"))
+                continue
+
+            row_id = self.names.rows.get(cells[0])
+            if row_id is None or row_id == _AMBIGUOUS:
+                reason = "Unknown" if row_id is None else "Ambiguous"
+                self.issues.append(
+                    ImportIssue(line, "subjects", f"{reason} row {cells[0]}"))
+                continue
+            if row_id in self.seen:
+                self.issues.append(
+                    ImportIssue(line, "subjects", f"Duplicate row {cells[0]}"))
+                continue
+
+            self.seen.add(row_id)
+            rows.append((line, cells[0], row_id, cells))
+        return rows
+
+    def _resolve(self, line: int, column: str, given: List[Optional[str]],
+                 state: tuple) -> Optional[tuple]:
+        """
+        New (annotation_id, rating_id, comment) of an Entity from the
+        `given` cells, cells missing from the spreadsheet are unchanged
+
+        Returns:
+            rating: New rating fields, None if any cell is invalid
+        """
+
+        _, component_id, *new = state
+        annotation, rating, comment = given
+        if annotation is not None:
+            new[0] = self.names.annotations.get((component_id, annotation))
+            if annotation and new[0] is None:
+                self.issues.append(
+                    ImportIssue(line, column, f"Unknown annotation "
+                                f"{annotation}"))
+                return None
+        if rating is not None:
+            new[1] = self.names.ratings.get(rating)
+            if rating and new[1] is None:
+                self.issues.append(
+                    ImportIssue(line, column + SUFFIXES[1],
+                                f"Unknown rating {rating}"))
+                return None
+        if comment is not None:
+            new[2] = comment.replace("\\n", "\n")
+        return tuple(new)
+
+    def import_chunk(self, lines: List[Tuple[int, str]]) -> List[tuple]:
+        """
+        Compare a chunk of spreadsheet lines to the DB
+
+        Returns:
+            ratings: (entity_id, annotation_id, rating_id, comment) of
+                changed Entities
+        """
+
+        rows = self._parse_rows(lines)
+        states = {(row_id, column_id): state
+                  for row_id, column_id, *state in queries.get_rating_states(
+                      [r[2] for r in rows], list(self.layout), self.rater)}
+
+        ratings = []
+        for line, row_name, row_id, cells in rows:
+            for column_id, (column, indices) in self.layout.items():
+                given = [cells[i] if i is not None else None for i in indices]
+                # Empty entries leave the Entity as is
+                if not any(given):
+                    continue
+
+                state = states.get((row_id, column_id))
+                if state is None:
+                    self.issues.append(
+                        ImportIssue(line, column, f"No image of row "
+                                    f"{row_name} in column {column}"))
+                    continue
+
+                new = self._resolve(line, column, given, state)
+                if new is None:
+                    continue
+                if new == tuple(state[2:]):
+                    self.unchanged += 1
+                    continue
+
+                self.changed += 1
+                ratings.append((state[0], *new))
+                if self.on_change is not None:
+                    self.on_change(
+                        Change(line, row_name, column,
+                               self.names.cells(*state[2:]),
+                               self.names.cells(*new)))
+        return ratings
+
+
+def import_tsv(lines: Iterable[str],
+               rater: Optional[str] = None,
+               dry_run: bool = False,
+               on_change: Optional[OnChange] = None,
+               chunk_rows: int = CHUNK_ROWS) -> ImportResult:
+    """
+    Import ratings from the lines of a participants.tsv spreadsheet,
+    streamed in chunks of `chunk_rows` rows that are each saved with a
+    single executemany statement in their own transaction
+
+    Names are resolved through in-memory maps. Entities with empty
+    cells, and cells missing from the spreadsheet, are left unchanged.
+    Invalid lines and cells are skipped and reported as issues
+
+    Arguments:
+        lines: Lines of the spreadsheet, starting with its header
+        rater: Import ratings of this Rater, created if it does not
+            exist yet, instead of the default rater
+        dry_run: Only report changes without saving them
+        on_change: Called with each changed Entity
+        chunk_rows: Spreadsheet rows per transaction
+
+    Raises:
+        ValueError: If the spreadsheet has no valid header
+    """
+
+    lines = iter(lines)
+    header = next(lines, None)
+    if header is None:
+        raise ValueError("Spreadsheet is empty")
+
+    header_cells = _split(header)
+    layout, issues = parse_header(
+        header_cells,
+        dict(TableColumn.select(TableColumn.name, TableColumn.id).tuples()))
+
+    rater_model = None
+    if rater is not None:
+        rater_model = queries.get_rater(rater, create=not dry_run)
+
+    importer = _Importer(layout, len(header_cells), _Names.load(),
+                         rater_model, on_change)
+    importer.issues.extend(issues)
+
+    db = Entity._meta.database
+    for chunk in _chunks(enumerate(lines, 2), chunk_rows):
+        if dry_run:
+            importer.import_chunk(chunk)
+            continue
+
+        # Lock for writing before reading so that the ratings compared
+        # against are those being replaced
+        with db.atomic(lock_type="IMMEDIATE"):
+            ratings = importer.import_chunk(chunk)
+            if ratings:
+                queries.save_ratings(ratings, rater_model)
+
+    return ImportResult(importer.rows, importer.changed, importer.unchanged,
+                        sorted(importer.issues, key=lambda i: i.line))
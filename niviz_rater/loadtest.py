@@ -0,0 +1,269 @@
+"""
+Load test of the rater API: concurrent simulated raters replay rating
+sessions against a running server, reporting latency percentiles and
+throughput per route
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import math
+import random
+import threading
+import time
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+# Latency percentiles reported per route
+PERCENTILES = (50, 95, 99)
+
+# Entities rated between polls of the overview, as the interface does
+# after saving
+OVERVIEW_EVERY = 5
+
+# Seconds to wait for a response before counting the request as failed
+REQUEST_TIMEOUT = 30.0
+
+# Route label of image requests to the fileserver
+IMAGE_ROUTE = "GET image"
+
+
+def percentile(ordered: List[float], p: float) -> Optional[float]:
+    """
+    Nearest-rank percentile `p` of sorted values, None if there are none
+    """
+
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(len(ordered) * p / 100))
+    return ordered[rank - 1]
+
+
+class _RouteStats:
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+
+    def report(self, seconds: float) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        report = {
+            "requests": len(ordered),
+            "errors": self.errors,
+            "throughput": len(ordered) / seconds if seconds else None
+        }
+        for p in PERCENTILES:
+            value = percentile(ordered, p)
+            report[f"p{p}"] = value * 1000 if value is not None else None
+        report["max"] = ordered[-1] * 1000 if ordered else None
+        return report
+
+
+class LoadTest:
+    """
+    Raters that each repeatedly open the view of an Entity, fetch its
+    images, save a rating and poll the overview every OVERVIEW_EVERY
+    ratings. Raters rate disjoint sets of Entities in spreadsheet order
+    as separate raters, so their saves do not conflict
+
+    Arguments:
+        url: Base URL of the server, such as http://localhost:5000
+        raters: Number of concurrent raters
+        duration: Seconds to run for
+        think_time: Mean seconds a rater waits between requests,
+            drawn from an exponential distribution
+        fetch_images: Fetch the images of each Entity viewed
+        seed: Seed of the raters' random choices
+    """
+
+    def __init__(self,
+                 url: str,
+                 raters: int = 20,
+                 duration: float = 30.0,
+                 think_time: float = 0.0,
+                 fetch_images: bool = True,
+                 seed: int = 0):
+        self.url = url.rstrip("/")
+        self.raters = raters
+        self.duration = duration
+        self.think_time = think_time
+        self.fetch_images = fetch_images
+        self.seed = seed
+        self._stats: Dict[str, _RouteStats] = {}
+        self._lock = threading.Lock()
+
+    def _record(self, route: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(route, _RouteStats())
+            stats.latencies.append(seconds)
+            if not ok:
+                stats.errors += 1
+
+    def request(self,
+                route: str,
+                url: str,
+                payload: Any = None) -> Optional[bytes]:
+        """
+        Request `url`, POSTing `payload` as JSON if given, and record
+        its latency under `route`
+
+        Returns:
+            body: Body of the response, None if the request failed
+        """
+
+        data = None
+        headers = {}
+        if payload is not None:
+            data = json.dumps(payload).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        if not url.startswith("http"):
+            url = self.url + url
+
+        start = time.perf_counter()
+        try:
+            with urlopen(Request(url, data=data, headers=headers),
+                         timeout=REQUEST_TIMEOUT) as response:
+                body = response.read()
+        except OSError as e:
+            self._record(route, time.perf_counter() - start, False)
+            logger.debug("%s %s failed: %s", route, url, e)
+            return None
+        self._record(route, time.perf_counter() - start, True)
+        return body
+
+    def _think(self, rng: random.Random) -> None:
+        if self.think_time > 0:
+            time.sleep(rng.expovariate(1 / self.think_time))
+
+    def _session(self, index: int, deadline: float) -> None:
+        rng = random.Random(self.seed * 1000003 + index)
+        rater = f"loadtest{index}"
+
+        ratings = self.request("GET /api/ratings", "/api/ratings")
+        spreadsheet = self.request("GET /api/spreadsheet", "/api/spreadsheet")
+        if ratings is None or spreadsheet is None:
+            return
+        rating_ids = [
+            r["id"] for r in json.loads(ratings)["validRatings"]
+            if r["id"] is not None
+        ]
+        entity_ids = [
+            e["id"] for e in json.loads(spreadsheet)["entities"]
+        ][index::self.raters]
+        if not entity_ids or not rating_ids:
+            return
+
+        rated = 0
+        while time.monotonic() < deadline:
+            entity_id = entity_ids[rated % len(entity_ids)]
+            self._think(rng)
+            body = self.request("GET /api/entity/<id>/view",
+                                f"/api/entity/{entity_id}/view?rater={rater}")
+            if body is None:
+                rated += 1
+                continue
+
+            view = json.loads(body)
+            if self.fetch_images:
+                for image in view["entityImages"]:
+                    self.request(IMAGE_ROUTE, image)
+
+            self._think(rng)
+            self.request(
+                "POST /api/entity", "/api/entity", {
+                    "id": entity_id,
+                    "version": view["entityVersion"],
+                    "rating": rng.choice(rating_ids),
+                    "rater": rater
+                })
+            rated += 1
+            if rated % OVERVIEW_EVERY == 0:
+                self.request("GET /api/overview",
+                             f"/api/overview?rater={rater}")
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Run the raters' sessions for `duration` seconds
+
+        Returns:
+            report: Total requests, errors and throughput in requests
+                per second, overall and for each route, and latency
+                percentiles of each route in milliseconds
+        """
+
+        self._stats = {}
+        start = time.monotonic()
+        deadline = start + self.duration
+        threads = [
+            threading.Thread(target=self._session,
+                             args=(i, deadline),
+                             name=f"rater-{i}",
+                             daemon=True) for i in range(self.raters)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.monotonic() - start
+
+        routes = {
+            route: stats.report(seconds)
+            for route, stats in sorted(self._stats.items())
+        }
+        requests = sum(r["requests"] for r in routes.values())
+        return {
+            "raters": self.raters,
+            "seconds": seconds,
+            "requests": requests,
+            "errors": sum(r["errors"] for r in routes.values()),
+            "throughput": requests / seconds,
+            "routes": routes
+        }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """
+    Table of the latency percentiles and throughput of each route
+    """
+
+    columns = ["requests", "errors", "throughput"
+               ] + [f"p{p}" for p in PERCENTILES] + ["max"]
+    width = max([len("route")] + [len(r) for r in report["routes"]])
+    lines = [
+        f"{report['raters']} raters, {report['seconds']:.1f}s, "
+        f"{report['requests']} requests ({report['errors']} failed), "
+        f"{report['throughput']:.1f} requests/s",
+        f"{'route':<{width}}" + "".join(f"{c:>11}" for c in columns[:3]) +
+        "".join(f"{c + ' ms':>10}" for c in columns[3:])
+    ]
+    for route, stats in report["routes"].items():
+        cells = [f"{stats['requests']:>11}", f"{stats['errors']:>11}",
+                 f"{stats['throughput']:>9.1f}/s"]
+        cells += [
+            f"{stats[c]:>10.1f}" if stats[c] is not None else f"{'-':>10}"
+            for c in columns[3:]
+        ]
+        lines.append(f"{route:<{width}}" + "".join(cells))
+    return "\n".join(lines)
+
+
+def exceeded_budgets(report: Dict[str, Any],
+                     budgets: Dict[int, float]) -> List[str]:
+    """
+    Describe each route whose latency percentile exceeded its budget
+
+    Arguments:
+        budgets: Mapping of percentiles in PERCENTILES to the maximum
+            latency in milliseconds
+    """
+
+    exceeded = []
+    for route, stats in report["routes"].items():
+        for p, budget in sorted(budgets.items()):
+            latency = stats[f"p{p}"]
+            if latency is not None and latency > budget:
+                exceeded.append(f"{route} p{p} latency {latency:.1f}ms "
+                                f"exceeds the budget of {budget:g}ms")
+    return exceeded
@@ -0,0 +1,245 @@
+"""
+Request and DB metrics of the web-server, exposed in the Prometheus
+text exposition format
+"""
+
+from __future__ import annotations
+from typing import Callable, Dict, Iterable, List, Tuple
+from bisect import bisect_left
+import threading
+import time
+
+# Upper bounds of request and DB statement duration buckets in seconds
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of response size buckets in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+# Route label of requests that did not match a route
+UNMATCHED = "none"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """
+    Values of a metric for each combination of label values
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, float] = {}
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_labels(self.labels, k)} {_number(v)}"
+            for k, v in values
+        ]
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}", *self._samples()
+        ])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in cumulative buckets with upper bounds
+    `buckets`, and their sum
+    """
+    kind = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values, counts of each bucket then +Inf, and sum
+        self._observations: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._observations.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            observations = sorted((labels, (list(counts), total[0]))
+                                  for labels, (counts, total) in
+                                  self._observations.items())
+
+        samples = []
+        for labels, (counts, total) in observations:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"), ), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                bucket_labels = _labels(self.labels, labels, f'le="{le}"')
+                samples.append(
+                    f"{self.name}_bucket{bucket_labels} {cumulative}")
+            samples.append(f"{self.name}_sum{_labels(self.labels, labels)} "
+                           f"{_number(total)}")
+            samples.append(f"{self.name}_count{_labels(self.labels, labels)} "
+                           f"{cumulative}")
+        return samples
+
+
+class Registry:
+    """
+    Metrics of the web-server's requests and DB statements
+    """
+
+    def __init__(self):
+        self.requests = Counter("niviz_http_requests_total",
+                                "Requests handled",
+                                ("method", "route", "status"))
+        self.errors = Counter("niviz_http_request_errors_total",
+                              "Requests that failed with a server error",
+                              ("method", "route"))
+        self.in_flight = Gauge("niviz_http_requests_in_flight",
+                               "Requests being handled")
+        self.durations = Histogram(
+            "niviz_http_request_duration_seconds",
+            "Time to handle requests, including streaming the response",
+            ("method", "route"))
+        self.sizes = Histogram("niviz_http_response_size_bytes",
+                               "Size of response bodies",
+                               ("method", "route"),
+                               buckets=SIZE_BUCKETS)
+        self.statements = Histogram(
+            "niviz_db_statement_duration_seconds",
+            "Time to execute DB statements, excluding fetching rows "
+            "after the first", ("operation", ))
+
+    @property
+    def metrics(self) -> List[Metric]:
+        return [
+            self.requests, self.errors, self.in_flight, self.durations,
+            self.sizes, self.statements
+        ]
+
+    def observe_statement(self, sql: str, seconds: float) -> None:
+        """
+        Statement hook recording the duration of a DB statement by its
+        operation (SELECT, INSERT, ...)
+        """
+
+        operation = sql.lstrip().split(None, 1)[0].upper() if sql else ""
+        self.statements.observe(seconds, operation)
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self.metrics) + "\n"
+
+
+class ResponseBody:
+    """
+    Response body counting the bytes sent, calls `done` with the size
+    once the server closes it
+    """
+
+    def __init__(self, body: Iterable[bytes], done: Callable[[int], None]):
+        self.body = body
+        self.done = done
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.done(self.size)
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware recording the latency, response size and status of
+    requests to a bottle application by route
+    """
+
+    def __init__(self, app: Callable, registry: Registry):
+        self.app = app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        registry = self.registry
+        start = time.perf_counter()
+        status: List[str] = []
+
+        def _start_response(value, headers, exc_info=None):
+            status.append(value)
+            return start_response(value, headers, exc_info)
+
+        def done(size: int, failed: bool = False):
+            route = environ.get('bottle.route')
+            labels = (environ.get('REQUEST_METHOD', ""),
+                      route.rule if route is not None else UNMATCHED)
+            code = status[-1].split(None, 1)[0] if status else "500"
+            registry.in_flight.dec()
+            registry.requests.inc(*labels, code)
+            if failed or code.startswith("5"):
+                registry.errors.inc(*labels)
+            registry.durations.observe(time.perf_counter() - start, *labels)
+            registry.sizes.observe(size, *labels)
+
+        registry.in_flight.inc()
+        try:
+            body = self.app(environ, _start_response)
+        except Exception:
+            done(0, failed=True)
+            raise
+        return ResponseBody(body, done)
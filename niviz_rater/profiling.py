@@ -0,0 +1,181 @@
+"""
+Profiling of CLI subcommands: call statistics with cProfile, memory
+allocations with tracemalloc and the time spent in named stages of
+ingestion, such as scanning the layout and writing each component
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Optional
+from contextlib import contextmanager
+from pathlib import Path
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Number of functions and allocation sites listed in summaries
+TOP_ENTRIES = 20
+
+# Time and number of runs of each stage while a Profile is active
+_stages: Optional[Dict[str, List[float]]] = None
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Add the time spent in the block to stage `name` of the active
+    Profile, does nothing when not profiling
+    """
+
+    if _stages is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = _stages.setdefault(name, [0.0, 0])
+        entry[0] += time.perf_counter() - start
+        entry[1] += 1
+
+
+def _allocation_filters() -> List[tracemalloc.Filter]:
+    return [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ]
+
+
+class Profile:
+    """
+    Context manager profiling the block with cProfile and tracemalloc
+    and timing its stages. Only one Profile can be active at a time
+
+    Times are measured under the profiler, which slows down code making
+    many small calls more than code waiting on I/O
+    """
+
+    def __init__(self, top: int = TOP_ENTRIES):
+        self.top = top
+        self.profiler = cProfile.Profile()
+        self.seconds = 0.0
+        self.stages: Dict[str, List[float]] = {}
+        self.peak_memory = 0
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self._start = 0.0
+
+    def __enter__(self) -> Profile:
+        global _stages
+        if _stages is not None:
+            raise RuntimeError("A profile is already active")
+        _stages = self.stages
+        tracemalloc.start()
+        self._start = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _stages
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self._start
+        _stages = None
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        self.snapshot = tracemalloc.take_snapshot().filter_traces(
+            _allocation_filters())
+        tracemalloc.stop()
+
+    def _functions(self) -> List[Dict[str, Any]]:
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        entries = sorted(stats.stats.items(),
+                         key=lambda item: item[1][3],
+                         reverse=True)
+        return [{
+            "function": pstats.func_std_string(func),
+            "calls": total_calls,
+            "seconds": own_time,
+            "cumulativeSeconds": cumulative_time
+        } for func, (_, total_calls, own_time, cumulative_time,
+                     _) in entries[:self.top]]
+
+    def _allocations(self) -> List[Dict[str, Any]]:
+        if self.snapshot is None:
+            return []
+        return [{
+            "site": f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+            "size": s.size,
+            "count": s.count
+        } for s in self.snapshot.statistics("lineno")[:self.top]]
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Total and per stage times, peak memory, and the functions with
+        the most cumulative time and allocation sites with the most
+        memory still allocated at the end of the block
+        """
+
+        summary = {
+            "seconds": self.seconds,
+            "stages": {
+                name: {
+                    "seconds": seconds,
+                    "runs": runs
+                }
+                for name, (seconds, runs) in self.stages.items()
+            },
+            # Peak size of memory blocks allocated by Python
+            "peakMemory": self.peak_memory,
+            "functions": self._functions(),
+            "allocations": self._allocations()
+        }
+        if resource is not None:
+            # Kilobytes on Linux, bytes on macOS
+            summary["maxRSS"] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        return summary
+
+    def write(self, prefix: Path) -> Dict[str, Any]:
+        """
+        Write the call statistics to `prefix`.pstats, to be read with
+        pstats or a viewer such as snakeviz, and the summary as JSON to
+        `prefix`.json
+
+        Returns:
+            summary: Summary written
+        """
+
+        prefix = Path(prefix)
+        self.profiler.dump_stats(str(prefix.with_name(prefix.name +
+                                                      ".pstats")))
+        summary = self.summary()
+        with open(prefix.with_name(prefix.name + ".json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def format_summary(summary: Dict[str, Any], entries: int = 5) -> str:
+    """
+    Stage times, peak memory and the top `entries` allocation sites
+    of a summary
+    """
+
+    lines = [f"Total: {summary['seconds']:.2f}s, peak memory "
+             f"{summary['peakMemory'] / 1024**2:.1f} MB"]
+    for name, entry in summary["stages"].items():
+        lines.append(f"  {name}: {entry['seconds']:.2f}s"
+                     + (f" ({entry['runs']} runs)" if entry['runs'] > 1
+                        else ""))
+    if summary["allocations"]:
+        lines.append("Top allocation sites:")
+        lines.extend(f"  {a['size'] / 1024:.1f} KB in {a['count']} blocks: "
+                     f"{a['site']}"
+                     for a in summary["allocations"][:entries])
+    return "\n".join(lines)
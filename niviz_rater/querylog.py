@@ -0,0 +1,190 @@
+"""
+Per-request counts and timings of DB statements, flagging requests that
+issue more statements than a budget or repeat the same statement, as
+when rows are fetched one at a time in a loop (N+1 queries)
+"""
+
+from __future__ import annotations
+from typing import Callable, Iterator, List, Optional, Tuple
+from collections import Counter
+from contextlib import contextmanager
+import logging
+import re
+import threading
+
+from niviz_rater.metrics import ResponseBody
+
+logger = logging.getLogger(__name__)
+
+# Statements per request above which a request is flagged
+QUERY_BUDGET = 20
+
+# Executions of the same normalised statement in a request from which
+# a request is flagged as likely issuing N+1 queries
+REPEATED_QUERIES = 10
+
+# Number of slowest statements logged per request
+SLOWEST_QUERIES = 3
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w\"])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b", re.I)
+_PARAMETER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Replace literals in `sql` with placeholders and collapse lists of
+    placeholders and whitespace, so statements differing only in their
+    values compare equal
+    """
+
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _PARAMETER_LIST.sub("(?, ...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+class RequestQueries:
+    """
+    Statements executed while handling a single request
+    """
+
+    def __init__(self):
+        self.statements: List[Tuple[str, float]] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def seconds(self) -> float:
+        return sum(seconds for _, seconds in self.statements)
+
+    def slowest(self, count: int) -> List[Tuple[str, float]]:
+        """
+        Normalised SQL and duration of the `count` slowest statements
+        """
+
+        statements = sorted(self.statements, key=lambda s: s[1], reverse=True)
+        return [(normalize_sql(sql), seconds)
+                for sql, seconds in statements[:count]]
+
+    def repeated(self, minimum: int) -> List[Tuple[str, int]]:
+        """
+        Normalised SQL of statements executed at least `minimum` times
+        and how often, most repeated first
+        """
+
+        counts = Counter(normalize_sql(sql) for sql, _ in self.statements)
+        return [(sql, n) for sql, n in counts.most_common() if n >= minimum]
+
+
+class QueryLog:
+    """
+    Statement hook attributing statements to the request being handled
+    on the executing thread. Statements executed outside of a tracked
+    request, such as by background threads, are ignored
+    """
+
+    def __init__(self,
+                 budget: Optional[int] = QUERY_BUDGET,
+                 repeats: Optional[int] = REPEATED_QUERIES,
+                 slowest: int = SLOWEST_QUERIES):
+        self.budget = budget
+        self.repeats = repeats
+        self.slowest = slowest
+        self._local = threading.local()
+
+    def observe_statement(self, sql: str, seconds: float) -> None:
+        queries = getattr(self._local, 'queries', None)
+        if queries is not None:
+            queries.statements.append((sql, seconds))
+
+    def start(self) -> Tuple[RequestQueries, Optional[RequestQueries]]:
+        """
+        Begin attributing statements on this thread to a new request
+
+        Returns:
+            queries: Statements of the new request
+            previous: Request that was being tracked, to pass to `stop`
+        """
+
+        previous = getattr(self._local, 'queries', None)
+        queries = self._local.queries = RequestQueries()
+        return queries, previous
+
+    def stop(self, previous: Optional[RequestQueries] = None) -> None:
+        self._local.queries = previous
+
+    @contextmanager
+    def track(self) -> Iterator[RequestQueries]:
+        """
+        Collect the statements executed on this thread within the block
+        """
+
+        queries, previous = self.start()
+        try:
+            yield queries
+        finally:
+            self.stop(previous)
+
+    def check(self, queries: RequestQueries, request: str) -> bool:
+        """
+        Log the slowest statements of a request, as warnings if the
+        request exceeded the query budget or repeated statements
+
+        Arguments:
+            request: Description of the request, such as its method
+                and route, used in log messages
+
+        Returns:
+            flagged: Whether the request was flagged
+        """
+
+        over_budget = self.budget is not None and queries.count > self.budget
+        repeated = (queries.repeated(self.repeats)
+                    if self.repeats is not None else [])
+        flagged = over_budget or bool(repeated)
+        level = logging.WARNING if flagged else logging.DEBUG
+        if not logger.isEnabledFor(level):
+            return flagged
+
+        if over_budget:
+            logger.warning("%s executed %d statements, over the budget of "
+                           "%d", request, queries.count, self.budget)
+        for sql, n in repeated:
+            logger.warning("%s executed the same statement %d times, "
+                           "likely N+1 queries: %s", request, n, sql)
+        logger.log(level, "%s executed %d statements in %.1fms", request,
+                   queries.count, queries.seconds * 1000)
+        for sql, seconds in queries.slowest(self.slowest):
+            logger.log(level, "  %.1fms %s", seconds * 1000, sql)
+        return flagged
+
+
+class QueryLogMiddleware:
+    """
+    WSGI middleware tracking the statements executed by each request to
+    a bottle application, including while streaming the response
+    """
+
+    def __init__(self, app: Callable, log: QueryLog):
+        self.app = app
+        self.log = log
+
+    def __call__(self, environ, start_response):
+        queries, previous = self.log.start()
+
+        def done(size: int):
+            self.log.stop(previous)
+            self.log.check(
+                queries, f"{environ.get('REQUEST_METHOD', '')} "
+                f"{environ.get('PATH_INFO', '')}")
+
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            done(0)
+            raise
+        return ResponseBody(body, done)
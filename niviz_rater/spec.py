@@ -5,10 +5,13 @@ Niviz-Rater Spec representation module
 from __future__ import annotations
 from typing import List, TYPE_CHECKING, Dict, Any, Iterable, Set
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from string import Template
 from itertools import groupby
 import logging
+import os
+
+from niviz_rater.profiling import stage
 
 if TYPE_CHECKING:
     from niviz_rater.validation import ValidConfig
@@ -35,14 +38,17 @@ class SpecConfig:
     def entities_by_component(
             self, layout: BIDSLayout) -> Iterable[ComponentEntities]:
 
-        bidsfiles = layout.get(extension=self.globals.image_extensions)
+        with stage("spec/query"):
+            bidsfiles = layout.get(extension=self.globals.image_extensions)
 
         for component in self.components:
+            with stage(f"spec/{component.id}"):
+                entities = component.build_qc_entities(
+                    bidsfiles, self.globals.row_description)
             yield ComponentEntities(
                 component_name=component.id,
                 available_annotations=component.available_annotations,
-                entities=component.build_qc_entities(
-                    bidsfiles, self.globals.row_description))
+                entities=entities)
 
 
 @dataclass
@@ -84,6 +90,14 @@ class QCEntity:
     def row_name(self):
         return self.tpl_row_name.substitute(self.entities)
 
+    def relative_to(self, base_path: str) -> QCEntity:
+        """
+        Return copy of QCEntity with image paths relative to `base_path`
+        """
+        return replace(self,
+                       images=[os.path.relpath(i, base_path)
+                               for i in self.images])
+
 
 @dataclass(frozen=True)
 class ComponentEntities:
@@ -109,6 +123,14 @@ class ComponentEntities:
         """
         return set([e.column_name for e in self.entities])
 
+    def relative_to(self, base_path: str) -> ComponentEntities:
+        """
+        Return copy of ComponentEntities with image paths of all
+        QCEntities relative to `base_path`
+        """
+        return replace(
+            self, entities=[e.relative_to(base_path) for e in self.entities])
+
 
 class ConfigComponent:
     """
@@ -0,0 +1,211 @@
+"""
+Rater throughput telemetry: times Entity views are opened and ratings
+saved, buffered in memory and written to the DB in batches, and a
+report of ratings per hour and time spent per Entity
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Set
+from itertools import groupby
+from operator import itemgetter
+from statistics import median
+import logging
+import threading
+import time
+
+from peewee import DatabaseError
+
+import niviz_rater.db.queries as queries
+from niviz_rater.agreement import DEFAULT_RATER
+from niviz_rater.db.models import SAVE_EVENT, VIEW_EVENT
+
+logger = logging.getLogger(__name__)
+
+# Buffered events that trigger a flush before FLUSH_INTERVAL elapses
+FLUSH_EVENTS = 500
+
+# Seconds between flushes of buffered events
+FLUSH_INTERVAL = 10.0
+
+# Saves more than this many seconds after the view was opened are not
+# counted towards time per Entity, the view was likely left open
+MAX_SECONDS_ON_ENTITY = 3600
+
+
+class TelemetryBuffer:
+    """
+    Collects view and save events in memory, requests only append to a
+    list while a background thread writes the events to the DB in
+    batches. Telemetry is best effort, events that cannot be written
+    are logged and dropped
+    """
+
+    def __init__(self,
+                 batch_size: int = FLUSH_EVENTS,
+                 interval: float = FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._events: List[tuple] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self,
+               kind: int,
+               entity_id: int,
+               rater: Optional[str] = None) -> None:
+        """
+        Buffer an event of `kind` (VIEW_EVENT or SAVE_EVENT) at the
+        current time, rater is the name of the rater or None for the
+        default rater
+        """
+
+        with self._lock:
+            self._events.append((entity_id, rater, kind, time.time()))
+            full = len(self._events) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def flush(self) -> int:
+        """
+        Write all buffered events to the DB
+
+        Returns:
+            n_events: Number of events written
+        """
+
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return 0
+
+        try:
+            # Raters are created here rather than on requests that
+            # only read, such as opening a view
+            rater_ids = {
+                name: queries.get_rater(name, create=True).id
+                for name in {e[1] for e in events if e[1] is not None}
+            }
+            rater_ids[None] = None
+            queries.save_rater_events([
+                (entity_id, rater_ids[rater], kind, at)
+                for entity_id, rater, kind, at in events
+            ])
+        except DatabaseError as e:
+            logger.error(f"Dropped {len(events)} rater events: {e}")
+            return 0
+        return len(events)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run,
+                                        name="telemetry",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread, writing any remaining events
+        """
+
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+class _Throughput:
+    """
+    Ratings, active hours and times per Entity of a group of saves
+    """
+
+    def __init__(self):
+        self.ratings = 0
+        self.hours: Set[int] = set()
+        self.seconds: List[float] = []
+
+    def add(self, at: float, seconds: Optional[float]) -> None:
+        self.ratings += 1
+        self.hours.add(int(at // 3600))
+        if seconds is not None:
+            self.seconds.append(seconds)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "ratings": self.ratings,
+            # Per hour in which ratings were saved
+            "ratingsPerHour":
+            self.ratings / len(self.hours) if self.hours else None,
+            "medianSeconds": median(self.seconds) if self.seconds else None
+        }
+
+
+def _grouped(groups: Dict[Any, _Throughput],
+             names: Dict[Any, str]) -> List[Dict[str, Any]]:
+    return [{
+        "name": names[key],
+        **groups[key].report()
+    } for key in sorted(groups, key=lambda k: names[k])]
+
+
+def throughput_report(since: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Ratings per hour and median time per Entity overall and per rater,
+    component and column, and ratings saved in each hour
+
+    The time spent on an Entity runs from opening its view to the
+    first save that follows. Ratings per hour count the hours in which
+    a rater saved ratings, so breaks are not counted
+
+    Arguments:
+        since: Only include events at or after this time, in seconds
+            since the epoch
+    """
+
+    overall = _Throughput()
+    raters: Dict[Optional[int], _Throughput] = {}
+    components: Dict[int, _Throughput] = {}
+    columns: Dict[int, _Throughput] = {}
+    hours: Dict[int, _Throughput] = {}
+
+    for _, events in groupby(queries.get_rater_events(since),
+                             key=itemgetter(0, 1)):
+        opened = None
+        for rater_id, _, kind, at, component_id, column_id in events:
+            if kind == VIEW_EVENT:
+                opened = at
+                continue
+            if kind != SAVE_EVENT:
+                continue
+
+            seconds = None
+            if opened is not None and at - opened <= MAX_SECONDS_ON_ENTITY:
+                seconds = at - opened
+            opened = None
+
+            keys = ((raters, rater_id), (components, component_id),
+                    (columns, column_id), (hours, int(at // 3600)))
+            for groups, key in keys:
+                groups.setdefault(key, _Throughput()).add(at, seconds)
+            overall.add(at, seconds)
+
+    rater_names = {r.id: r.name for r in queries.get_raters()}
+    rater_names[None] = DEFAULT_RATER
+    report = overall.report()
+    report["raters"] = _grouped(raters, rater_names)
+    report["components"] = _grouped(components,
+                                    queries.get_component_names())
+    report["columns"] = _grouped(columns, queries.get_column_names())
+    report["hours"] = [{
+        "start": hour * 3600,
+        "ratings": hours[hour].ratings,
+        "medianSeconds": hours[hour].report()["medianSeconds"]
+    } for hour in sorted(hours)]
+    return report
@@ -0,0 +1,171 @@
+import io
+import json
+from contextlib import contextmanager
+from string import Template
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+from bottle import default_app
+
+import niviz_rater.api  # noqa: F401 registers API routes
+import niviz_rater.db.utils as dbutils
+import niviz_rater.spec as spec
+from niviz_rater.db.models import database_proxy
+from niviz_rater.querylog import QueryLog, normalize_sql
+
+FILESERVER = "http://localhost:5001"
+
+
+class Response:
+    def __init__(self, status, headers, body):
+        self.status_code = int(status.split()[0])
+        self.headers = dict(headers)
+        self.body = body
+
+    @property
+    def text(self):
+        return self.body.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class Client:
+    """
+    Minimal WSGI client for calling API routes
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=b"", headers=None):
+        path, _, query = path.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+        }
+        for k, v in (headers or {}).items():
+            environ[f"HTTP_{k.upper().replace('-', '_')}"] = v
+            if k.lower() == "content-type":
+                environ["CONTENT_TYPE"] = v
+        setup_testing_defaults(environ)
+
+        result = {}
+
+        def start_response(status, headers, exc_info=None):
+            result["status"] = status
+            result["headers"] = headers
+
+        chunks = self.app(environ, start_response)
+        try:
+            body = b"".join(chunks)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        return Response(result["status"], result["headers"], body)
+
+    def get(self, path, headers=None):
+        return self.request("GET", path, headers=headers)
+
+    def post(self, path, payload=None, headers=None):
+        headers = {"Content-Type": "application/json", **(headers or {})}
+        return self.request("POST",
+                            path,
+                            body=json.dumps(payload).encode("utf-8"),
+                            headers=headers)
+
+
+@pytest.fixture
+def api_db(tmp_path):
+    """
+    Provide an initialized file-backed DB bound to the models, opened
+    as the server opens it
+    """
+
+    db = dbutils.get_or_create_db(str(tmp_path / "niviz.db"))
+    previous = database_proxy.obj
+    database_proxy.initialize(db)
+    dbutils.initialize_tables(db, {"Ratings": ["Pass", "Fail"]})
+
+    yield db
+
+    db.close()
+    database_proxy.initialize(previous)
+
+
+@pytest.fixture
+def max_queries(api_db):
+    """
+    Context manager asserting that at most `count` DB statements are
+    executed within the block, listing the statements if more are
+    """
+
+    log = QueryLog()
+    dbutils.add_statement_hook(api_db, log.observe_statement)
+
+    @contextmanager
+    def assert_max_queries(count):
+        with log.track() as queries:
+            yield queries
+        statements = "\n".join(
+            normalize_sql(sql) for sql, _ in queries.statements)
+        assert queries.count <= count, (
+            f"{queries.count} statements executed, expected at most "
+            f"{count}:\n{statements}")
+
+    return assert_max_queries
+
+
+def _qc_entity(subject, column, images):
+    return spec.QCEntity(images=images,
+                         entities={"subject": subject},
+                         tpl_label=Template(f"${{subject}} {column}"),
+                         tpl_column_name=Template(column),
+                         tpl_row_name=Template("${subject}"))
+
+
+@pytest.fixture
+def study_db(api_db):
+    """
+    Two components rated over three subjects, subject C is missing
+    the second component
+    """
+
+    components = {
+        "anat": ("T1w", ["A", "B", "C"], ["qc1.svg", "qc2.png"]),
+        "func": ("bold", ["A", "B"], ["qc1.svg"]),
+    }
+    for component, (column, subjects, images) in components.items():
+        entities = [
+            _qc_entity(s, column,
+                       [f"/qc/sub-{s}/figures/{column}_{i}" for i in images])
+            for s in subjects
+        ]
+        dbutils.component_entities_to_db(
+            api_db,
+            spec.ComponentEntities(component_name=component,
+                                   available_annotations=["Good", "Bad"],
+                                   entities=entities),
+            base_path="/qc")
+    return api_db
+
+
+@pytest.fixture
+def client(api_db):
+    app = default_app()
+    config = {
+        'niviz_rater.fileserver': FILESERVER,
+        'niviz_rater.base_path': "/qc",
+        'niviz_rater.db.instance': database_proxy,
+    }
+    previous = {k: app.config[k] for k in config if k in app.config}
+    app.config.update(config)
+
+    yield Client(app)
+
+    for k in config:
+        app.config.pop(k, None)
+    app.config.update(previous)
@@ -0,0 +1,129 @@
+import json
+import sys
+
+import pytest
+from bottle import default_app
+
+import niviz_rater.app as app
+import niviz_rater.db.models as models
+
+np = pytest.importorskip("numpy")
+
+import niviz_rater.agreement as agreement  # noqa: E402
+
+CONFIG_KEYS = [
+    'niviz_rater.base_path', 'niviz_rater.db.file', 'niviz_rater.db.instance'
+]
+
+
+def _rating_id(name):
+    return models.Rating.get(models.Rating.name == name).id
+
+
+def _rate(client, entity_id, rating, rater=None):
+    payload = {"id": entity_id, "rating": _rating_id(rating)}
+    if rater is not None:
+        payload["rater"] = rater
+    assert client.post("/api/entity", payload).status_code == 200
+
+
+@pytest.fixture
+def rated_db(study_db, client):
+    for entity_id, rating in [(1, "Pass"), (2, "Fail"), (4, "Pass")]:
+        _rate(client, entity_id, rating)
+    for entity_id, rating in [(1, "Pass"), (2, "Pass"), (4, "Pass"),
+                              (5, "Fail")]:
+        _rate(client, entity_id, rating, "r1")
+    return study_db
+
+
+def test_cohen_kappa():
+
+    confusion = np.array([[[20, 5], [10, 15]], [[10, 0], [0, 0]]])
+    kappa = agreement.cohen_kappa(confusion)
+
+    assert kappa[0] == pytest.approx(0.4)
+    assert np.isnan(kappa[1])
+
+
+def test_fleiss_kappa():
+
+    codes = np.array([[0, 0], [1, 1], [0, 1], [1, 1], [0, -1]])
+    kappa, n_entities = agreement.fleiss_kappa(codes, np.zeros(5, int), 1, 2)
+
+    assert kappa[0] == pytest.approx(7 / 15)
+    assert n_entities.tolist() == [4]
+
+
+def test_load_ratings(rated_db):
+
+    matrix = agreement.load_ratings()
+
+    assert matrix.raters == ["default", "r1"]
+    assert matrix.ratings == ["Pass", "Fail"]
+    assert matrix.entity_ids.tolist() == [1, 2, 3, 4, 5]
+    assert matrix.codes.tolist() == [[0, 0], [1, 0], [-1, -1], [0, 0],
+                                     [-1, 1]]
+
+
+def test_agreement_report(rated_db, client):
+
+    report = client.get("/api/agreement").json()
+
+    overall = report["overall"]
+    assert overall["entities"] == 5
+    assert overall["rated"] == [3, 4]
+    assert overall["fleissEntities"] == 3
+    assert overall["pairs"] == [{
+        "raters": ["default", "r1"],
+        "entities": 3,
+        "agreement": pytest.approx(2 / 3),
+        "kappa": pytest.approx(0),
+        "confusion": [[2, 0], [1, 0]]
+    }]
+    assert overall["disagreements"] == {
+        "count": 1,
+        "entities": [{
+            "id": 2,
+            "name": "B T1w",
+            "ratings": ["Fail", "Pass"]
+        }]
+    }
+
+    assert list(report["components"]) == ["anat", "func"]
+    assert report["components"]["anat"]["disagreements"]["count"] == 1
+    func = report["columns"]["bold"]
+    assert func["pairs"][0]["agreement"] == 1.0
+    # Undefined, only a single rating is used
+    assert func["pairs"][0]["kappa"] is None
+    assert func["disagreements"] == {"count": 0, "entities": []}
+
+
+def test_agreement_report_selects_raters(rated_db, client):
+
+    report = client.get("/api/agreement?raters=r1,default&limit=0").json()
+    assert report["raters"] == ["r1", "default"]
+    assert report["overall"]["pairs"][0]["confusion"] == [[2, 1], [0, 0]]
+    assert report["overall"]["disagreements"]["entities"] == []
+
+    assert client.get("/api/agreement?raters=default,r2").status_code == 400
+    assert client.get("/api/agreement?raters=r1").status_code == 400
+    assert client.get("/api/agreement?limit=all").status_code == 400
+
+
+def test_agreement_subcommand(rated_db, tmp_path, monkeypatch):
+
+    expected = agreement.agreement_report()
+    for key in CONFIG_KEYS:
+        monkeypatch.setitem(default_app().config, key, None)
+
+    output = tmp_path / "agreement.json"
+    monkeypatch.setattr(sys, "argv", [
+        "niviz-rater", "--db-file",
+        str(tmp_path / "niviz.db"), "agreement", "-o",
+        str(output)
+    ])
+
+    app.main()
+
+    assert json.loads(output.read_text()) == expected
@@ -0,0 +1,285 @@
+import threading
+
+import niviz_rater.api as api
+import niviz_rater.db.backup as backup
+import niviz_rater.db.models as models
+import niviz_rater.db.utils as dbutils
+
+FILESERVER = "http://localhost:5001"
+
+
+def test_spreadsheet_returns_all_entities(study_db, client):
+
+    response = client.get("/api/spreadsheet")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("application/json")
+
+    entities = response.json()["entities"]
+    assert len(entities) == 5
+    assert [e["id"] for e in entities] == sorted(e["id"] for e in entities)
+
+    first = entities[0]
+    assert first["rowName"] == "A"
+    assert first["columnName"] == "T1w"
+    assert first["name"] == "A T1w"
+    assert first["comment"] == ""
+    assert first["rating"] == {"id": None, "name": "None"}
+    assert first["annotation"] == {"id": None, "name": "None"}
+    assert first["imagePaths"] == [
+        f"{FILESERVER}/sub-A/figures/T1w_qc1.svg",
+        f"{FILESERVER}/sub-A/figures/T1w_qc2.png",
+    ]
+    assert first["thumbnailPaths"] == first["imagePaths"]
+
+
+def test_spreadsheet_includes_ratings_and_annotations(study_db, client):
+
+    entity = models.Entity.get_by_id(2)
+    entity.update_rating("Pass")
+    entity.update_annotation("Good")
+    entity.update_comment("A comment")
+    entity.save()
+
+    entities = {
+        e["id"]: e
+        for e in client.get("/api/spreadsheet").json()["entities"]
+    }
+
+    assert entities[2]["rating"]["name"] == "Pass"
+    assert entities[2]["annotation"]["name"] == "Good"
+    assert entities[2]["comment"] == "A comment"
+    assert entities[4]["imagePaths"] == [
+        f"{FILESERVER}/sub-A/figures/bold_qc1.svg"
+    ]
+
+
+def test_entity_view(study_db, client):
+
+    view = client.get("/api/entity/4/view").json()
+
+    assert view["entityId"] == 4
+    assert view["entityName"] == "A bold"
+    assert view["entityImages"] == [f"{FILESERVER}/sub-A/figures/bold_qc1.svg"]
+    assert [a["name"] for a in view["entityAvailableAnnotations"]
+            ] == ["None", "Good", "Bad"]
+    assert view["entityRating"] == {"id": None, "name": "None"}
+
+    assert client.get("/api/entity/100/view").status_code == 404
+
+
+def test_next_entity_views_follow_spreadsheet_order(study_db, client):
+
+    response = client.get("/api/entity/1/next?count=3")
+    views = response.json()["views"]
+
+    assert [v["entityId"] for v in views] == [4, 2, 5]
+    assert views[0] == client.get("/api/entity/4/view").json()
+    assert response.headers["Link"].split(", ") == [
+        f"<{image}>; rel=preload; as=image" for v in views
+        for image in v["entityImages"]
+    ]
+
+
+def test_next_entity_views_skip_rated(study_db, client):
+
+    entity = models.Entity.get_by_id(2)
+    entity.update_rating("Pass")
+    entity.save()
+
+    views = client.get("/api/entity/1/next?unrated=1").json()["views"]
+    assert [v["entityId"] for v in views] == [4, 5, 3]
+
+    last = client.get("/api/entity/3/next")
+    assert last.json()["views"] == []
+    assert "Link" not in last.headers
+
+    assert client.get("/api/entity/100/next").status_code == 404
+
+
+def test_update_entity_increments_version(study_db, client):
+
+    rating = models.Rating.get(models.Rating.name == "Pass")
+    response = client.post("/api/entity", {
+        "id": 1,
+        "version": 0,
+        "rating": rating.id,
+        "comment": "ok"
+    })
+
+    assert response.status_code == 200
+    assert response.json() == {"id": 1, "version": 1}
+    entity = client.get("/api/entity/1").json()
+    assert entity["version"] == 1
+    assert entity["rating"]["name"] == "Pass"
+    assert entity["comment"] == "ok"
+
+
+def test_update_entity_rejects_stale_version(study_db, client):
+
+    assert client.post("/api/entity", {
+        "id": 1,
+        "version": 0,
+        "comment": "first"
+    }).status_code == 200
+
+    stale = client.post("/api/entity", {
+        "id": 1,
+        "version": 0,
+        "comment": "second"
+    })
+    assert stale.status_code == 409
+    assert stale.json()["entity"]["comment"] == "first"
+    assert stale.json()["entity"]["version"] == 1
+
+    # Re-sending the stored state is not a conflict
+    assert client.post("/api/entity", {
+        "id": 1,
+        "version": 0,
+        "comment": "first"
+    }).json() == {"id": 1, "version": 1}
+
+
+def test_update_entity_rejects_invalid_requests(study_db, client):
+
+    assert client.post("/api/entity", {"comment": "a"}).status_code == 400
+    assert client.post("/api/entity", {
+        "id": 100,
+        "comment": "a"
+    }).status_code == 404
+    assert client.post("/api/entity", {
+        "id": 1,
+        "rating": 100
+    }).status_code == 400
+
+
+def test_admin_backup_writes_rotated_snapshots(study_db, client, tmp_path,
+                                               monkeypatch):
+
+    assert client.post("/api/admin/backup").status_code == 501
+
+    config = client.app.config
+    monkeypatch.setitem(config, 'niviz_rater.db.file', study_db.database)
+    monkeypatch.setitem(config, 'niviz_rater.backup.dir', tmp_path / "bak")
+    monkeypatch.setitem(config, 'niviz_rater.backup.keep', 1)
+
+    def snapshot(path):
+        response = client.post(path)
+        assert response.status_code == 202
+        started = response.json()
+        assert started["status"] == "running"
+        assert response.headers["Location"] == (
+            f"/api/admin/backup/{started['snapshot']}")
+        # Written on a background thread
+        api._snapshots[started["snapshot"]].join()
+        return client.get(response.headers["Location"]).json()
+
+    first = snapshot("/api/admin/backup")
+    second = snapshot("/api/admin/backup?vacuum=true")
+
+    assert first["snapshot"].startswith("niviz-")
+    assert first["status"] == second["status"] == "done"
+    assert second["removed"] == [first["snapshot"]]
+    assert [p.name for p in (tmp_path / "bak").iterdir()
+            ] == [second["snapshot"]]
+    assert client.get("/api/admin/backup/other.db").status_code == 404
+
+
+def test_admin_backup_reports_failures_and_forgets_old_snapshots(
+        study_db, client, tmp_path, monkeypatch):
+
+    config = client.app.config
+    monkeypatch.setitem(config, 'niviz_rater.db.file', study_db.database)
+    monkeypatch.setitem(config, 'niviz_rater.backup.dir', tmp_path / "bak")
+    monkeypatch.setattr(api, "_snapshots", {})
+    monkeypatch.setattr(api, "SNAPSHOT_STATUSES", 1)
+
+    def broken_snapshot_db(*args, **kwargs):
+        raise RuntimeError("unexpected")
+
+    monkeypatch.setattr(backup, "snapshot_db", broken_snapshot_db)
+    names = []
+    for _ in range(3):
+        name = client.post("/api/admin/backup").json()["snapshot"]
+        api._snapshots[name].join()
+        names.append(name)
+
+    assert list(api._snapshots) == names[1:]
+    assert client.get(f"/api/admin/backup/{names[0]}").status_code == 404
+    status = client.get(f"/api/admin/backup/{names[-1]}").json()
+    assert status["status"] == "failed"
+    assert status["error"] == "RuntimeError: unexpected"
+
+
+def test_admin_backup_does_not_block_requests(study_db, client, tmp_path,
+                                              monkeypatch):
+
+    config = client.app.config
+    monkeypatch.setitem(config, 'niviz_rater.db.file', study_db.database)
+    monkeypatch.setitem(config, 'niviz_rater.backup.dir', tmp_path / "bak")
+
+    release = threading.Event()
+    snapshot_db = backup.snapshot_db
+
+    def slow_snapshot_db(*args, **kwargs):
+        release.wait(10)
+        return snapshot_db(*args, **kwargs)
+
+    monkeypatch.setattr(backup, "snapshot_db", slow_snapshot_db)
+    started = client.post("/api/admin/backup").json()
+    try:
+        assert client.get(f"/api/admin/backup/{started['snapshot']}").json(
+        )["status"] == "running"
+        assert client.post("/api/admin/backup").status_code == 409
+        assert client.post("/api/entity", {
+            "id": 1,
+            "rating": 1
+        }).status_code == 200
+    finally:
+        release.set()
+        api._snapshots[started["snapshot"]].join()
+
+    assert client.get(f"/api/admin/backup/{started['snapshot']}").json(
+    )["status"] == "done"
+
+
+def test_read_only_serves_precomputed_responses(study_db, client,
+                                                monkeypatch):
+
+    entity = models.Entity.get_by_id(2)
+    entity.update_rating("Pass")
+    entity.save()
+    client.post("/api/entity", {"id": 4, "comment": "r1", "rater": "r1"})
+
+    paths = [
+        "/api/spreadsheet", "/api/spreadsheet?rater=r1", "/api/entity/2/view",
+        "/api/entity/1/next?count=3", "/api/entity/1/next?unrated=1",
+        "/api/entity/3/next", "/api/entity/4/view?rater=r1"
+    ]
+    expected = [client.get(p) for p in paths]
+
+    study_db.close()
+    db = dbutils.get_immutable_db(study_db.database)
+    models.database_proxy.initialize(db)
+    assert db.execute_sql("PRAGMA query_only").fetchone()[0] == 1
+
+    config = client.app.config
+    monkeypatch.setitem(config, 'niviz_rater.read_only', True)
+    monkeypatch.setitem(config, 'niviz_rater.read_cache',
+                        api.build_read_cache(config))
+
+    for path, response in zip(paths, expected):
+        cached = client.get(path)
+        assert cached.json() == response.json(), path
+        assert cached.headers["Content-Type"].startswith("application/json")
+        assert cached.headers.get("Link") == response.headers.get("Link")
+    assert client.get("/api/entity/100/view").status_code == 404
+    assert client.get("/api/entity/100/next").status_code == 404
+
+    assert client.post("/api/entity", {
+        "id": 1,
+        "comment": "a"
+    }).status_code == 403
+    assert client.post(
+        "/api/queue/next?holder=a&column=T1w").status_code == 403
+    assert models.Entity.get_by_id(1).comment == ""
+    db.close()
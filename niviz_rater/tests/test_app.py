@@ -0,0 +1,107 @@
+import json
+import pstats
+import sys
+
+import pytest
+from bottle import default_app
+
+import niviz_rater.app as app
+import niviz_rater.db.migrations as migrations
+import niviz_rater.db.utils as dbutils
+import niviz_rater.export as export
+
+CONFIG_KEYS = [
+    'niviz_rater.base_path', 'niviz_rater.db.file', 'niviz_rater.db.instance'
+]
+
+
+@pytest.mark.parametrize("options", [[], ["--snapshot"]])
+def test_export_runs_without_specification(study_db, tmp_path, monkeypatch,
+                                           options):
+
+    for key in CONFIG_KEYS:
+        monkeypatch.setitem(default_app().config, key, None)
+
+    expected = "".join(export.iter_tsv(columns=["bold"]))
+    output = tmp_path / "participants.tsv"
+    monkeypatch.setattr(sys, "argv", [
+        "niviz-rater", "--db-file",
+        str(tmp_path / "niviz.db"), "export", "-o",
+        str(output), "--columns", "bold"
+    ] + options)
+
+    app.main()
+
+    assert output.read_text() == expected
+
+
+def test_saves_do_not_wait_for_export(study_db, tmp_path):
+
+    study_db.close()
+    db_file = str(tmp_path / "niviz.db")
+    writer = dbutils.get_or_create_db(db_file, {'busy_timeout': 0})
+    writer.connect()
+    reader = dbutils.get_read_only_db(db_file)
+
+    with app._consistent_read(reader):
+        before = reader.execute_sql("SELECT COUNT(*) FROM rating").fetchone()
+        with writer.atomic():
+            writer.execute_sql("INSERT INTO rating (name) VALUES ('Later')")
+        after = reader.execute_sql("SELECT COUNT(*) FROM rating").fetchone()
+
+    assert before == after
+    writer.close()
+    reader.close()
+
+
+@pytest.mark.parametrize("version,expected", [
+    (migrations.SCHEMA_VERSION - 1, migrations.SCHEMA_VERSION),
+    # Absolute image paths are only made relative given -i
+    (0, 0),
+])
+def test_migrate_db_runs_without_specification(study_db, tmp_path,
+                                               monkeypatch, version,
+                                               expected):
+
+    for key in CONFIG_KEYS:
+        monkeypatch.delitem(default_app().config, key, raising=False)
+    migrations.set_version(study_db, version)
+    study_db.close()
+
+    monkeypatch.setattr(sys, "argv", [
+        "niviz-rater", "--db-file",
+        str(tmp_path / "niviz.db"), "migrate_db"
+    ])
+    app.main()
+
+    assert migrations.get_version(study_db) == expected
+
+
+def test_profile_writes_stats_and_summary(study_db, tmp_path, monkeypatch):
+
+    for key in CONFIG_KEYS:
+        monkeypatch.setitem(default_app().config, key, None)
+
+    prefix = tmp_path / "export-profile"
+    monkeypatch.setattr(sys, "argv", [
+        "niviz-rater", "--db-file",
+        str(tmp_path / "niviz.db"), "--profile",
+        str(prefix), "export", "-o",
+        str(tmp_path / "participants.tsv")
+    ])
+
+    app.main()
+
+    assert (tmp_path / "participants.tsv").exists()
+    stats = pstats.Stats(str(tmp_path / "export-profile.pstats"))
+    assert any(name == "iter_export" for _, _, name in stats.stats)
+
+    summary = json.loads((tmp_path / "export-profile.json").read_text())
+    assert set(summary["stages"]) == {"export"}
+    assert summary["stages"]["export"]["runs"] == 1
+    assert summary["seconds"] >= summary["stages"]["export"]["seconds"]
+    assert summary["peakMemory"] > 0
+    assert summary["functions"][0]["cumulativeSeconds"] >= summary[
+        "functions"][-1]["cumulativeSeconds"]
+    assert summary["allocations"] and all(
+        {"site", "size", "count"} == set(a) for a in summary["allocations"])
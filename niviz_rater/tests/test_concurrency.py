@@ -0,0 +1,51 @@
+import threading
+
+import niviz_rater.db.models as models
+
+N_WRITERS = 8
+N_UPDATES = 10
+
+
+def test_parallel_writers_do_not_lose_updates(study_db, client):
+    """
+    Writers append to an Entity's comment by read-modify-write,
+    retrying on conflict, every append must be kept
+    """
+
+    errors = []
+
+    def writer(name):
+        try:
+            for i in range(N_UPDATES):
+                while True:
+                    entity = client.get("/api/entity/1").json()
+                    response = client.post(
+                        "/api/entity", {
+                            "id": 1,
+                            "version": entity["version"],
+                            "comment": entity["comment"] + f"{name}.{i};"
+                        })
+                    if response.status_code == 200:
+                        break
+                    assert response.status_code == 409
+        except Exception as e:
+            errors.append(e)
+        finally:
+            study_db.close()
+
+    threads = [
+        threading.Thread(target=writer, args=(f"w{n}", ))
+        for n in range(N_WRITERS)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+
+    entity = models.Entity.get_by_id(1)
+    appended = entity.comment.split(";")[:-1]
+    assert sorted(appended) == sorted(f"w{n}.{i}" for n in range(N_WRITERS)
+                                      for i in range(N_UPDATES))
+    assert entity.version == N_WRITERS * N_UPDATES
@@ -0,0 +1,192 @@
+import gzip
+import json
+
+import pytest
+
+import niviz_rater.db.models as models
+import niviz_rater.db.queries as queries
+import niviz_rater.export as export
+
+
+def _reference_tsv():
+    """
+    Build participants.tsv in memory from denormalized models
+    """
+    rows = queries.get_denormalized_rows()
+    columns = list(queries.get_columns())
+
+    lines = []
+    for row in rows:
+        entries = [row.name]
+        entities = {e.columnname.id: e for e in row.entities}
+        for c in columns:
+            if c.id in entities:
+                entries.extend(entities[c.id].entry)
+            else:
+                entries.extend(("", "", ""))
+        lines.append("\t".join(entries))
+
+    header = [
+        f"{c.name}\t{c.name}_passfail\t{c.name}_comment" for c in columns
+    ]
+    header = "\t".join(["subjects"] + header)
+    return "\n".join([header] + lines)
+
+
+def _rate(entity_id, rating, annotation, comment):
+    entity = models.Entity.get_by_id(entity_id)
+    entity.update_rating(rating)
+    entity.update_annotation(annotation)
+    entity.comment = comment
+    entity.save()
+
+
+def test_tsv_matches_reference_output(study_db):
+
+    _rate(1, "Pass", "Good", "fine")
+    _rate(5, "Fail", "Bad", "multi\nline")
+    models.TableRow.create(name="D")
+
+    assert "".join(export.iter_tsv()) == _reference_tsv()
+
+
+def test_tsv_is_streamed_in_chunks(study_db):
+
+    chunks = list(export.iter_tsv(chunk_rows=2))
+
+    # Header, then rows A, B then row C
+    assert len(chunks) == 3
+    assert chunks[0].startswith("subjects\t")
+    assert all(c.startswith("\n") for c in chunks[1:])
+    assert "".join(chunks) == _reference_tsv()
+
+
+def test_export_endpoint_sets_download_headers(study_db, client):
+
+    response = client.get("/api/export")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith(
+        "text/tab-separated-values")
+    assert "participants.tsv" in response.headers["Content-Disposition"]
+    assert response.text == _reference_tsv()
+
+
+def test_tsv_places_cells_by_column_regardless_of_entity_order(study_db):
+
+    # Entity created after other columns sorts before them by column name
+    row = models.TableRow.get(models.TableRow.name == "C")
+    column = models.TableColumn.create(name="AAA")
+    entity = models.Entity.create(name="C AAA",
+                                  columnname=column,
+                                  rowname=row,
+                                  component=models.Component.get_by_id(1))
+    entity.update_rating("Pass")
+    entity.save()
+
+    lines = "".join(export.iter_tsv()).split("\n")
+
+    assert lines[0].split("\t")[1] == "AAA"
+    assert lines[3].split("\t")[:3] == ["C", "", "Pass"]
+    assert "".join(export.iter_tsv()) == _reference_tsv()
+
+
+def test_tsv_exports_selected_columns(study_db):
+
+    _rate(4, "Pass", "Good", "")
+
+    lines = "".join(export.iter_tsv(columns=["bold"])).split("\n")
+
+    assert lines[0] == "subjects\tbold\tbold_passfail\tbold_comment"
+    assert lines[1:] == ["A\tGood\tPass\t", "B\t\t\t", "C\t\t\t"]
+
+
+def test_tsv_exports_component_columns(study_db):
+
+    header = next(export.iter_tsv(component="anat"))
+    assert header == "subjects\tT1w\tT1w_passfail\tT1w_comment"
+
+
+def test_tsv_raises_on_unknown_selection(study_db):
+
+    with pytest.raises(ValueError):
+        export.iter_tsv(columns=["bold", "missing"])
+
+    with pytest.raises(ValueError):
+        export.iter_tsv(component="missing")
+
+
+def test_export_endpoint_rejects_unknown_columns(study_db, client):
+
+    assert client.get("/api/export?columns=bold").status_code == 200
+    assert client.get("/api/export?columns=missing").status_code == 400
+
+
+def test_tsv_gz_decompresses_to_tsv(study_db):
+
+    _rate(5, "Fail", "Bad", "multi\nline")
+
+    data = b"".join(export.iter_export("tsv.gz", chunk_rows=1))
+
+    assert gzip.decompress(data).decode("utf-8") == _reference_tsv()
+
+
+def test_jsonl_exports_one_record_per_entity(study_db):
+
+    _rate(5, "Fail", "Bad", "multi\nline")
+
+    lines = "".join(export.iter_export("jsonl", chunk_rows=2)).splitlines()
+    records = [json.loads(line) for line in lines]
+
+    # Unrated Entities are exported with a null rating
+    assert len(records) == 5
+    assert [r["rating"] for r in records] == [None, None, None, "Fail", None]
+    assert records[0] == {
+        "row": "A",
+        "column": "T1w",
+        "annotation": None,
+        "rating": None,
+        "comment": ""
+    }
+    assert records[3] == {
+        "row": "B",
+        "column": "bold",
+        "annotation": "Bad",
+        "rating": "Fail",
+        "comment": "multi\nline"
+    }
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "arrow"])
+def test_columnar_exports_match_tsv(study_db, fmt):
+
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    _rate(5, "Fail", "Bad", "multi\nline")
+
+    data = b"".join(export.iter_export(fmt, chunk_rows=2))
+    if fmt == "parquet":
+        parquet = pq.ParquetFile(pa.BufferReader(data))
+        assert parquet.num_row_groups == 2
+        table = parquet.read()
+    else:
+        table = pa.ipc.open_stream(data).read_all()
+
+    tsv = _reference_tsv().split("\n")
+    assert table.column_names == tsv[0].split("\t")
+    assert table.column("subjects").to_pylist() == ["A", "B", "C"]
+    assert table.column("bold_comment").to_pylist() == ["", "multi\nline", ""]
+
+
+def test_export_endpoint_selects_format(study_db, client):
+
+    response = client.get("/api/export?format=tsv.gz&columns=T1w")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/gzip"
+    assert "participants.tsv.gz" in response.headers["Content-Disposition"]
+    assert gzip.decompress(response.body).decode("utf-8").startswith(
+        "subjects\tT1w\t")
+
+    assert client.get("/api/export?format=xlsx").status_code == 400
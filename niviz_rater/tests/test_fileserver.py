@@ -0,0 +1,109 @@
+import os
+import gzip
+
+import niviz_rater.fileserver as fileserver
+from niviz_rater.cache import FileCache
+
+
+def _touch(path, mtime):
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_cache_put_then_get_returns_entry(tmp_path):
+
+    source = tmp_path / "image.svg"
+    source.write_text("<svg></svg>")
+    cache = FileCache(tmp_path / "cache", max_size=1024)
+
+    assert cache.get(source, "gzip") is None
+    entry = cache.put(source, "gzip", b"data")
+
+    assert cache.get(source, "gzip") == entry
+    assert entry.read_bytes() == b"data"
+    assert cache.size == 4
+
+
+def test_cache_is_invalidated_when_source_is_modified(tmp_path):
+
+    source = tmp_path / "image.svg"
+    source.write_text("<svg></svg>")
+    cache = FileCache(tmp_path / "cache", max_size=1024)
+    cache.put(source, "gzip", b"data")
+
+    source.write_text("<svg><g></g></svg>")
+    assert cache.get(source, "gzip") is None
+
+
+def test_cache_evicts_least_recently_used_entries(tmp_path):
+
+    cache = FileCache(tmp_path / "cache", max_size=10)
+    sources = []
+    for i in range(3):
+        source = tmp_path / f"{i}.svg"
+        source.write_text(str(i))
+        sources.append(source)
+
+    first = cache.put(sources[0], "gzip", b"aaaa")
+    second = cache.put(sources[1], "gzip", b"bbbb")
+    _touch(first, 2_000_000_000)
+    _touch(second, 1_000_000_000)
+
+    cache.put(sources[2], "gzip", b"cccc")
+
+    assert cache.size <= 10
+    assert cache.get(sources[0], "gzip") is not None
+    assert cache.get(sources[1], "gzip") is None
+    assert cache.get(sources[2], "gzip") is not None
+
+
+def test_cache_size_is_restored_from_directory(tmp_path):
+
+    source = tmp_path / "image.svg"
+    source.write_text("<svg></svg>")
+    FileCache(tmp_path / "cache", max_size=1024).put(source, "gzip", b"abc")
+
+    assert FileCache(tmp_path / "cache", max_size=1024).size == 3
+
+
+def test_precompress_skips_non_compressible_images(tmp_path):
+
+    svg = tmp_path / "image.svg"
+    svg.write_text("<svg>" + "<g></g>" * 100 + "</svg>")
+    png = tmp_path / "image.png"
+    png.write_bytes(b"\x89PNG")
+    cache = FileCache(tmp_path / "cache", max_size=1024**2)
+
+    n = fileserver.precompress(cache, [svg, png], encodings=["gzip"])
+
+    assert n == 1
+    assert cache.get(png, "gzip") is None
+    entry = cache.get(svg, "gzip")
+    assert gzip.decompress(entry.read_bytes()) == svg.read_bytes()
+    # Extra flags of the gzip header mark maximum compression
+    assert entry.read_bytes()[8] == 2
+
+
+def test_compressed_on_request_with_fast_levels(tmp_path):
+
+    svg = tmp_path / "image.svg"
+    svg.write_text("<svg>" + "<g></g>" * 10000 + "</svg>")
+    cache = FileCache(tmp_path / "cache", max_size=1024**2)
+
+    entry = fileserver.get_compressed(cache, svg, "gzip")
+
+    assert entry == cache.get(svg, "gzip")
+    assert gzip.decompress(entry.read_bytes()) == svg.read_bytes()
+    assert entry.read_bytes()[8] == 0
+    assert cache.size == entry.stat().st_size
+    assert fileserver.get_compressed(cache, tmp_path / "missing.svg",
+                                     "gzip") is None
+    assert list((tmp_path / "cache").iterdir()) == [entry]
+
+
+def test_accepted_encodings_respects_client_preferences():
+
+    assert fileserver.accepted_encodings("") == []
+    assert fileserver.accepted_encodings("identity") == []
+    assert fileserver.accepted_encodings("gzip;q=0") == []
+    assert "gzip" in fileserver.accepted_encodings("deflate, gzip;q=0.8")
+    assert fileserver.accepted_encodings("*") == fileserver.ENCODINGS
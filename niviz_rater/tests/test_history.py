@@ -0,0 +1,144 @@
+import json
+import time
+
+import niviz_rater.db.models as models
+import niviz_rater.db.queries as queries
+import niviz_rater.importer as importer
+
+
+def _history(client, since=None):
+    response = client.get("/api/history" +
+                          (f"?since={since}" if since is not None else ""))
+    assert response.headers["Content-Type"].startswith("application/x-ndjson")
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def _update(client, **changes):
+    return client.post("/api/entity", changes).json()
+
+
+def test_changes_are_logged(study_db, client):
+
+    _update(client, id=1, rating=1, comment="first")
+    # Saving the same rating is not a change
+    _update(client, id=1, rating=1)
+    _update(client, id=1, annotation=1)
+    _update(client, id=2, rating=2, rater="r1")
+    importer.import_tsv(["subjects\tbold_passfail", "B\tFail"])
+
+    changes = _history(client)
+    assert [(c["rater"], c["name"], c["version"], c["old"], c["new"])
+            for c in changes] == [
+                (None, "A T1w", 1, {
+                    "rating": None,
+                    "annotation": None,
+                    "comment": ""
+                }, {
+                    "rating": "Pass",
+                    "annotation": None,
+                    "comment": "first"
+                }),
+                (None, "A T1w", 3, {
+                    "rating": "Pass",
+                    "annotation": None,
+                    "comment": None
+                }, {
+                    "rating": "Pass",
+                    "annotation": "Good",
+                    "comment": None
+                }),
+                ("r1", "B T1w", 1, {
+                    "rating": None,
+                    "annotation": None,
+                    "comment": None
+                }, {
+                    "rating": "Fail",
+                    "annotation": None,
+                    "comment": None
+                }),
+                (None, "B bold", 1, {
+                    "rating": None,
+                    "annotation": None,
+                    "comment": None
+                }, {
+                    "rating": "Fail",
+                    "annotation": None,
+                    "comment": None
+                }),
+            ]
+    assert changes[0]["row"] == "A" and changes[0]["column"] == "T1w"
+
+    assert _history(client, since=changes[2]["time"]) == changes[2:]
+    assert client.get("/api/history?since=x").status_code == 400
+
+
+def test_undo_steps_back_through_history(study_db, client):
+
+    _update(client, id=1, rating=1, comment="first")
+    _update(client, id=1, rating=2)
+    _update(client, id=1, comment="second")
+
+    states = []
+    for _ in range(3):
+        entity = client.post("/api/entity/1/undo").json()
+        states.append(
+            (entity["rating"]["name"], entity["comment"], entity["version"]))
+    assert states == [("Fail", "first", 4), ("Pass", "first", 5),
+                      ("None", "", 6)]
+
+    assert client.post("/api/entity/1/undo").status_code == 404
+    assert client.post("/api/entity/100/undo").status_code == 404
+
+    # Undos are logged as changes undoing earlier changes
+    changes = _history(client)
+    assert [c["undoes"] for c in changes
+            ] == [None, None, None, changes[2]["id"], changes[1]["id"],
+                  changes[0]["id"]]
+
+    # Changes made after an undo are undone first
+    _update(client, id=1, comment="third")
+    assert client.post("/api/entity/1/undo").json()["comment"] == ""
+
+
+def test_undo_of_change_already_reverted_is_marked(study_db, client):
+
+    _update(client, id=1, rating=1)
+    # e.g merged from another copy of the DB, the Entity already holds
+    # the rating it would be reverted to
+    models.RatingHistory.insert(entity=1,
+                                time=time.time(),
+                                version=1,
+                                old_rating=1,
+                                rating=2).execute()
+
+    entity = client.post("/api/entity/1/undo").json()
+    assert (entity["rating"]["name"], entity["version"]) == ("Pass", 2)
+    assert client.post("/api/entity/1/undo").json()["rating"]["name"] == (
+        "None")
+    assert client.post("/api/entity/1/undo").status_code == 404
+
+    changes = _history(client)
+    assert [c["undoes"] for c in changes
+            ] == [None, None, changes[1]["id"], changes[0]["id"]]
+
+
+def test_undo_checks_version_and_rater(study_db, client):
+
+    _update(client, id=2, rating=1, rater="r1")
+    _update(client, id=2, rating=2)
+
+    conflict = client.post("/api/entity/2/undo", {"version": 0})
+    assert conflict.status_code == 409
+    assert conflict.json()["entity"]["version"] == 1
+
+    assert client.post("/api/entity/2/undo", {
+        "rater": "r1",
+        "version": 1
+    }).json()["rating"]["name"] == "None"
+    assert models.Entity.get_by_id(2).rating.name == "Fail"
+    assert client.post("/api/entity/2/undo", {
+        "rater": "r2"
+    }).status_code == 404
+
+    assert queries.undo_change(2) == 2
+    assert models.Entity.get_by_id(2).rating is None
@@ -0,0 +1,160 @@
+import sys
+
+import pytest
+from bottle import default_app
+
+import niviz_rater.app as app
+import niviz_rater.db.models as models
+import niviz_rater.db.queries as queries
+import niviz_rater.export as export
+import niviz_rater.importer as importer
+
+CONFIG_KEYS = [
+    'niviz_rater.base_path', 'niviz_rater.db.file', 'niviz_rater.db.instance'
+]
+
+HEADER = ("subjects\tT1w\tT1w_passfail\tT1w_comment\tbold\tbold_passfail\t"
+          "bold_comment")
+
+
+def _tsv(*rows):
+    return [HEADER] + ["\t".join(r) for r in rows]
+
+
+def _entry(entity_id):
+    entity = models.Entity.get_by_id(entity_id)
+    return (entity.annotation.name if entity.annotation else None,
+            entity.rating.name if entity.rating else None, entity.comment,
+            entity.version)
+
+
+def test_import_round_trips_export(study_db):
+
+    lines = _tsv(("A", "Good", "Pass", "fine", "Bad", "Fail", "multi\\nline"),
+                 ("B", "", "Fail", "", "", "", ""),
+                 ("C", "", "", "", "", "", ""))
+    result = importer.import_tsv(lines, chunk_rows=2)
+
+    assert result == importer.ImportResult(rows=3,
+                                           changed=3,
+                                           unchanged=0,
+                                           issues=[])
+    assert _entry(1) == ("Good", "Pass", "fine", 1)
+    assert _entry(2) == (None, "Fail", "", 1)
+    assert _entry(4) == ("Bad", "Fail", "multi\nline", 1)
+    assert _entry(3) == (None, None, "", 0)
+    assert "".join(export.iter_tsv()).split("\n")[:3] == lines[:3]
+
+    assert importer.import_tsv(lines).unchanged == 3
+    assert _entry(1)[3] == 1
+
+    # Progress counters follow imported ratings
+    assert queries.get_row_count() == 3
+    assert dict(((c, r), n)
+                for _, c, r, n in queries.get_rating_counts()) == {
+                    (1, 1): 1,
+                    (1, 2): 1,
+                    (1, None): 1,
+                    (2, 2): 1,
+                    (2, None): 1
+                }
+
+
+def test_import_leaves_missing_cells_unchanged(study_db):
+
+    models.Entity.update(comment="keep").where(
+        models.Entity.id == 1).execute()
+    result = importer.import_tsv(
+        ["subjects\tT1w_passfail\tunknown", "A\tPass\tx"])
+
+    assert result.issues == [importer.ImportIssue(1, "unknown",
+                                                  "Unknown column")]
+    assert _entry(1) == (None, "Pass", "keep", 1)
+
+
+def test_import_dry_run_reports_changes(study_db):
+
+    changes = []
+    result = importer.import_tsv(_tsv(("A", "", "Pass", "", "", "", "ok")),
+                                 dry_run=True,
+                                 on_change=changes.append)
+
+    assert result.changed == 2
+    assert changes == [
+        importer.Change(2, "A", "T1w", ("", "", ""), ("", "Pass", "")),
+        importer.Change(2, "A", "bold", ("", "", ""), ("", "", "ok")),
+    ]
+    assert _entry(1) == (None, None, "", 0)
+
+
+def test_import_reports_issues(study_db):
+
+    lines = _tsv(("A", "Nope", "Pass", "", "", "Maybe", ""),
+                 ("C", "", "Pass", "", "", "Fail", ""),
+                 ("D", "", "Pass", "", "", "", ""),
+                 ("B", "", "Pass", ""),
+                 ("C", "", "Fail", "", "", "", ""))
+    result = importer.import_tsv(lines)
+
+    assert result.issues == [
+        importer.ImportIssue(2, "T1w", "Unknown annotation Nope"),
+        importer.ImportIssue(2, "bold_passfail", "Unknown rating Maybe"),
+        importer.ImportIssue(3, "bold", "No image of row C in column bold"),
+        importer.ImportIssue(4, "subjects", "Unknown row D"),
+        importer.ImportIssue(5, "", "Expected 7 cells, found 4"),
+        importer.ImportIssue(6, "subjects", "Duplicate row C"),
+    ]
+    assert (result.rows, result.changed) == (5, 1)
+    assert _entry(3)[1] == "Pass"
+
+    with pytest.raises(ValueError):
+        importer.import_tsv(["T1w\tT1w_passfail"])
+
+
+def test_import_rater_ratings(study_db):
+
+    importer.import_tsv(_tsv(("B", "Bad", "Fail", "x", "", "", "")),
+                        rater="r1")
+
+    assert _entry(2) == (None, None, "", 0)
+    rater_rating = models.RaterRating.get()
+    assert (rater_rating.rater.name, rater_rating.entity.id,
+            rater_rating.rating.name, rater_rating.annotation.name,
+            rater_rating.comment, rater_rating.version) == ("r1", 2, "Fail",
+                                                            "Bad", "x", 1)
+
+    importer.import_tsv(_tsv(("B", "", "Pass", "", "", "", "")), rater="r1")
+    rater_rating = models.RaterRating.get()
+    assert (rater_rating.rating.name, rater_rating.annotation,
+            rater_rating.version) == ("Pass", None, 2)
+
+
+def test_import_subcommand(study_db, tmp_path, monkeypatch):
+
+    spreadsheet = tmp_path / "participants.tsv"
+    spreadsheet.write_text("\n".join(
+        _tsv(("A", "", "Pass", "", "", "", ""),
+             ("D", "", "Pass", "", "", "", ""))))
+
+    def run(*args):
+        for key in CONFIG_KEYS:
+            monkeypatch.delitem(default_app().config, key, raising=False)
+        monkeypatch.setattr(sys, "argv", [
+            "niviz-rater", "--db-file",
+            str(tmp_path / "niviz.db"), "import_ratings",
+            str(spreadsheet), *args
+        ])
+        app.main()
+
+    diff, errors = tmp_path / "diff.tsv", tmp_path / "errors.tsv"
+    run("--dry-run", "--diff", str(diff), "--errors", str(errors))
+    assert _entry(1)[1] is None
+    assert diff.read_text().splitlines() == [
+        "line\tsubjects\tcolumn\told\tnew", "2\tA\tT1w_passfail\t\tPass"
+    ]
+    assert errors.read_text().splitlines() == [
+        "line\tcolumn\tmessage", "3\tsubjects\tUnknown row D"
+    ]
+
+    run()
+    assert _entry(1)[1] == "Pass"
@@ -0,0 +1,57 @@
+from threading import Thread
+from wsgiref.simple_server import make_server
+
+import niviz_rater.db.models as models
+from niviz_rater.app import QuietRequestHandler
+from niviz_rater.loadtest import (LoadTest, exceeded_budgets, format_report,
+                                  percentile)
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert [percentile(values, p) for p in (50, 95, 99, 100)] == [
+        50.0, 95.0, 99.0, 100.0
+    ]
+    assert percentile([3.0], 50) == 3.0
+    assert percentile([], 50) is None
+
+
+def test_raters_replay_sessions(study_db, client):
+
+    server = make_server('localhost',
+                         0,
+                         client.app,
+                         handler_class=QuietRequestHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        report = LoadTest(f"http://localhost:{server.server_port}",
+                          raters=2,
+                          duration=0.5,
+                          fetch_images=False).run()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    routes = report["routes"]
+    assert set(routes) == {
+        "GET /api/ratings", "GET /api/spreadsheet",
+        "GET /api/entity/<id>/view", "POST /api/entity", "GET /api/overview"
+    }
+    assert report["errors"] == 0
+    assert routes["GET /api/spreadsheet"]["requests"] == 2
+    views = routes["GET /api/entity/<id>/view"]
+    assert views["requests"] >= routes["POST /api/entity"]["requests"] >= 5
+    assert views["p50"] <= views["p95"] <= views["p99"] <= views["max"]
+
+    # Raters rate disjoint Entities as themselves
+    raters = {r.name for r in models.Rater.select()}
+    assert raters == {"loadtest0", "loadtest1"}
+    assert models.Entity.select().where(
+        models.Entity.rating.is_null(False)).count() == 0
+
+    assert "POST /api/entity" in format_report(report)
+    assert exceeded_budgets(report, {95: 60000}) == []
+    exceeded = exceeded_budgets(report, {99: 0})
+    assert len(exceeded) == len(routes)
+    assert exceeded[0].startswith("GET /api/entity/<id>/view p99 latency ")
@@ -0,0 +1,65 @@
+import pytest
+
+import niviz_rater.db.queries as queries
+import niviz_rater.db.utils as dbutils
+import niviz_rater.metrics as metrics
+
+
+@pytest.fixture
+def registry(study_db, client, monkeypatch):
+    registry = metrics.Registry()
+    monkeypatch.setitem(client.app.config, 'niviz_rater.metrics', registry)
+    dbutils.add_statement_hook(study_db, registry.observe_statement)
+    return registry
+
+
+def _samples(text):
+    return dict(
+        line.rsplit(" ", 1) for line in text.splitlines()
+        if not line.startswith("#"))
+
+
+def test_metrics_by_route(client, registry, monkeypatch):
+
+    measured = type(client)(metrics.MetricsMiddleware(client.app, registry))
+    view = measured.get("/api/entity/1/view")
+    measured.get("/api/entity/2/view")
+    measured.get("/api/entity/100/view")
+    # Not found, or not allowed when the frontend's catch-all is routed
+    unmatched = measured.post("/not/a/route")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("failed")
+
+    monkeypatch.setattr(queries, "get_summary", fail)
+    assert measured.get("/api/overview").status_code == 500
+
+    response = client.get("/metrics")
+    assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+    samples = _samples(response.text)
+
+    route = 'method="GET",route="/api/entity/<entity_id:int>/view"'
+    assert samples[f'niviz_http_requests_total{{{route},status="200"}}'] == "2"
+    assert samples[f'niviz_http_requests_total{{{route},status="404"}}'] == "1"
+    assert samples['niviz_http_requests_total{method="POST",route="none",'
+                   f'status="{unmatched.status_code}"}}'] == "1"
+    assert samples['niviz_http_request_errors_total{method="GET",'
+                   'route="/api/overview"}'] == "1"
+    assert f'niviz_http_request_errors_total{{{route}}}' not in samples
+    assert samples["niviz_http_requests_in_flight"] == "0"
+
+    assert samples[f'niviz_http_request_duration_seconds_count{{{route}}}'] \
+        == "3"
+    assert samples[f'niviz_http_request_duration_seconds_bucket{{{route},'
+                   'le="+Inf"}'] == "3"
+    assert samples[f'niviz_http_response_size_bytes_bucket{{{route},'
+                   'le="256"}'] == "1"
+    assert float(samples[f'niviz_http_response_size_bytes_sum{{{route}}}']) \
+        > len(view.body)
+
+    assert int(samples['niviz_db_statement_duration_seconds_count'
+                       '{operation="SELECT"}']) >= 3
+
+
+def test_metrics_disabled(client):
+    assert client.get("/metrics").status_code == 501
@@ -0,0 +1,116 @@
+from peewee import fn
+
+import niviz_rater.db.models as models
+
+
+def _rating_id(name):
+    return models.Rating.get(models.Rating.name == name).id
+
+
+def _rate(client, entity_id, rating, rater=None):
+    payload = {"id": entity_id, "rating": _rating_id(rating)}
+    if rater is not None:
+        payload["rater"] = rater
+    assert client.post("/api/entity", payload).status_code == 200
+
+
+def _counted():
+    """
+    RatingCount counters recomputed from Entities
+    """
+    Entity = models.Entity
+    rating = fn.COALESCE(Entity.rating, 0)
+    return sorted(
+        Entity.select(Entity.component, Entity.columnname, rating,
+                      fn.COUNT(Entity.id)).group_by(
+                          Entity.component, Entity.columnname,
+                          rating).tuples())
+
+
+def test_counters_follow_entity_changes(study_db, client):
+
+    _rate(client, 1, "Pass")
+    _rate(client, 4, "Fail")
+    _rate(client, 4, "Pass")
+    models.Image.delete().where(models.Image.entity == 5).execute()
+    models.Entity.delete().where(models.Entity.id == 5).execute()
+
+    counters = sorted(
+        models.RatingCount.select().where(
+            models.RatingCount.count > 0).tuples())
+    assert counters == _counted()
+
+    rows = {
+        models.TableRow.get_by_id(r.rowname).name: (r.total, r.unrated)
+        for r in models.RowProgress.select()
+    }
+    assert rows == {"A": (2, 0), "B": (1, 1), "C": (1, 1)}
+
+
+def test_progress(study_db, client):
+
+    _rate(client, 2, "Pass")
+    _rate(client, 3, "Fail")
+
+    progress = client.get("/api/progress").json()
+
+    assert progress["entities"] == 5
+    assert progress["rated"] == 2
+    assert progress["ratings"] == {"None": 3, "Pass": 1, "Fail": 1}
+    assert progress["components"] == [{
+        "name": "anat",
+        "entities": 3,
+        "rated": 2,
+        "ratings": {
+            "None": 1,
+            "Pass": 1,
+            "Fail": 1
+        }
+    }, {
+        "name": "func",
+        "entities": 2,
+        "rated": 0,
+        "ratings": {
+            "None": 2,
+            "Pass": 0,
+            "Fail": 0
+        }
+    }]
+    assert [c["name"] for c in progress["columns"]] == ["T1w", "bold"]
+    assert progress["rows"]["total"] == 3
+    assert progress["rows"]["complete"] == 1
+    assert [(r["name"], r["entities"], r["rated"])
+            for r in progress["rows"]["incomplete"]] == [("A", 2, 0),
+                                                         ("B", 2, 1)]
+
+    assert client.get("/api/overview").json()["numberOfRows"] == 3
+
+
+def test_progress_of_rater(study_db, client):
+
+    _rate(client, 1, "Pass")
+    _rate(client, 3, "Fail", rater="r1")
+    _rate(client, 5, "Pass", rater="r1")
+
+    progress = client.get("/api/progress?rater=r1&rows=1").json()
+
+    assert progress["rated"] == 2
+    assert progress["ratings"] == {"None": 3, "Pass": 1, "Fail": 1}
+    assert progress["components"][0]["ratings"] == {
+        "None": 2,
+        "Pass": 0,
+        "Fail": 1
+    }
+    assert progress["rows"]["complete"] == 1
+    assert progress["rows"]["incomplete"] == [{
+        "name": "A",
+        "entities": 2,
+        "rated": 0,
+        "ratings": {
+            "None": 2,
+            "Pass": 0,
+            "Fail": 0
+        }
+    }]
+
+    assert client.get("/api/progress?rows=many").status_code == 400
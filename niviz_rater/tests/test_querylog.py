@@ -0,0 +1,94 @@
+import logging
+
+import pytest
+
+import niviz_rater.db.models as models
+import niviz_rater.db.utils as dbutils
+import niviz_rater.importer as importer
+from niviz_rater.querylog import QueryLog, QueryLogMiddleware, normalize_sql
+
+
+@pytest.mark.parametrize("method,path,payload,count", [
+    ("get", "/api/overview", None, 3),
+    ("get", "/api/progress", None, 8),
+    ("get", "/api/ratings", None, 3),
+    ("get", "/api/spreadsheet", None, 1),
+    ("get", "/api/entity/1", None, 3),
+    ("get", "/api/entity/1/view", None, 2),
+    ("get", "/api/entity/1/next", None, 4),
+    ("post", "/api/queue/next?holder=r1&column=T1w", None, 4),
+    ("post", "/api/entity", {
+        "id": 1,
+        "rating": 1,
+        "annotation": 1,
+        "comment": "x"
+    }, 2),
+    ("post", "/api/entity/1/undo", None, 10),
+    ("get", "/api/history", None, 4),
+    ("get", "/api/export", None, 2),
+    ("get", "/api/throughput", None, 4),
+])
+def test_endpoint_query_counts(study_db, client, max_queries, method, path,
+                               payload, count):
+
+    client.post("/api/entity", {"id": 1, "rating": 2})
+    with max_queries(count):
+        response = getattr(client, method)(path, payload)
+    assert response.status_code == 200
+
+
+def test_import_query_count(study_db, max_queries):
+
+    lines = [
+        "subjects\tT1w\tT1w_passfail\tT1w_comment", "A\tGood\tPass\tok",
+        "B\t\tFail\t", "C\t\tPass\t"
+    ]
+    with max_queries(9) as log:
+        assert importer.import_tsv(lines).changed == 3
+
+    # Ratings are staged with a single executemany statement
+    staged = [
+        sql for sql, _ in log.statements
+        if sql.startswith('INSERT INTO temp."saved_rating"')
+    ]
+    assert len(staged) == 1
+
+
+def test_normalize_sql():
+    assert normalize_sql('SELECT "t1"."id" FROM "entity" AS "t1"\n'
+                         ' WHERE ("t1"."id" IN (?, ?, ?)) AND "t1".name = '
+                         "'it''s' LIMIT 10 OFFSET -1") == (
+                             'SELECT "t1"."id" FROM "entity" AS "t1" WHERE '
+                             '("t1"."id" IN (?, ...)) AND "t1".name = ? '
+                             'LIMIT ? OFFSET ?')
+
+
+def test_requests_over_budget_are_flagged(study_db, client, caplog):
+
+    log = QueryLog(budget=3, repeats=3)
+    dbutils.add_statement_hook(study_db, log.observe_statement)
+
+    def n_plus_one(environ, start_response):
+        start_response("200 OK", [])
+        for entity_id in (1, 2, 3, 4):
+            yield models.Entity.get_by_id(entity_id).name.encode()
+
+    measured = type(client)(QueryLogMiddleware(n_plus_one, log))
+    with caplog.at_level(logging.WARNING, logger="niviz_rater.querylog"):
+        assert measured.get("/entities").text == "A T1wB T1wC T1wA bold"
+
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages[0] == ("GET /entities executed 4 statements, over the "
+                           "budget of 3")
+    assert messages[1].startswith("GET /entities executed the same "
+                                  "statement 4 times, likely N+1 queries: "
+                                  "SELECT")
+    assert messages[1].endswith('WHERE ("t1"."id" = ?) LIMIT ? OFFSET ?')
+    # Followed by the slowest statements
+    assert len(messages) == 3 + log.slowest
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger="niviz_rater.querylog"):
+        client.get("/api/overview")
+        type(client)(QueryLogMiddleware(client.app, log)).get("/api/entity/1")
+    assert not caplog.records
@@ -0,0 +1,110 @@
+import pytest
+
+import niviz_rater.db.models as models
+import niviz_rater.db.queries as queries
+
+
+def _lease(holder, column="T1w", **kwargs):
+    lease, next_ids = queries.lease_next_entity(
+        holder, column=queries.get_column(column), **kwargs)
+    return (lease.entity_id if lease else None), next_ids
+
+
+def test_leases_unrated_entities_in_id_order(study_db):
+
+    assert _lease("a", prefetch=5) == (1, [2, 3])
+    assert _lease("b", prefetch=5) == (2, [3])
+    assert _lease("c") == (3, [])
+    assert _lease("d") == (None, [])
+
+
+def test_lease_skips_rated_entities(study_db):
+
+    entity = models.Entity.get_by_id(1)
+    entity.update_rating("Pass")
+    entity.save()
+
+    assert _lease("a", prefetch=1) == (2, [3])
+
+
+def test_holder_releases_previous_lease(study_db):
+
+    assert _lease("a") == (1, [])
+    assert _lease("a", after=1) == (2, [])
+    assert _lease("b") == (1, [])
+    assert models.Lease.select().count() == 2
+
+
+def test_expired_leases_are_reclaimed(study_db):
+
+    assert _lease("a", duration=-1) == (1, [])
+    assert _lease("b") == (1, [])
+    assert [(lease.holder, lease.entity_id)
+            for lease in models.Lease.select()] == [("b", 1)]
+
+
+def test_lease_by_rater(study_db, client):
+
+    client.post("/api/entity", {"id": 1, "rating": 1, "rater": "r1"})
+    client.post("/api/entity", {"id": 2, "rating": 1})
+
+    r1 = queries.get_rater("r1")
+    assert _lease("a", rater=r1, prefetch=5) == (2, [3])
+    # Raters that have not rated yet lease any Entity without a lease
+    assert _lease("b", rater=queries.get_rater("r2")) == (1, [])
+    assert _lease("c", prefetch=5) == (3, [])
+
+    response = client.post("/api/queue/next?holder=a&column=T1w&rater=r1")
+    assert response.json()["id"] == 2
+    assert models.Rater.select().count() == 1
+
+
+def test_lease_by_component(study_db):
+
+    lease, next_ids = queries.lease_next_entity(
+        "a", component=queries.get_component("func"), prefetch=5)
+    assert lease.entity_id == 4
+    assert next_ids == [5]
+
+
+@pytest.mark.parametrize("column", [True, False])
+def test_unrated_query_uses_index(study_db, column):
+
+    if column:
+        q = queries._unrated_entities_query(column=queries.get_column("T1w"))
+        index = "entity_columnname_id_rating_id_id"
+    else:
+        q = queries._unrated_entities_query(
+            component=queries.get_component("anat"))
+        index = "entity_component_id_rating_id_id"
+
+    sql, params = q.limit(1).sql()
+    plan = " ".join(
+        r[-1] for r in study_db.execute_sql("EXPLAIN QUERY PLAN " + sql,
+                                            params))
+
+    assert f"USING COVERING INDEX {index}" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_queue_endpoint(study_db, client):
+
+    first = client.post("/api/queue/next?holder=a&column=T1w&prefetch=1")
+    assert first.status_code == 200
+    assert first.json()["id"] == 1
+    assert first.json()["next"] == [2]
+    assert first.json()["expires"] is not None
+
+    second = client.post("/api/queue/next?holder=b&component=anat")
+    assert second.json()["id"] == 2
+
+
+def test_queue_endpoint_rejects_invalid_requests(study_db, client):
+
+    assert client.post("/api/queue/next?column=T1w").status_code == 400
+    assert client.post("/api/queue/next?holder=a").status_code == 400
+    assert client.post(
+        "/api/queue/next?holder=a&column=missing").status_code == 404
+    # Leasing writes, so it is not a GET
+    assert client.get("/api/queue/next?holder=a&column=T1w").status_code in (
+        404, 405)
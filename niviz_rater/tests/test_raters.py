@@ -0,0 +1,118 @@
+import niviz_rater.db.models as models
+import niviz_rater.db.queries as queries
+import niviz_rater.export as export
+
+
+def _rating_id(name):
+    return models.Rating.get(models.Rating.name == name).id
+
+
+def _post(client, entity_id, rater, version=0, **changes):
+    return client.post("/api/entity", {
+        "id": entity_id,
+        "version": version,
+        "rater": rater,
+        **changes
+    })
+
+
+def test_rater_ratings_are_separate_from_default_rater(study_db, client):
+
+    response = _post(client, 1, "r1", rating=_rating_id("Fail"), comment="x")
+    assert response.json() == {"id": 1, "version": 1}
+
+    entity = models.Entity.get_by_id(1)
+    assert entity.rating is None
+    assert entity.version == 0
+
+    rater_rating = models.RaterRating.get()
+    assert rater_rating.rater.name == "r1"
+    assert rater_rating.rating.name == "Fail"
+    assert rater_rating.comment == "x"
+
+    entities = client.get("/api/spreadsheet?rater=r1").json()["entities"]
+    assert entities[0]["rating"]["name"] == "Fail"
+    assert entities[0]["version"] == 1
+    assert entities[1]["rating"]["name"] == "None"
+
+    default = client.get("/api/spreadsheet").json()["entities"]
+    assert default[0]["rating"]["name"] == "None"
+
+
+def test_rater_entity_views(study_db, client):
+
+    _post(client, 4, "r1", rating=_rating_id("Pass"), annotation=3)
+
+    info = client.get("/api/entity/4?rater=r1").json()
+    assert info["rating"]["name"] == "Pass"
+    assert info["annotation"]["name"] == "Good"
+    assert info["version"] == 1
+
+    view = client.get("/api/entity/4/view?rater=r1").json()
+    assert view["entityRating"]["name"] == "Pass"
+    assert view["entityVersion"] == 1
+
+    other = client.get("/api/entity/4/view?rater=r2").json()
+    assert other["entityRating"]["name"] == "None"
+    assert other["entityVersion"] == 0
+
+    views = client.get(
+        "/api/entity/1/next?unrated=1&rater=r1").json()["views"]
+    assert [v["entityId"] for v in views] == [2, 5, 3]
+
+
+def test_rater_versions_conflict_per_rater(study_db, client):
+
+    assert _post(client, 1, "r1", comment="a").status_code == 200
+    assert _post(client, 1, "r2", comment="b").status_code == 200
+
+    conflict = _post(client, 1, "r1", comment="c")
+    assert conflict.status_code == 409
+    assert conflict.json()["entity"]["comment"] == "a"
+
+    assert _post(client, 1, "r1", version=1, comment="c").status_code == 200
+
+
+def test_rater_progress(study_db, client):
+
+    _post(client, 1, "r1", rating=_rating_id("Pass"))
+    _post(client, 2, "r1", comment="no rating yet")
+
+    overview = client.get("/api/overview?rater=r1").json()
+    assert overview["numberOfRated"] == 1
+    assert overview["numberOfUnrated"] == 4
+
+    assert client.get("/api/overview").json()["numberOfRated"] == 0
+
+
+def test_rater_export(study_db, client):
+
+    _post(client, 4, "r1", rating=_rating_id("Pass"), comment="ok")
+
+    lines = "".join(export.iter_export(columns=["bold"],
+                                       rater="r1")).split("\n")
+    assert lines[1:] == ["A\t\tPass\tok", "B\t\t\t", "C\t\t\t"]
+
+    assert client.get("/api/export?rater=r1").status_code == 200
+    assert client.get("/api/export?rater=missing").status_code == 400
+
+
+def test_rater_queries_use_indexes(study_db):
+
+    rater = queries.get_rater("r1", create=True)
+
+    def plan(q):
+        sql, params = q.sql()
+        return " ".join(
+            r[-1]
+            for r in study_db.execute_sql("EXPLAIN QUERY PLAN " + sql, params))
+
+    progress = models.RaterRating.select().where(
+        (models.RaterRating.rater == rater)
+        & models.RaterRating.rating.is_null(False))
+    assert "INDEX raterrating_rater_id_rating_id" in plan(progress)
+
+    cells = queries._join_ratings(
+        models.Entity.select(models.Rating.name), rater)
+    assert "INDEX raterrating_rater_id_entity_id" in plan(cells)
+    assert "SCAN raterrating" not in plan(cells)
@@ -0,0 +1,111 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import niviz_rater.db.models as models
+import niviz_rater.telemetry as telemetry
+
+START = 100 * 3600
+
+
+@pytest.fixture
+def buffer(client, monkeypatch):
+    buffer = telemetry.TelemetryBuffer()
+    monkeypatch.setitem(client.app.config, 'niviz_rater.telemetry', buffer)
+    return buffer
+
+
+def test_throughput_report(study_db, client, buffer, monkeypatch):
+
+    clock = SimpleNamespace(time=lambda: START)
+    monkeypatch.setattr(telemetry, "time", clock)
+
+    def at(seconds, path, payload=None):
+        clock.time = lambda: START + seconds
+        if payload is None:
+            return client.get(path)
+        return client.post(path, payload)
+
+    at(0, "/api/entity/1/view")
+    at(30, "/api/entity", {"id": 1, "rating": 1})
+    at(40, "/api/entity/4/view")
+    at(100, "/api/entity", {"id": 4, "rating": 2})
+    # Saves without opening the view again are not timed
+    at(110, "/api/entity", {"id": 4, "comment": "x"})
+    at(7200, "/api/entity/2/view?rater=r1")
+    at(7220, "/api/entity", {"id": 2, "rating": 1, "rater": "r1"})
+    # Failed saves and views are not recorded
+    at(7230, "/api/entity/100/view")
+    at(7240, "/api/entity", {"id": 100, "rating": 1})
+
+    assert not models.RaterEvent.select().exists()
+    report = client.get("/api/throughput").json()
+    assert models.RaterEvent.select().count() == 7
+
+    assert {k: report[k]
+            for k in ("ratings", "ratingsPerHour", "medianSeconds")} == {
+                "ratings": 4,
+                "ratingsPerHour": 2.0,
+                "medianSeconds": 30
+            }
+    assert report["raters"] == [{
+        "name": "default",
+        "ratings": 3,
+        "ratingsPerHour": 3.0,
+        "medianSeconds": 45
+    }, {
+        "name": "r1",
+        "ratings": 1,
+        "ratingsPerHour": 1.0,
+        "medianSeconds": 20
+    }]
+    components = [(c["name"], c["ratings"], c["medianSeconds"])
+                  for c in report["components"]]
+    assert components == [("anat", 2, 25), ("func", 2, 60)]
+    assert [(c["name"], c["ratingsPerHour"])
+            for c in report["columns"]] == [("T1w", 1.0), ("bold", 2.0)]
+    assert report["hours"] == [{
+        "start": START,
+        "ratings": 3,
+        "medianSeconds": 45
+    }, {
+        "start": START + 7200,
+        "ratings": 1,
+        "medianSeconds": 20
+    }]
+
+    assert client.get(f"/api/throughput?since={START + 7000}").json(
+    )["ratings"] == 1
+    assert client.get("/api/throughput?since=x").status_code == 400
+
+
+def test_views_do_not_create_raters(study_db, client, buffer):
+
+    client.get("/api/entity/1/view?rater=r1")
+    assert not models.Rater.select().exists()
+
+    buffer.flush()
+    rater = models.Rater.get()
+    assert rater.name == "r1"
+    event = models.RaterEvent.get()
+    assert (event.rater, event.kind) == (rater.id, models.VIEW_EVENT)
+
+
+def test_buffer_flushes_full_batches_in_background(study_db):
+
+    buffer = telemetry.TelemetryBuffer(batch_size=2, interval=60)
+    buffer.start()
+    try:
+        buffer.record(models.VIEW_EVENT, 1)
+        buffer.record(models.SAVE_EVENT, 1)
+        deadline = time.monotonic() + 5
+        while (models.RaterEvent.select().count() < 2
+               and time.monotonic() < deadline):
+            time.sleep(0.01)
+        assert models.RaterEvent.select().count() == 2
+
+        buffer.record(models.VIEW_EVENT, 2)
+    finally:
+        buffer.stop()
+    assert models.RaterEvent.select().count() == 3
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from niviz_rater.cache import FileCache
+import niviz_rater.thumbnails as thumbnails
+
+PILImage = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def service(tmp_path):
+    base = tmp_path / "images"
+    base.mkdir()
+    cache = FileCache(tmp_path / "cache", max_size=1024**2)
+    service = thumbnails.ThumbnailService(base, cache, size=32)
+    yield service
+    service.shutdown()
+
+
+def _generated(service, relpath):
+    assert service.get(relpath) is None
+    service.wait()
+    return service.get(relpath)
+
+
+def test_thumbnail_fits_within_configured_size(service):
+
+    PILImage.new("RGB", (200, 100)).save(service.base_directory / "a.png")
+
+    thumb = _generated(service, "a.png")
+
+    with PILImage.open(thumb) as img:
+        assert img.size == (32, 16)
+
+
+def test_thumbnail_is_generated_once(service):
+
+    PILImage.new("RGB", (200, 100)).save(service.base_directory / "a.jpg")
+
+    first = _generated(service, "a.jpg")
+    mtime = first.stat().st_mtime_ns
+    second = service.get("a.jpg")
+
+    assert first == second
+    assert service.cache.size == first.stat().st_size
+    assert second.stat().st_mtime_ns >= mtime
+
+
+def test_unreadable_images_are_not_thumbnailed(service, monkeypatch):
+
+    source = service.base_directory / "a.png"
+    source.write_bytes(b"not a png")
+    assert _generated(service, "a.png") is None
+
+    # Failures are not retried until the image is modified
+    with monkeypatch.context() as m:
+        m.setattr(service._executor, "submit", None)
+        assert service.get("a.png") is None
+
+    PILImage.new("RGB", (200, 100)).save(source)
+    os.utime(source, ns=(1, 1))
+    assert _generated(service, "a.png") is not None
+
+
+def test_thumbnail_route_revalidates_by_source(service, study_db, client,
+                                               monkeypatch):
+
+    monkeypatch.setitem(client.app.config, 'niviz_rater.thumbnails', service)
+    source = service.base_directory / "a.png"
+    PILImage.new("RGB", (200, 100)).save(source)
+
+    # The full image is served while the thumbnail is generated
+    assert client.get("/api/thumbnail/a.png").status_code in (302, 303)
+    service.wait()
+    response = client.get("/api/thumbnail/a.png")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.headers["Etag"]
+    assert client.get("/api/thumbnail/a.png",
+                      headers={"If-None-Match": etag}).status_code == 304
+
+    PILImage.new("RGB", (100, 100)).save(source)
+    os.utime(source, ns=(1, 1))
+    _generated(service, "a.png")
+    response = client.get("/api/thumbnail/a.png",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["Etag"] != etag
+
+
+def test_svg_images_are_not_thumbnailed(service):
+
+    (service.base_directory / "a.svg").write_text("<svg></svg>")
+    assert service.get("a.svg") is None
+
+
+def test_paths_outside_base_directory_are_refused(service, tmp_path):
+
+    PILImage.new("RGB", (200, 100)).save(tmp_path / "outside.png")
+    assert service.get("../outside.png") is None
@@ -0,0 +1,142 @@
+"""
+Lazily generated raster thumbnails of QC images
+"""
+
+from __future__ import annotations
+from typing import Dict, Optional
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import io
+import logging
+import os
+import threading
+
+from niviz_rater.cache import FileCache, PathLike
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+logger = logging.getLogger(__name__)
+
+# Vector images (SVG) are served as-is
+THUMBNAIL_FORMATS = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG"}
+
+
+def is_thumbnailable(path: PathLike) -> bool:
+    return PILImage is not None and os.path.splitext(
+        path)[1].lower() in THUMBNAIL_FORMATS
+
+
+def make_thumbnail(source: PathLike, size: int) -> bytes:
+    """
+    Render a thumbnail of `source` fitting within a `size` x `size` box
+    """
+
+    image_format = THUMBNAIL_FORMATS[Path(source).suffix.lower()]
+    with PILImage.open(source) as img:
+        img.thumbnail((size, size))
+        if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format=image_format, optimize=True)
+    return buf.getvalue()
+
+
+class ThumbnailService:
+    """
+    Generate thumbnails of images under `base_directory` in the
+    background using a bounded pool of workers, starting on the first
+    request of each image, and store them in `cache`. Images that could
+    not be thumbnailed are not retried until they are modified
+    """
+
+    def __init__(self,
+                 base_directory: PathLike,
+                 cache: FileCache,
+                 size: int = 256,
+                 max_workers: int = 2):
+        self.base_directory = Path(base_directory).resolve()
+        self.cache = cache
+        self.size = size
+        self.variant = f"thumb{size}"
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="thumbnail")
+        self._pending: Dict[Path, Future] = {}
+        # Modification times of images that could not be thumbnailed
+        self._failed: Dict[Path, int] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, relpath: str) -> Optional[Path]:
+        """
+        Resolve `relpath` against the base directory, refusing
+        paths outside of it
+        """
+        source = (self.base_directory / relpath).resolve()
+        try:
+            source.relative_to(self.base_directory)
+        except ValueError:
+            return None
+        return source
+
+    def get(self, relpath: str) -> Optional[Path]:
+        """
+        Return path to thumbnail of `relpath` if it is cached, otherwise
+        start generating it in the background and return None, as when
+        a thumbnail cannot be created
+        """
+
+        source = self.resolve(relpath)
+        if (source is None or not is_thumbnailable(source)
+                or not source.is_file()):
+            return None
+
+        variant = f"{self.variant}{source.suffix.lower()}"
+        entry = self.cache.get(source, variant)
+        if entry is not None:
+            return entry
+
+        mtime = source.stat().st_mtime_ns
+        with self._lock:
+            if source in self._pending or self._failed.get(source) == mtime:
+                return None
+            future = self._executor.submit(self._generate, source, variant,
+                                           mtime)
+            self._pending[source] = future
+        # Outside of the lock, a finished future runs the callback now
+        future.add_done_callback(lambda _: self._done(source))
+        return None
+
+    def _done(self, source: Path):
+        with self._lock:
+            self._pending.pop(source, None)
+
+    def _generate(self, source: Path, variant: str,
+                  mtime: int) -> Optional[Path]:
+        try:
+            thumb = self.cache.put(source, variant,
+                                   make_thumbnail(source, self.size))
+        except Exception as e:
+            logger.error(f"Failed to generate thumbnail for {source}")
+            logger.error(f"Error msg: {e}")
+            with self._lock:
+                self._failed[source] = mtime
+            return None
+
+        with self._lock:
+            self._failed.pop(source, None)
+        return thumb
+
+    def wait(self):
+        """
+        Wait for thumbnails being generated
+        """
+
+        with self._lock:
+            pending = list(self._pending.values())
+        wait(pending)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)